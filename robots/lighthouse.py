@@ -62,6 +62,13 @@ def play(botSocket, srvConf):
                     # we are ready to shoot again!
                     currentMode = "scan"
 
+            if currentMode == "refire":
+                # The last fireCanonRequest got no reply so we don't know if the server fired. Try it again
+                # with the same msgID. If its reply came late (while we sent other requests) then that reply
+                # is used without sending the request again, so we never fire twice at one target.
+                currentMode = "wait"
+                botSocket.sendRecvMessage(fireRequest, msgID=fireRequest['msgID'])
+
             if currentMode == "scan":
                 scanRadStart = nextScanSlice * scanSliceWidth
                 scanRadEnd = min(scanRadStart + scanSliceWidth, math.pi * 2)
@@ -72,8 +79,10 @@ def play(botSocket, srvConf):
                 if scanReply['distance'] != 0:
                     # fire down the center of the slice we just scanned.
                     fireDirection = scanRadStart + scanSliceWidth / 2
-                    botSocket.sendRecvMessage(
-                        {'type': 'fireCanonRequest', 'direction': fireDirection, 'distance': scanReply['distance']})
+                    fireRequest = {'type': 'fireCanonRequest', 'direction': fireDirection,
+                                   'distance': scanReply['distance']}
+                    currentMode = "refire"  # until the server replies.
+                    botSocket.sendRecvMessage(fireRequest)
                     # make sure don't try and shoot again until this shell has exploded.
                     currentMode = "wait"
 
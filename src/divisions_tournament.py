@@ -7,7 +7,6 @@ import signal
 import argparse
 import platform
 import json
-import re
 
 #include the netbot src directory in sys.path so we can import modules from it.
 filepath = os.path.dirname(os.path.abspath(__file__))
@@ -45,22 +44,43 @@ def closeFiles():
     fd = []
 
 
-def startserver(divisionDir):
+def startserver(roundDir, name, arenas):
+    # One server runs all divisions, division n in arena n on port 20000 + n.
     global fd
-    f = open(os.path.join(divisionDir,"server.output.txt"), "w")
+    f = open(os.path.join(roundDir, name + ".server.output.txt"), "w")
     fd.append(f)
-    cmdline = pythoncmd + srvoptions + [os.path.join(divisionDir,"results.json")]
+    cmdline = pythoncmd + srvoptions + [os.path.join(roundDir, name + ".results.json"), '-arenas', str(arenas)]
     log(cmdline, "DEBUG")
     p = subprocess.Popen(cmdline, stdout=f, stderr=subprocess.STDOUT)
     return p
 
 
-def startbot(divisionDir, botkey):
+def arenaJsonFile(roundDir, name, arena, arenas):
+    # The server adds the arena number to the -jsonsb filename when it runs more than one arena.
+    if arenas > 1:
+        return os.path.join(roundDir, name + ".results-arena" + str(arena) + ".json")
+    return os.path.join(roundDir, name + ".results.json")
+
+
+def arenaScoreboard(serverOutput, arena, arenas):
+    # Return the lines of the final scoreboard of arena from the server output.
+    with open(serverOutput) as f:
+        lines = f.read().splitlines()
+    end = "Arena " + str(arena) + ":" if arenas > 1 else ":"
+    for i in range(len(lines)):
+        if "Final results of" in lines[i] and lines[i].endswith(end):
+            for j in range(i, len(lines)):
+                if lines[j].lstrip().startswith("Name      Points"):
+                    return lines[j + 2:j + 2 + botsInDivision]
+    return []
+
+
+def startbot(divisionDir, botkey, serverPort):
     global fd, robotsDir, bots
     bot = bots[botkey]
     f = open(os.path.join(divisionDir, bot['file'] + ".output.txt"), "w")
     fd.append(f)
-    cmdline = pythoncmd + [os.path.join(robotsDir, bot['file']), '-p', str(bot['port']),'-sp','20000']
+    cmdline = pythoncmd + [os.path.join(robotsDir, bot['file']), '-p', str(bot['port']),'-sp',str(serverPort)]
     log(cmdline, "DEBUG")
     p = subprocess.Popen(cmdline, stdout=f, stderr=subprocess.STDOUT)
     return p
@@ -78,17 +98,21 @@ def botsToString(divisions):
     return(output)
 
 
-def rundivision(divisionDir, botkeys):
+def rundivisions(roundDir, name, divisionDirs, divisionBotkeys):
+    # Run all divisions at once in one server, division n in arena n.
     global bots
 
-    log("Running Division: " + divisionDir)
-    os.mkdir(divisionDir)
+    arenas = len(divisionDirs)
+    for divisionDir in divisionDirs:
+        log("Running Division: " + divisionDir)
+        os.mkdir(divisionDir)
 
-    srvProc = startserver(divisionDir)
+    srvProc = startserver(roundDir, name, arenas)
 
     botProcs = []
-    for botkey in botkeys:
-        botProcs.append(startbot(divisionDir, botkey))
+    for arena in range(arenas):
+        for botkey in divisionBotkeys[arena]:
+            botProcs.append(startbot(divisionDirs[arena], botkey, 20000 + arena))
 
     time.sleep(2)
 
@@ -127,17 +151,19 @@ def rundivision(divisionDir, botkeys):
 
     closeFiles()
 
-    # if results.json has been created then load results else log error.
-    jsonFile = os.path.join(divisionDir,"results.json")
-    if os.path.isfile(jsonFile):
-        with open(jsonFile) as json_file:
-            results = json.load(json_file)
-        botSort = sorted(results['bots'], key=lambda b: results['bots'][b]['points'], reverse=True)
-        for i in range(len(botSort)):
-            botkeys[i] = botSort[i]
-    else:
-        log("Server did not produce json file: " + jsonFile, "FAILURE")
-        quit()
+    # if the json file of each arena has been created then load results else log error.
+    for arena in range(arenas):
+        botkeys = divisionBotkeys[arena]
+        jsonFile = arenaJsonFile(roundDir, name, arena, arenas)
+        if os.path.isfile(jsonFile):
+            with open(jsonFile) as json_file:
+                results = json.load(json_file)
+            botSort = sorted(results['bots'], key=lambda b: results['bots'][b]['points'], reverse=True)
+            for i in range(len(botSort)):
+                botkeys[i] = botSort[i]
+        else:
+            log("Server did not produce json file: " + jsonFile, "FAILURE")
+            quit()
 
 
 def quit(signal=None, frame=None):
@@ -234,9 +260,10 @@ def main():
                     divisions[divisionNumber+1][1]
                    ])
 
+            crossDivisionDirs = []
             for divisionNumber in range(divisionsTotal-1):
-                divisionDir = os.path.join(roundDir, "crossdivision-" + str(divisionNumber) + "x" + str(divisionNumber+1))
-                rundivision(divisionDir, crossDivisions[divisionNumber])
+                crossDivisionDirs.append(os.path.join(roundDir, "crossdivision-" + str(divisionNumber) + "x" + str(divisionNumber+1)))
+            rundivisions(roundDir, "crossdivisions", crossDivisionDirs, crossDivisions)
 
             for b in range(divisionsTotal-1):
                 # !!! ASSUMES botsInDivition == 4
@@ -250,9 +277,10 @@ def main():
             log(botsToString(divisions), "VERBOSE")
 
         # Run each division and put robots in division in order of points.
+        divisionDirs = []
         for divisionNumber in range(divisionsTotal):
-            divisionDir = os.path.join(roundDir, "division-" + str(divisionNumber))
-            rundivision(divisionDir, divisions[divisionNumber])
+            divisionDirs.append(os.path.join(roundDir, "division-" + str(divisionNumber)))
+        rundivisions(roundDir, "divisions", divisionDirs, divisions)
 
         log(botsToString(divisions), "VERBOSE")
 
@@ -266,10 +294,8 @@ def main():
 
         for divisionNumber in range(divisionsTotal):
             output += "DIVISION " + str(divisionNumber)
-            roundoutput = os.path.join(roundDir, "division-" + str(divisionNumber), "server.output.txt")
-            p = subprocess.Popen(["grep", "-m1", "-A", str(botsInDivision), "\------------------", roundoutput], stdout=subprocess.PIPE, stderr=sys.stdout.buffer)
-            tmp = p.stdout.read().decode("utf-8")
-            output += re.sub(r'---*','',tmp)
+            roundoutput = os.path.join(roundDir, "divisions.server.output.txt")
+            output += "\n" + "\n".join(arenaScoreboard(roundoutput, divisionNumber, divisionsTotal)) + "\n"
             output += "\n"
 
         with open(resultsfilename,"a+") as f: 
@@ -0,0 +1,342 @@
+import argparse
+import math
+import multiprocessing
+import os
+import random
+import time
+
+from netbots_log import log
+from netbots_log import setLogLevel
+import netbots_ipc as nbipc
+import netbots_server as nbsrv
+import netbots_npengine as nbnp
+import netbots_recorder as nbrec
+
+"""
+**About Headless Mode**
+
+Headless mode runs NetBots games inside one python process with no sockets and no
+step pacing. Games run as fast as the server and robots can go, which is useful for
+evaluating robots over thousands of games.
+
+Robots are python objects derived from HeadlessRobot. Once per server step each robot's
+play() method is called with a HeadlessBotLink. The link's sendRecvMessage() takes the
+same request dicts a robot would send over the network and returns the same reply dicts,
+by calling netbots_server.processMsg() directly. For example:
+
+    class Spinner(HeadlessRobot):
+        name = "Spinner"
+
+        def play(self, srv):
+            info = srv.sendRecvMessage({'type': 'getInfoRequest'})
+            if info['health'] != 0:
+                direction = self.rng.random() * math.pi * 2
+                srv.sendRecvMessage({'type': 'setDirectionRequest', 'requestedDirection': direction})
+
+    d = runHeadless([Spinner(), Spinner(), Spinner(), Spinner()], {'gamesToPlay': 100})
+    logScoreboard(d)
+
+Just like the network server, a robot may only send conf['botMsgsPerStep'] messages each
+step. Messages are never dropped in headless mode.
+
+Robots should make random choices with self.rng, a random.Random that runHeadless() seeds
+from its seed argument, so runs with the same seed play the same games. runHeadless() does
+not seed the random module.
+"""
+
+
+class HeadlessException(Exception):
+    """Raised when a headless robot can not join or sends an invalid message."""
+    pass
+
+
+class StepBudgetUsed(Exception):
+    """Raised by HeadlessBotLink.sendRecvMessage() when a robot has used all of its messages this step."""
+    pass
+
+
+class HeadlessRobot:
+    """ Base class for robots that run in the same process as the server. """
+    name = "Headless Robot"
+    robotClass = "default"
+
+    def start(self, srvConf):
+        """
+        Called once after the robot joins. srvConf is the conf from the joinReply. self.rng
+        has already been set to the robot's own random.Random.
+        """
+        self.srvConf = srvConf
+
+    def play(self, srv):
+        """
+        Called once per server step. Use srv.sendRecvMessage(msg) to send requests to the
+        server. Return when done with this step.
+        """
+        pass
+
+
+class HeadlessBotLink:
+    """ Connects one HeadlessRobot directly to the server data. """
+
+    def __init__(self, d, src, robot):
+        self.d = d
+        self.src = src
+        self.robot = robot
+        self.msgCount = 0  # Number of messages sent this step.
+
+    def sendRecvMessage(self, msg):
+        """
+        Process msg on the server and return the reply.
+
+        Raises HeadlessException if msg is not a valid message.
+        Raises nbipc.NetBotSocketException if the reply is an Error message, just like
+        NetBotSocket.sendRecvMessage().
+        Raises StepBudgetUsed if the robot has already sent botMsgsPerStep messages this step.
+        """
+        if self.msgCount >= self.d.conf['botMsgsPerStep']:
+            raise StepBudgetUsed()
+        self.msgCount += 1
+
+        if not nbipc.isValidMsg(msg):
+            raise HeadlessException("Robot " + self.robot.name + " sent invalid message: " + str(msg))
+
+        if self.d.recorder:
+            self.d.recorder.msg(self.d, self.src, msg)
+        reply = nbsrv.processMsg(self.d, msg, self.src)
+        if reply['type'] == "Error":
+            raise nbipc.NetBotSocketException("Received Error Message: " + reply['result'])
+        return reply
+
+
+def mkSrvData(conf=None):
+    """
+    Return new SrvData for a headless run. conf is a dict of conf values that override the
+    defaults.
+    """
+    d = nbsrv.SrvData()
+
+    # Messages are not dropped by default since there is no network to emulate.
+    d.conf['dropRate'] = 0
+    if conf:
+        d.conf.update(conf)
+    d.state['dropNext'] = d.conf['dropRate']
+    d.conf['noViewers'] = True
+    return d
+
+
+def runHeadless(robots, conf=None, obstacles=0, jamZones=0, seed=None, engine='python', record=None, idle='off'):
+    """
+    Play conf['gamesToPlay'] games between robots (list of HeadlessRobot) with no sockets and
+    no step pacing. conf is a dict of conf values that override the defaults. botsInGame is
+    always set to len(robots). If record is a filename then the games are recorded to it and
+    can be played again with netbots_server.replayRecording(). If idle is 'jump' then games
+    where nothing happens are jumped to stepMax (see netbots_server.isIdle()).
+
+    Returns the SrvData of the finished tournament. Scores are in d.bots.
+    """
+    if engine == 'numpy' and not nbnp.available():
+        raise HeadlessException("The numpy step engine was requested but numpy is not installed.")
+
+    d = mkSrvData(conf)
+    d.rng.seed(seed)
+    d.conf['botsInGame'] = len(robots)
+    d.conf['obstacles'] = nbsrv.mkObstacles(d, obstacles)
+    d.conf['jamZones'] = nbsrv.mkJamZones(d, jamZones)
+    d.state['engine'] = engine
+    d.state['idlePolicy'] = idle
+    d.compileClassParams()
+    nbsrv.mkStartLocations(d)
+    if record:
+        d.recorder = nbrec.Recorder(record, d, seed)
+
+    links = []
+    for i in range(len(robots)):
+        robot = robots[i]
+        src = nbipc.formatIpPort("headless", i)
+        msg = {'type': 'joinRequest', 'name': robot.name}
+        if robot.robotClass != "default":
+            msg['class'] = robot.robotClass
+        # Each robot has its own random numbers so the caller's random module is left alone.
+        robot.rng = random.Random(None if seed is None else "robot " + str(i) + " seed " + str(seed))
+        if d.recorder:
+            d.recorder.msg(d, src, msg)
+        reply = nbsrv.processMsg(d, msg, src)
+        if reply['type'] == "Error":
+            raise HeadlessException("Robot " + robot.name + " could not join: " + reply['result'])
+        robot.start(reply['conf'])
+        links.append(HeadlessBotLink(d, src, robot))
+
+    d.state['tourStartTime'] = time.time()
+    while d.state['gameNumber'] < d.conf['gamesToPlay']:
+        # Recorded ticks line up with netbots_server.stepGame(), which starts a game when all bots are dead.
+        if d.recorder:
+            d.recorder.tick(d)
+        nbsrv.initGame(d)
+        alive = True
+        while alive:
+            for link in links:
+                link.msgCount = 0
+                try:
+                    link.robot.play(link)
+                except StepBudgetUsed:
+                    pass
+                if link.msgCount == 0:
+                    d.bots[link.src]['missedSteps'] += 1
+
+            if d.recorder:
+                d.recorder.tick(d)
+            nbsrv.jumpToStepMax(d)
+            nbsrv.step(d)
+
+            alive = False
+            for src, bot in d.bots.items():
+                if bot['health'] != 0:
+                    alive = True
+                    break
+
+    if d.recorder:
+        d.recorder.close()
+
+    log("Headless tournament of " + str(d.state['gameNumber']) + " games took " +
+        '%.3f' % (time.time() - d.state['tourStartTime']) + " secs.", "VERBOSE")
+    return d
+
+
+def runHeadlessBatch(robots, conf, obstacles, jamZones, seed, engine, idle):
+    """ Pool worker for runHeadlessPool(). Play one batch of games and return its netbots_server.arenaResult(). """
+    return nbsrv.arenaResult(runHeadless(robots, conf, obstacles, jamZones, seed, engine, idle=idle))
+
+
+def runHeadlessPool(robots, conf=None, obstacles=0, jamZones=0, seed=None, engine='python', workers=0, idle='off'):
+    """
+    Same as runHeadless() but conf['gamesToPlay'] games are split into batches that are
+    played at the same time by a pool of worker processes. workers is the number of
+    processes, 0 == one per CPU core. If seed is given then batch n uses seed + n.
+
+    Returns a SrvData with the combined results of all batches (see netbots_server.mergeResults()).
+    """
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    if conf is None:
+        conf = {}
+    games = conf.get('gamesToPlay', nbsrv.SrvData.conf['gamesToPlay'])
+    workers = max(1, min(workers, games))
+
+    batches = []
+    for w in range(workers):
+        batchConf = dict(conf)
+        batchConf['gamesToPlay'] = games // workers + (1 if w < games % workers else 0)
+        batchSeed = None if seed is None else seed + w
+        batches.append((robots, batchConf, obstacles, jamZones, batchSeed, engine, idle))
+
+    with multiprocessing.Pool(workers) as pool:
+        results = pool.starmap(runHeadlessBatch, batches)
+
+    return nbsrv.mergeResults(results)
+
+
+########################################################
+# Demo Robots
+########################################################
+
+
+class SittingDuck(HeadlessRobot):
+    """ Headless version of robots/sittingduck.py. """
+    name = "SittingDuck"
+
+    def play(self, srv):
+        srv.sendRecvMessage({'type': 'getInfoRequest'})
+
+
+class WallBanger(HeadlessRobot):
+    """ Headless version of robots/wallbanger.py. """
+    name = "WallBanger"
+
+    def play(self, srv):
+        getInfoReply = srv.sendRecvMessage({'type': 'getInfoRequest'})
+        if getInfoReply['health'] == 0:
+            return
+
+        getSpeedReply = srv.sendRecvMessage({'type': 'getSpeedRequest'})
+        if getSpeedReply['requestedSpeed'] == 0:
+            radians = self.rng.random() * 2 * math.pi
+            srv.sendRecvMessage({'type': 'setDirectionRequest', 'requestedDirection': radians})
+            srv.sendRecvMessage({'type': 'setSpeedRequest', 'requestedSpeed': 100})
+
+
+class LightHouse(HeadlessRobot):
+    """ Headless version of robots/lighthouse.py. """
+    name = "LightHouse"
+    scanSlices = 32
+
+    def play(self, srv):
+        getInfoReply = srv.sendRecvMessage({'type': 'getInfoRequest'})
+        if getInfoReply['health'] == 0:
+            return
+
+        if getInfoReply['gameNumber'] != getattr(self, 'gameNumber', 0):
+            self.gameNumber = getInfoReply['gameNumber']
+            self.currentMode = "scan"
+            self.nextScanSlice = 0
+
+        scanSliceWidth = math.pi * 2 / self.scanSlices
+
+        if self.currentMode == "wait":
+            getCanonReply = srv.sendRecvMessage({'type': 'getCanonRequest'})
+            if not getCanonReply['shellInProgress']:
+                self.currentMode = "scan"
+
+        if self.currentMode == "scan":
+            scanRadStart = self.nextScanSlice * scanSliceWidth
+            scanRadEnd = min(scanRadStart + scanSliceWidth, math.pi * 2)
+            scanReply = srv.sendRecvMessage(
+                {'type': 'scanRequest', 'startRadians': scanRadStart, 'endRadians': scanRadEnd})
+
+            if scanReply['distance'] != 0:
+                fireDirection = scanRadStart + scanSliceWidth / 2
+                srv.sendRecvMessage(
+                    {'type': 'fireCanonRequest', 'direction': fireDirection, 'distance': scanReply['distance']})
+                self.currentMode = "wait"
+
+            self.nextScanSlice = (self.nextScanSlice + 1) % self.scanSlices
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-games', metavar='int', dest='gamesToPlay', type=int,
+                        default=100, help='Games to play.')
+    parser.add_argument('-stepmax', metavar='int', dest='stepMax', type=int,
+                        default=1000, help='Max steps in one game.')
+    parser.add_argument('-seed', metavar='int', dest='seed', type=int,
+                        default=None, help='Random seed.')
+    parser.add_argument('-engine', dest='engine', type=str, choices=['python', 'numpy'],
+                        default='python', help='Step engine.')
+    parser.add_argument('-idle', dest='idle', type=str, choices=['off', 'jump'],
+                        default='off', help='Jump games where nothing is happening to stepMax.')
+    parser.add_argument('-record', metavar='filename', dest='record', type=str,
+                        default=None, help='Record the games to filename. Only with -workers 1.')
+    parser.add_argument('-workers', metavar='int', dest='workers', type=int,
+                        default=1, help='Number of processes to spread games over. 0 == one per CPU core.')
+    parser.add_argument('-debug', dest='debug', action='store_true',
+                        default=False, help='Print DEBUG level log messages.')
+    parser.add_argument('-verbose', dest='verbose', action='store_true',
+                        default=False, help='Print VERBOSE level log messages. Note, -debug includes -verbose.')
+    args = parser.parse_args()
+
+    setLogLevel(args.debug, args.verbose)
+
+    if args.record and args.workers != 1:
+        log("-record can only be used with -workers 1. Games played by a pool of workers are not recorded.", "FAILURE")
+        exit()
+
+    robots = [SittingDuck(), WallBanger(), LightHouse(), LightHouse()]
+    conf = {'gamesToPlay': args.gamesToPlay, 'stepMax': args.stepMax}
+    if args.workers == 1:
+        d = runHeadless(robots, conf, seed=args.seed, engine=args.engine, record=args.record, idle=args.idle)
+    else:
+        d = runHeadlessPool(robots, conf, seed=args.seed, engine=args.engine, workers=args.workers, idle=args.idle)
+    nbsrv.logScoreboard(d)
+
+
+if __name__ == "__main__":
+    main()
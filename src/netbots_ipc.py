@@ -4,8 +4,10 @@ import time
 import re
 import math
 import argparse
+import asyncio
 
 from netbots_log import log
+from netbots_log import logEnabled
 
 try:
     import msgpack as umsgpack
@@ -71,6 +73,9 @@ MsgDef = {
     'scanRequest': {'startRadians': ['(int,float)', 0, math.pi * 2], 'endRadians': ['(int,float)', 0, math.pi * 2]},
     'scanReply': {'distance': ['(int,float)', 0, 32767]},
 
+    'endTurnRequest': {},
+    'endTurnReply': {},
+
     'addViewerRequest': {},
     'addViewerReply': {'conf': 'dict'},
 
@@ -81,11 +86,87 @@ MsgDef = {
 }
 
 
-def isValidMsg(msg):
-    """ Returns True if msg is a valid message, otherwise returns false. """
+# Names of the python types that MsgDef field types may use.
+msgTypeNames = {'int': int, 'float': float, 'str': str, 'bool': bool, 'dict': dict, 'list': list}
+
+# Keys that may be in any message (see Messages in README.md).
+msgCommonKeys = ('type', 'msgID', 'replyData')
+
+
+def msgTypeTuple(typeName):
+    """ Return tuple of python types for a MsgDef type name such as 'int' or '(int,float)'. """
+    return tuple(msgTypeNames[name.strip()] for name in typeName.strip('()').split(','))
 
-    global MsgDef
 
+def mkMsgValidator(msgtype, msgspec):
+    """
+    Return a function that checks a message of type msgtype against msgspec, its entry in
+    MsgDef. The function returns None if the message is valid, otherwise a str saying why not.
+    """
+    fields = []  # [(name, optional, types, typeName, isStr, min, max), ...]
+    for fld, fldspec in msgspec.items():
+        optional = fld.endswith('_o')
+        if optional:
+            # remove magic suffix marking field as optional
+            fld = fld[:-2]
+        if isinstance(fldspec, list):
+            fields.append((fld, optional, msgTypeTuple(fldspec[0]), fldspec[0], fldspec[0] == 'str', fldspec[1], fldspec[2]))
+        else:
+            fields.append((fld, optional, msgTypeTuple(fldspec), fldspec, False, None, None))
+    known = frozenset([f[0] for f in fields] + list(msgCommonKeys))
+
+    def validate(msg):
+        found = 1  # 'type'
+        for fld, optional, types, typeName, isStr, lo, hi in fields:
+            if fld not in msg:
+                if optional:
+                    # optional field is not present, which is valid.
+                    continue
+                return "Msg does not contain required '" + fld + "' key: " + str(msg)
+            value = msg[fld]
+            if not isinstance(value, types):
+                return ("Msg '" + fld + "' key has value of type " + str(type(value)) +
+                        " but expected " + typeName + ": " + str(msg))
+            if lo is not None:
+                if isStr:
+                    if len(value) < lo or len(value) > hi:
+                        return ("Msg '" + fld + "' key has a string value " + str(value) +
+                                " with length out of range [" + str(lo) + "," + str(hi) + "] : " + str(msg))
+                elif value < lo or value > hi:
+                    return ("Msg '" + fld + "' key has a value " + str(value) +
+                            " which is out of range [" + str(lo) + "," + str(hi) + "] : " + str(msg))
+            found += 1
+        # msgId and replyData are always optional and have no specific format. So they are always valid if present.
+        if 'msgID' in msg:
+            found += 1
+        if 'replyData' in msg:
+            found += 1
+        if found != len(msg):
+            # message has fields it should not have.
+            extra = [fld for fld in msg if fld not in known]
+            result = ("Msg contains field(s) " + str(extra) + " which is not defined for message type " +
+                      msgtype + ": " + str(msg))
+            for fld in extra:
+                if isinstance(fld, str) and fld.endswith('_o'):
+                    result += " Optional message fields should not include '_o' suffix in field name."
+                    break
+            return result
+        return None
+
+    return validate
+
+
+def compileMsgDef(msgDef):
+    """ Return {msgtype: validator, ...} with a validator from mkMsgValidator() for each type in msgDef. """
+    return {msgtype: mkMsgValidator(msgtype, msgspec) for msgtype, msgspec in msgDef.items()}
+
+
+# Validators for every message type, compiled once from MsgDef. Call compileMsgDef() again if MsgDef is changed.
+msgValidators = compileMsgDef(MsgDef)
+
+
+def isValidMsg(msg):
+    """ Returns True if msg is a valid message, otherwise returns false. """
     if not isinstance(msg, dict):
         log("Msg is type " + str(type(msg)) + " but must be dict type: " + str(msg), "ERROR")
         return False
@@ -93,63 +174,17 @@ def isValidMsg(msg):
         log("Msg does not contain 'type' key: " + str(msg), "ERROR")
         return False
 
-    unvalidedFields = list(msg.keys())
-    # type is validated below as part of loop so does not need specific validation.
-    unvalidedFields.remove('type')
-    # msgId and replyData are always optional and have no specific format. So they are always valid if present.
-    if 'msgID' in unvalidedFields:
-        unvalidedFields.remove('msgID')
-    if 'replyData' in unvalidedFields:
-        unvalidedFields.remove('replyData')
-
-    for msgtype, msgspec in MsgDef.items():
-        if msgtype == msg['type']:
-            for fld, fldspec in msgspec.items():
-                if fld.endswith('_o'):
-                    # remove magic suffix marking field as optional
-                    fld = fld.rstrip('_o')
-                    if fld not in msg:
-                        # optional field is not present, which is valid.
-                        continue
-                elif fld not in msg:
-                    log("Msg does not contain required '" + fld + "' key: " + str(msg), "ERROR")
-                    return False
-                if isinstance(fldspec, list):
-                    if not isinstance(msg[fld], eval(fldspec[0])):
-                        log("Msg '" + fld + "' key has value of type " + str(type(msg[fld])) +
-                            " but expected " + fldspec[0] + ": " + str(msg), "ERROR")
-                        return False
-                    if fldspec[0] is 'str':
-                        if len(msg[fld]) < fldspec[1] or len(msg[fld]) > fldspec[2]:
-                            log("Msg '" + fld + "' key has a string value " + str(msg[fld]) +
-                                " with length out of range [" + str(fldspec[1]) + "," +
-                                str(fldspec[2]) + "] : " + str(msg), "ERROR")
-                            return False
-                    elif msg[fld] < fldspec[1] or msg[fld] > fldspec[2]:
-                        log("Msg '" + fld + "' key has a value " + str(msg[fld]) +
-                            " which is out of range [" + str(fldspec[1]) + "," +
-                            str(fldspec[2]) + "] : " + str(msg), "ERROR")
-                        return False
-                else:
-                    if not isinstance(msg[fld], eval(fldspec)):
-                        log("Msg '" + fld + "' key has value of type " + str(type(msg[fld])) +
-                            " but expected " + fldspec + ": " + str(msg), "ERROR")
-                        return False
-                unvalidedFields.remove(fld)
-            # All fields defined for message type have now been examined and are valid
-            if len(unvalidedFields):
-                # message has fields it should not have.
-                log("Msg contains field(s) " + str(unvalidedFields) + " which is not defined for message type " + msg['type'] + ": " + str(msg), "ERROR")
-                for fld in unvalidedFields:
-                    if fld.endswith('_o'):
-                        log("Optional message fields should not include '_o' suffix in field name.", "WARNING")
-                        break
-                return False
-            else:
-                # message is valid and has no extra fields.
-                return True
-    log("Msg 'type' key has value '" + str(msg['type']) + "' which is not known: " + str(msg), "ERROR")
-    return False
+    msgtype = msg['type']
+    validate = msgValidators.get(msgtype) if isinstance(msgtype, str) else None
+    if validate is None:
+        log("Msg 'type' key has value '" + str(msgtype) + "' which is not known: " + str(msg), "ERROR")
+        return False
+
+    result = validate(msg)
+    if result is not None:
+        log(result, "ERROR")
+        return False
+    return True
 
 
 def isValidIP(ip):
@@ -195,23 +230,65 @@ class NetBotSocketException(Exception):
     pass
 
 
-class NetBotSocket:
-    """NetBot Msg filtering and basic reliable send/recv for UDP soket. """
-
-    def __init__(self, sourceIP, sourcePort, destinationIP='127.0.0.1', destinationPort=20000):
-        """
-        Create and bind UDP socket and bind it to listen on sourceIP and sourcePort.
-
-        sourceIP: IP the socket will listen on. This must be 127.0.0.1 (locahost), 0.0.0.0 (all interfaces), or a valid IP address on the computer.
-        sourcePort: port to listen on. This is an integer number.
-        destinationIP and destinationPort are stored with setDestinationAddress()
+class RttEstimator:
+    """
+    Round trip time (RTT) of requests to one destination and the retransmit timeout (rto)
+    computed from it, the same way as TCP (RFC 6298): a smoothed RTT (srtt) and RTT
+    variation (rttvar) are updated from each sample and rto = srtt + k * rttvar.
+
+    Only requests that were sent once may be sampled (Karn's rule), since a reply to a
+    request that was sent more than once could be the reply to any of the sends.
+    sendRecvMessage() already waits longer for each resend of a request (delayMultiplier),
+    so a single dropped message does not change rto. backoff() doubles rto, until the next
+    sample, only when a request gets no reply at all.
+
+    rto is never less than rtoMin. NetBotSocket sets rtoMin to stepSec when it gets a
+    joinReply because the server drops requests over a bot's msgPerStep for the rest of
+    the step and they get no reply. A resend sooner than one step would only be dropped
+    again, and since those requests are resent they are never sampled, so without this
+    rto would shrink to the round trip time of requests answered at once.
+    """
+
+    alpha = 1 / 8  # Weight of a new sample in srtt.
+    beta = 1 / 4  # Weight of a new sample in rttvar.
+    k = 4
+    rtoMin = 0.005
+    rtoMax = 2.0
+
+    def __init__(self, rtoMin=None):
+        if rtoMin is not None:
+            self.rtoMin = rtoMin
+        self.srtt = None
+        self.rttvar = None
+        self.rto = None  # None until the first sample.
+        self.samples = 0
+        self.backoffs = 0
+
+    def sample(self, r):
+        """ Update srtt, rttvar and rto with the round trip time, r, of a request that was sent once. """
+        if self.srtt is None:
+            self.srtt = r
+            self.rttvar = r / 2
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - r)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * r
+        self.samples += 1
+        self.rto = max(self.rtoMin, min(self.rtoMax, self.srtt + self.k * self.rttvar))
 
+    def backoff(self):
+        """ Double rto because a request needed a resend. Has no effect before the first sample. """
+        if self.rto is not None:
+            self.rto = max(self.rtoMin, min(self.rtoMax, self.rto * 2))
+            self.backoffs += 1
 
-        Returns NetBotSocket object.
 
-        Raises socket related exceptions.
-        """
+class NetBotSocketBase:
+    """
+    Message counts, round trip times (see RttEstimator) and stats shared by NetBotSocket
+    and AsyncNetBotSocket.
+    """
 
+    def __init__(self):
         self.sent = {}  # Number of messages sent to OS socket
         self.recv = {}  # Number of messages recv from OS socket
         self.sendRecvMessageCalls = 0  # Number of calls to sendRecvMessage
@@ -221,34 +298,31 @@ class NetBotSocket:
         self.recvTypes = {}
 
         self.sendrecvDelay = 0.1
-
-        self.sourceIP = sourceIP
-        self.sourcePort = sourcePort
-        log("Creating socket with sourceIP=" + sourceIP + ", sourcePort=" + str(sourcePort), "VERBOSE")
-        self.s = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-        try:
-            self.s.bind((sourceIP, sourcePort))
-            log("Source Socket Binding Successful. Listening on " + formatIpPort(sourceIP, sourcePort))
-        except Exception as e:
-            self.s.close()
-            self.s = None
-            log("Source Socket Binding Failed. The source port may already be in use. Try another port.", "FAILURE")
-            raise
-        self.s.settimeout(0)
-        self.destinationIP = destinationIP
-        self.destinationPort = destinationPort
-        self.bufferSize = 4096
-        random.seed()
-        self.msgID = random.randrange(0, 65000, 1)
-
-    def settimeout(self, t):
-        self.s.settimeout(t)
+        self.rtt = {}  # {"ip:port": RttEstimator, ...} of each destination sendRecvMessage has used.
+        self.rtoMin = None  # rtoMin of RttEstimators, None for RttEstimator.rtoMin
 
     def setDelay(self, delay):
+        """ Set the resend delay sendRecvMessage uses before it has measured the round trip time. """
         self.sendrecvDelay = delay
 
+    def setRtoMin(self, rtoMin):
+        """ Set the shortest retransmit timeout sendRecvMessage uses for every destination. """
+        self.rtoMin = rtoMin
+        for rtt in self.rtt.values():
+            rtt.rtoMin = rtoMin
+
+    def getRttEstimator(self, dest):
+        """ Return the RttEstimator of dest ("ip:port"). """
+        if dest not in self.rtt:
+            self.rtt[dest] = RttEstimator(self.rtoMin)
+        return self.rtt[dest]
+
+    def getStashStats(self):
+        """ Return str of reply stash stats for getStats(). Sockets with no stash have none. """
+        return ""
+
     def getStats(self):
-        """ Return str of NetBotSocket stats. """
+        """ Return str of socket stats. """
         output = "\n\n                 ====== Stats ======"
 
         if self.sendRecvMessageCalls:
@@ -257,12 +331,22 @@ class NetBotSocket:
                 "\n   sendRecvMessage Resends: " + str(self.sendRecvMessageResends) + \
                 "\n  Avg sendRecvMessage Time: " + \
                 '%.6f' % (self.sendRecvMessageTime / self.sendRecvMessageCalls) + " secs."
+        output += self.getStashStats()
 
         for src in self.sent.keys():
             output += "\n\n               === To/From: " + src + " ==="\
                 "\n             Messages Sent: " + str(self.sent[src]) +\
                 "\n             Messages Recv: " + str(self.recv[src])
 
+            if src in self.rtt and self.rtt[src].samples:
+                rtt = self.rtt[src]
+                output += "\n" + \
+                    "\n" + '%26s' % ("Round Trip Time (SRTT)") + ": " + '%.3f' % (rtt.srtt * 1000) + " ms" + \
+                    "\n" + '%26s' % ("RTT Variation (RTTVAR)") + ": " + '%.3f' % (rtt.rttvar * 1000) + " ms" + \
+                    "\n" + '%26s' % ("Retransmit Timeout (RTO)") + ": " + '%.3f' % (rtt.rto * 1000) + " ms" + \
+                    "\n" + '%26s' % ("RTT Samples") + ": " + str(rtt.samples) + \
+                    "\n" + '%26s' % ("RTO Backoffs") + ": " + str(rtt.backoffs)
+
             if src in self.sendTypes:
                 output += "\n\n                Messages Sent by Type"
                 for t, c in sorted(self.sendTypes[src].items(), key=lambda x: x[0]):
@@ -277,6 +361,57 @@ class NetBotSocket:
 
         return output
 
+
+class NetBotSocket(NetBotSocketBase):
+    """NetBot Msg filtering and basic reliable send/recv for UDP soket. """
+
+    replyStashSize = 64  # Most replies sendRecvMessage() keeps for later calls.
+    replyStashSecs = 10.0  # Replies kept longer than this are dropped.
+    answeredSize = 256  # Most msgIDs of answered calls remembered so later copies of their replies are dropped.
+
+    def __init__(self, sourceIP, sourcePort, destinationIP='127.0.0.1', destinationPort=20000):
+        """
+        Create and bind UDP socket and bind it to listen on sourceIP and sourcePort.
+
+        sourceIP: IP the socket will listen on. This must be 127.0.0.1 (locahost), 0.0.0.0 (all interfaces), or a valid IP address on the computer.
+        sourcePort: port to listen on. This is an integer number.
+        destinationIP and destinationPort are stored with setDestinationAddress()
+
+
+        Returns NetBotSocket object.
+
+        Raises socket related exceptions.
+        """
+
+        NetBotSocketBase.__init__(self)
+        self.replyStashAdds = 0  # Number of replies sendRecvMessage kept for a later call
+        self.replyStashHits = 0  # Number of sendRecvMessage calls answered from the stash
+        self.replyStashDrops = 0  # Number of replies not kept because their call was already answered
+        self.replyStash = {}  # {msgID: (time kept, msg, ip, port), ...} oldest first.
+        self.answered = {}  # {msgID: None, ...} of sendRecvMessage calls that got their reply, oldest first.
+
+        self.sourceIP = sourceIP
+        self.sourcePort = sourcePort
+        log("Creating socket with sourceIP=" + sourceIP + ", sourcePort=" + str(sourcePort), "VERBOSE")
+        self.s = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        try:
+            self.s.bind((sourceIP, sourcePort))
+            log("Source Socket Binding Successful. Listening on " + formatIpPort(sourceIP, sourcePort))
+        except Exception as e:
+            self.s.close()
+            self.s = None
+            log("Source Socket Binding Failed. The source port may already be in use. Try another port.", "FAILURE")
+            raise
+        self.s.settimeout(0)
+        self.destinationIP = destinationIP
+        self.destinationPort = destinationPort
+        self.bufferSize = 4096
+        random.seed()
+        self.msgID = random.randrange(0, 65000, 1)
+
+    def settimeout(self, t):
+        self.s.settimeout(t)
+
     def setDestinationAddress(self, destinationIP, destinationPort):
         """
         Set default destination used by NetBotSocket send and recv functions when
@@ -299,7 +434,7 @@ class NetBotSocket:
     def deserialize(self, b):
         return umsgpack.unpackb(b, raw=False)
 
-    def sendMessage(self, msg, destinationIP=None, destinationPort=None, packedAndChecked=False):
+    def sendMessage(self, msg, destinationIP=None, destinationPort=None, packedAndChecked=False, checked=False):
         """
         Sends msg to destinationIP:destinationPort and then returns immediately.
         sendMessage is considered asynchronous because it does not wait for a
@@ -315,6 +450,11 @@ class NetBotSocket:
         If packedAndChecked is True then msg is assumed to already be serialized
         and no other checks will be done.
 
+        If checked is True then msg, destinationIP and destinationPort are assumed
+        to be valid and are not checked, but msg is still serialized. Use this for
+        messages built by trusted code, such as server replies to the ip and port
+        a request came from.
+
         """
 
         if destinationIP is None:
@@ -324,20 +464,22 @@ class NetBotSocket:
             destinationPort = self.destinationPort
 
         if not packedAndChecked:
-            if not isValidMsg(msg):
-                raise NetBotSocketException("Could not send because msg is not valid format.")
-            if not isValidIP(destinationIP):
-                raise NetBotSocketException("Could not send because destinationIP is not valid format.")
-            if not isValidPort(destinationPort):
-                raise NetBotSocketException("Could not send because destinationPort is not valid format.")
+            if not checked:
+                if not isValidMsg(msg):
+                    raise NetBotSocketException("Could not send because msg is not valid format.")
+                if not isValidIP(destinationIP):
+                    raise NetBotSocketException("Could not send because destinationIP is not valid format.")
+                if not isValidPort(destinationPort):
+                    raise NetBotSocketException("Could not send because destinationPort is not valid format.")
 
             # Convert data from python objects to network binary format
             networkbytes = self.serialize(msg)
         else:
             networkbytes = msg
 
-        log("Sending msg to " + destinationIP + ":" + str(destinationPort) +
-            " len=" + str(len(networkbytes)) + " bytes " + str(msg), "DEBUG")
+        if logEnabled("DEBUG"):
+            log("Sending msg to " + destinationIP + ":" + str(destinationPort) +
+                " len=" + str(len(networkbytes)) + " bytes " + str(msg), "DEBUG")
         self.s.sendto(networkbytes, (destinationIP, destinationPort))
 
         dest = formatIpPort(destinationIP, destinationPort)
@@ -388,8 +530,9 @@ class NetBotSocket:
             msg = self.deserialize(bytesAddressPair[0])
             ip = bytesAddressPair[1][0]
             port = bytesAddressPair[1][1]
-            log("Received msg from " + ip + ":" + str(port) + " len=" +
-                str(len(bytesAddressPair[0])) + " bytes " + str(msg), "DEBUG")
+            if logEnabled("DEBUG"):
+                log("Received msg from " + ip + ":" + str(port) + " len=" +
+                    str(len(bytesAddressPair[0])) + " bytes " + str(msg), "DEBUG")
 
             src = formatIpPort(ip, port)
             if src in self.recv:
@@ -419,11 +562,65 @@ class NetBotSocket:
         # If we get a joinReply then use the server conf to tune our send delay in sendRecvMessage()
         if msg['type'] == 'joinReply':
             self.setDelay(msg['conf']['stepSec'] * 2)
+            self.setRtoMin(msg['conf']['stepSec'])
 
         return msg, ip, port
 
+    def getStashStats(self):
+        if not self.replyStashAdds and not self.replyStashDrops:
+            return ""
+        return "\n     Replies Kept in Stash: " + str(self.replyStashAdds) + \
+            "\n   Calls Answered by Stash: " + str(self.replyStashHits) + \
+            "\n Replies to Answered Calls: " + str(self.replyStashDrops)
+
+    def stashReply(self, msg, ip, port):
+        """
+        Keep msg, a reply to a request other than the one sendRecvMessage() is waiting for,
+        so a later call with its msgID can use it. Only the newest replyStashSize replies
+        are kept, for at most replyStashSecs. Copies of replies to calls that were already
+        answered (msg was sent more than once and each send was answered) are dropped.
+        """
+        if msg['msgID'] in self.answered:
+            self.replyStashDrops += 1
+            return
+
+        now = time.perf_counter()
+        self.expireReplyStash(now)
+        if msg['msgID'] in self.replyStash:
+            # Keep the newest copy of a reply to a request that was sent more than once.
+            del self.replyStash[msg['msgID']]
+        elif len(self.replyStash) >= self.replyStashSize:
+            del self.replyStash[next(iter(self.replyStash))]
+        self.replyStash[msg['msgID']] = (now, msg, ip, port)
+        self.replyStashAdds += 1
+
+    def markAnswered(self, msgID):
+        """ Remember that the call with msgID got its reply. Only the newest answeredSize are remembered. """
+        if msgID in self.answered:
+            del self.answered[msgID]
+        elif len(self.answered) >= self.answeredSize:
+            del self.answered[next(iter(self.answered))]
+        self.answered[msgID] = None
+
+    def expireReplyStash(self, now):
+        while self.replyStash:
+            msgID, entry = next(iter(self.replyStash.items()))
+            if now - entry[0] <= self.replyStashSecs:
+                break
+            del self.replyStash[msgID]
+
+    def popStashedReply(self, msgID, ip, port):
+        """ Remove and return the stashed reply from ip:port with msgID, or None if there is none. """
+        self.expireReplyStash(time.perf_counter())
+        entry = self.replyStash.get(msgID)
+        if entry is None or entry[2] != ip or entry[3] != port:
+            return None
+        del self.replyStash[msgID]
+        self.replyStashHits += 1
+        return entry[1]
+
     def sendRecvMessage(self, msg, destinationIP=None, destinationPort=None,
-                        retries=10, delay=None, delayMultiplier=1.2):
+                        retries=10, delay=None, delayMultiplier=1.2, msgID=None):
         """
         Sends msg to destinationIP:destinationPort and then returns the reply.
         sendRecvMessage is considered synchronous because it will not return
@@ -440,7 +637,18 @@ class NetBotSocket:
 
         If no reply is received then the message will be sent again (retried) in
         case it was dropped by the network. If the maximum number of retries is
-        reached then a NetBotSocketException exception will be raised.
+        reached then a NetBotSocketException exception will be raised. If delay
+        is not given then the first resend waits for the retransmit timeout of
+        the destination (see RttEstimator), or the delay set by setDelay() until
+        a round trip has been measured. Each later resend waits delayMultiplier
+        times longer than the one before.
+
+        Replies from the destination to other requests (e.g. that arrive after
+        an earlier call gave up) are not discarded but kept in a stash (see
+        stashReply()). If msgID is given then it is used rather than a new one,
+        so msg['msgID'] from a call that raised can be used to try that request
+        again. If its reply is in the stash then it is returned at once and msg
+        is not sent again, so the server does not do the request twice.
 
         Raises NetBotSocketException exception if the msg does not hae a valid format.
         """
@@ -454,20 +662,32 @@ class NetBotSocket:
         if destinationPort is None:
             destinationPort = self.destinationPort
 
+        rtt = self.getRttEstimator(formatIpPort(destinationIP, destinationPort))
         if delay:
             nextDelay = delay
+        elif rtt.rto is not None:
+            nextDelay = rtt.rto
         else:
             nextDelay = self.sendrecvDelay
 
         remaining = retries
 
-        self.msgID = self.msgID + 1
-        if self.msgID > 65000:
-            self.msgID = 0
+        newMsgID = msgID is None
+        if newMsgID:
+            self.msgID = self.msgID + 1
+            if self.msgID > 65000:
+                self.msgID = 0
+            msgID = self.msgID
+            # A reply kept from the last time this msgID was used is not for this request.
+            self.replyStash.pop(msgID, None)
+            self.answered.pop(msgID, None)
+            replyMsg = None
+        else:
+            replyMsg = self.popStashedReply(msgID, destinationIP, destinationPort)
 
-        msg['msgID'] = self.msgID
+        msg['msgID'] = msgID
 
-        gotReply = False
+        gotReply = replyMsg is not None
         sendMessage = 0
         while remaining != 0 and gotReply == False:
             if sendMessage <= time.perf_counter():
@@ -475,7 +695,8 @@ class NetBotSocket:
                 if sendMessage != 0:
                     self.sendRecvMessageResends += 1
                 remaining = remaining - 1
-                sendMessage = time.perf_counter() + nextDelay
+                sentAt = time.perf_counter()
+                sendMessage = sentAt + nextDelay
                 self.s.settimeout(nextDelay)
                 nextDelay = nextDelay * delayMultiplier
 
@@ -488,12 +709,25 @@ class NetBotSocket:
             if ip is not None:
                 # if the message is the one we are looking for.
                 if ip == destinationIP and port == destinationPort and \
-                        isinstance(replyMsg, dict) and \
-                        'msgID' in replyMsg and replyMsg['msgID'] == msg['msgID']:
-                    gotReply = True
+                        isinstance(replyMsg, dict) and 'msgID' in replyMsg:
+                    if replyMsg['msgID'] == msgID:
+                        gotReply = True
+                        replyAt = time.perf_counter()
+                    else:
+                        self.stashReply(replyMsg, ip, port)
 
         self.s.settimeout(0)
 
+        if gotReply:
+            self.markAnswered(msgID)
+
+        # Karn's rule: a reply is only a sample if msg was sent once with a msgID no earlier call used.
+        sends = retries - remaining
+        if gotReply and sends == 1 and newMsgID:
+            rtt.sample(replyAt - sentAt)
+        elif not gotReply:
+            rtt.backoff()
+
         if not gotReply:
             log("Raising Exception NetBotSocketException because failed to get valid respose after " + str(retries) +
                 " retries with delay = " + str(delay) + " and delayMultiplier = " + str(delayMultiplier), "VERBOSE")
@@ -508,3 +742,242 @@ class NetBotSocket:
 
         self.sendRecvMessageTime += time.perf_counter() - startTime
         return replyMsg
+
+
+class NetBotDatagramProtocol(asyncio.DatagramProtocol):
+    """ asyncio protocol that passes datagrams to an AsyncNetBotSocket. """
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    def datagram_received(self, data, addr):
+        self.owner.datagramReceived(data, addr)
+
+    def error_received(self, exc):
+        # Windows reports ICMP destination unreachable here. Requests will be resent or time out.
+        log("Socket error: " + str(exc), "WARNING")
+
+
+class AsyncNetBotSocket(NetBotSocketBase):
+    """
+    asyncio version of NetBotSocket. Many sendRecvMessage() calls can be waiting for their
+    replies at the same time, so a robot can send all its requests for a step together:
+
+        info, location, scan = await asyncio.gather(
+            botSocket.sendRecvMessage({'type': 'getInfoRequest'}),
+            botSocket.sendRecvMessage({'type': 'getLocationRequest'}),
+            botSocket.sendRecvMessage({'type': 'scanRequest', 'startRadians': 0, 'endRadians': 1}))
+
+    Each request gets its own msgID and replies are matched to requests by msgID, so they
+    may arrive in any order. Each request is resent on its own timer if its reply does not
+    arrive. Replies to requests that are no longer waiting are dropped. Other messages,
+    such as requests from robots when used by a server, are kept for recvMessage().
+
+    Create with: botSocket = await AsyncNetBotSocket.create(sourceIP, sourcePort, ...)
+    """
+
+    def __init__(self, sourceIP, sourcePort, destinationIP='127.0.0.1', destinationPort=20000):
+        """ Use create() rather than calling this directly. """
+        NetBotSocketBase.__init__(self)
+
+        self.sourceIP = sourceIP
+        self.sourcePort = sourcePort
+        self.destinationIP = destinationIP
+        self.destinationPort = destinationPort
+        self.transport = None
+        self.waiting = {}  # {msgID: (future, ip, port), ...} Requests waiting for a reply.
+        self.received = asyncio.Queue()  # (msg, ip, port) of messages that are not replies to sendRecvMessage().
+        random.seed()
+        self.msgID = random.randrange(0, 65000, 1)
+
+    @classmethod
+    async def create(cls, sourceIP, sourcePort, destinationIP='127.0.0.1', destinationPort=20000):
+        """
+        Create and bind a UDP endpoint on sourceIP and sourcePort (see NetBotSocket) and
+        return a new AsyncNetBotSocket. Must be called from a running event loop.
+
+        Raises socket related exceptions.
+        """
+        self = cls(sourceIP, sourcePort, destinationIP, destinationPort)
+        log("Creating async socket with sourceIP=" + sourceIP + ", sourcePort=" + str(sourcePort), "VERBOSE")
+        try:
+            self.transport, protocol = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: NetBotDatagramProtocol(self), local_addr=(sourceIP, sourcePort), family=socket.AF_INET)
+            log("Source Socket Binding Successful. Listening on " + formatIpPort(sourceIP, sourcePort))
+        except Exception as e:
+            log("Source Socket Binding Failed. The source port may already be in use. Try another port.", "FAILURE")
+            raise
+        return self
+
+    def close(self):
+        """ Close the socket. Requests still waiting for a reply raise NetBotSocketException. """
+        if self.transport:
+            self.transport.close()
+            self.transport = None
+        for future, ip, port in self.waiting.values():
+            if not future.done():
+                future.set_exception(NetBotSocketException("Socket closed."))
+        self.waiting = {}
+
+    def setDestinationAddress(self, destinationIP, destinationPort):
+        """ Same as NetBotSocket.setDestinationAddress(). """
+        if not isValidIP(destinationIP):
+            raise NetBotSocketException("Could not set destination because destinationIP is not valid format.")
+        if not isValidPort(destinationPort):
+            raise NetBotSocketException("Could not set destination because destinationPort is not valid format.")
+        self.destinationIP = destinationIP
+        self.destinationPort = destinationPort
+
+    def count(self, counts, types, peer, msgtype):
+        if peer in counts:
+            counts[peer] += 1
+        else:
+            counts[peer] = 1
+        if peer not in types:
+            types[peer] = {}
+        if msgtype in types[peer]:
+            types[peer][msgtype] += 1
+        else:
+            types[peer][msgtype] = 1
+
+    def sendMessage(self, msg, destinationIP=None, destinationPort=None):
+        """
+        Same as NetBotSocket.sendMessage(). Returns immediately without waiting for the
+        message to be sent.
+        """
+        if destinationIP is None:
+            destinationIP = self.destinationIP
+
+        if destinationPort is None:
+            destinationPort = self.destinationPort
+
+        if not isValidMsg(msg):
+            raise NetBotSocketException("Could not send because msg is not valid format.")
+        if not isValidIP(destinationIP):
+            raise NetBotSocketException("Could not send because destinationIP is not valid format.")
+        if not isValidPort(destinationPort):
+            raise NetBotSocketException("Could not send because destinationPort is not valid format.")
+        if self.transport is None:
+            raise NetBotSocketException("Could not send because socket is closed.")
+
+        networkbytes = umsgpack.packb(msg, use_bin_type=True)
+        if logEnabled("DEBUG"):
+            log("Sending msg to " + destinationIP + ":" + str(destinationPort) +
+                " len=" + str(len(networkbytes)) + " bytes " + str(msg), "DEBUG")
+        self.transport.sendto(networkbytes, (destinationIP, destinationPort))
+        self.count(self.sent, self.sendTypes, formatIpPort(destinationIP, destinationPort), msg['type'])
+
+    def datagramReceived(self, data, addr):
+        """ Called by NetBotDatagramProtocol for each datagram that arrives. """
+        ip, port = addr[0], addr[1]
+        try:
+            msg = umsgpack.unpackb(data, raw=False)
+        except Exception as e:
+            log("Received message that could not be unpacked from " + formatIpPort(ip, port) + ": " + str(e), "ERROR")
+            return
+        if logEnabled("DEBUG"):
+            log("Received msg from " + ip + ":" + str(port) + " len=" + str(len(data)) + " bytes " + str(msg), "DEBUG")
+        if not isValidMsg(msg):
+            return
+        self.count(self.recv, self.recvTypes, formatIpPort(ip, port), msg['type'])
+
+        # If we get a joinReply then use the server conf to tune our send delay in sendRecvMessage()
+        if msg['type'] == 'joinReply':
+            self.setDelay(msg['conf']['stepSec'] * 2)
+            self.setRtoMin(msg['conf']['stepSec'])
+
+        if 'msgID' in msg:
+            if msg['msgID'] in self.waiting:
+                future, waitIP, waitPort = self.waiting[msg['msgID']]
+                if ip == waitIP and port == waitPort:
+                    del self.waiting[msg['msgID']]
+                    if not future.done():
+                        future.set_result(msg)
+                    return
+            if msg['type'] == 'Error' or msg['type'].endswith('Reply'):
+                # Reply to a request that already has its reply (a resend answered twice) or
+                # that gave up. Nothing will ever read it, so do not keep it.
+                if logEnabled("DEBUG"):
+                    log("Dropped reply to request that is not waiting: " + str(msg), "DEBUG")
+                return
+        self.received.put_nowait((msg, ip, port))
+
+    async def recvMessage(self):
+        """
+        Wait for a message that is not a reply to a sendRecvMessage() request and return
+        msg, ip, port.
+        """
+        return await self.received.get()
+
+    async def sendRecvMessage(self, msg, destinationIP=None, destinationPort=None,
+                              retries=10, delay=None, delayMultiplier=1.2):
+        """
+        Same as NetBotSocket.sendRecvMessage() but waits for the reply without blocking
+        other tasks, so many requests can be waiting for replies at once. msg is not
+        changed; the msgID is added to a copy.
+
+        Raises NetBotSocketException if there is no reply after retries sends, if the reply
+        is an Error message, or if msg does not have a valid format.
+        """
+        startTime = time.perf_counter()
+        self.sendRecvMessageCalls += 1
+
+        if destinationIP is None:
+            destinationIP = self.destinationIP
+
+        if destinationPort is None:
+            destinationPort = self.destinationPort
+
+        rtt = self.getRttEstimator(formatIpPort(destinationIP, destinationPort))
+        if delay:
+            nextDelay = delay
+        elif rtt.rto is not None:
+            nextDelay = rtt.rto
+        else:
+            nextDelay = self.sendrecvDelay
+
+        # find a msgID that is not already waiting for a reply.
+        self.msgID = (self.msgID + 1) % 65001
+        while self.msgID in self.waiting:
+            self.msgID = (self.msgID + 1) % 65001
+        msgID = self.msgID
+        msg = dict(msg)
+        msg['msgID'] = msgID
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[msgID] = (future, destinationIP, destinationPort)
+        try:
+            for attempt in range(retries):
+                self.sendMessage(msg, destinationIP, destinationPort)
+                if attempt:
+                    self.sendRecvMessageResends += 1
+                sentAt = time.perf_counter()
+                try:
+                    replyMsg = await asyncio.wait_for(asyncio.shield(future), nextDelay)
+                    replyAt = time.perf_counter()
+                    break
+                except asyncio.TimeoutError:
+                    nextDelay = nextDelay * delayMultiplier
+            else:
+                rtt.backoff()
+                log("Raising Exception NetBotSocketException because failed to get valid respose after " + str(retries) +
+                    " retries with delay = " + str(delay) + " and delayMultiplier = " + str(delayMultiplier), "VERBOSE")
+                raise NetBotSocketException("Failed to get valid respose.")
+        finally:
+            entry = self.waiting.get(msgID)
+            if entry and entry[0] is future:
+                del self.waiting[msgID]
+
+        # Karn's rule: only sample the round trip time of requests that were sent once.
+        if attempt == 0:
+            rtt.sample(replyAt - sentAt)
+
+        if replyMsg['type'] == "Error":
+            log("Raising Exception NetBotSocketException because reply message, with correct msgID was of type Error.",
+                "VERBOSE")
+            raise NetBotSocketException("Received Error Message: " + replyMsg['result'])
+
+        del replyMsg['msgID']
+
+        self.sendRecvMessageTime += time.perf_counter() - startTime
+        return replyMsg
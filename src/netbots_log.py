@@ -1,13 +1,158 @@
-
-import inspect
 import os
-from datetime import datetime
+import sys
+import time
+import queue
+import atexit
+import threading
+
+"""
+**About Logging**
+
+log() is called often, including from the server's message loop, so it is kept cheap:
+
+- DEBUG and VERBOSE messages are thrown away before anything is formatted. msg may be a
+  function that returns the message, so building a costly message (e.g. str() of a
+  network message) only happens if it will be logged. Use logEnabled() to skip more work.
+- The module.function() of the caller is looked up once per calling function and cached.
+- The date and time to the second is formatted once per second.
+- A log file (see setLogFile()) is kept open and buffered rather than opened for every
+  line. It can be rotated when it gets too big and written by a background thread.
+"""
 
 # global printing of debug and info log level messages on/off
 logDebug = False
 logVerbose = False
 logFile = False
 
+callers = {}  # {code object: "module.function()", ...} Names of functions that have called log().
+logWriter = None  # LogWriter of logFile.
+
+# The date and time to the second of the last log line, and that time formatted.
+lastSecond = None
+lastSecondText = ""
+
+
+class LogWriter:
+    """
+    Appends lines to a file that is kept open, with buffering. The buffer is flushed by the
+    first line written flushSecs or more after the last flush (with background, at least
+    every flushSecs), so the file can still be watched while running.
+    If maxBytes is not 0 then once the file is about maxBytes long it is renamed to
+    filename.1 (filename.1 to filename.2 and so on, keeping backups old files) and a new file
+    started. If background is True then lines are written by a thread so log() does not
+    wait for the disk.
+    """
+
+    flushSecs = 1.0
+
+    def __init__(self, filename, maxBytes=0, backups=3, background=False):
+        self.filename = filename
+        self.maxBytes = maxBytes
+        self.backups = backups
+        self.f = open(filename, "a", buffering=65536)
+        self.size = self.f.tell()
+        self.lastFlush = time.monotonic()
+        self.q = None
+        self.thread = None
+        if background:
+            self.startThread()
+
+    def startThread(self):
+        self.q = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name="LogWriter", daemon=True)
+        self.thread.start()
+
+    def write(self, line, flush=False):
+        """ Write line (which must end with a newline). If flush then also flush it to the file. """
+        if self.q:
+            self.q.put((line, flush))
+        else:
+            self.writeNow(line, flush)
+
+    def writeNow(self, line, flush):
+        if self.maxBytes and self.size + len(line) > self.maxBytes and self.size > 0:
+            self.rotate()
+        self.f.write(line)
+        self.size += len(line)
+        if flush or time.monotonic() - self.lastFlush > self.flushSecs:
+            self.flushNow()
+
+    def flushNow(self):
+        self.f.flush()
+        self.lastFlush = time.monotonic()
+
+    def rotate(self):
+        self.f.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(self.filename + "." + str(i)):
+                os.replace(self.filename + "." + str(i), self.filename + "." + str(i + 1))
+        if self.backups > 0:
+            os.replace(self.filename, self.filename + ".1")
+        else:
+            os.remove(self.filename)
+        self.f = open(self.filename, "a", buffering=65536)
+        self.size = 0
+
+    def run(self):
+        while True:
+            try:
+                item = self.q.get(timeout=self.flushSecs)
+            except queue.Empty:
+                self.flushNow()
+                continue
+            if item is None:
+                self.flushNow()
+                return
+            if isinstance(item, threading.Event):
+                # flush() is waiting for everything before this to be written.
+                self.flushNow()
+                item.set()
+                continue
+            self.writeNow(item[0], item[1])
+
+    def flush(self):
+        """ Write all lines given to write() so far to the file. """
+        if self.thread:
+            done = threading.Event()
+            self.q.put(done)
+            done.wait()
+        elif self.f:
+            self.flushNow()
+
+    def close(self):
+        if self.thread:
+            self.q.put(None)
+            self.thread.join()
+            self.thread = None
+            self.q = None
+        if self.f:
+            self.f.close()
+            self.f = None
+
+    def afterFork(self):
+        # Only the thread that called fork() runs in the child, so write directly from now on.
+        self.thread = None
+        self.q = None
+
+
+def flushLog():
+    """ Write all log lines so far to the log file. """
+    if logWriter:
+        logWriter.flush()
+
+
+def closeLog():
+    global logWriter
+    if logWriter:
+        logWriter.close()
+        logWriter = None
+
+
+atexit.register(closeLog)
+if hasattr(os, 'register_at_fork'):
+    # Lines still in the buffer would be written by both processes, so flush before forking.
+    os.register_at_fork(before=flushLog, after_in_child=lambda: logWriter and logWriter.afterFork())
+
 
 def setLogLevel(debug=False, verbose=False):
     """
@@ -23,21 +168,52 @@ def setLogLevel(debug=False, verbose=False):
     logVerbose = verbose
     log("DEBUG logging = " + str(logDebug) + ". VERBOSE logging = " + str(logVerbose), "INFO")
 
-def setLogFile(filename=False):
+def setLogFile(filename=False, maxBytes=0, backups=3, background=False):
     """
-    Turn writing to file on or off. Off by default.
+    Turn writing to file on or off. Off by default. If maxBytes is not 0 then the file is
+    rotated once it is about maxBytes long, keeping backups old files. If background is
+    True then the file is written by a background thread. See LogWriter.
     """
 
-    global logFile
+    global logFile, logWriter
 
+    closeLog()
     logFile = filename
+    if logFile:
+        logWriter = LogWriter(logFile, maxBytes, backups, background)
     log("logFile set to " + str(logFile), "INFO")
 
 
+def logEnabled(level):
+    """ Returns True if log() will output messages of level. """
+    if level == "DEBUG":
+        return logDebug
+    if level == "VERBOSE":
+        return logVerbose
+    return True
+
+
+def callerName(frame):
+    """ Return "module.function()" of the function running in frame. """
+    code = frame.f_code
+    try:
+        return callers[code]
+    except KeyError:
+        function = code.co_name
+        if function != '<module>':
+            function = function + '()'
+        name = str(frame.f_globals.get('__name__', '-')) + '.' + function
+        callers[code] = name
+        return name
+
+
 def log(msg, level="INFO"):
     """
     Print msg to standard output in the format: LogLevel Time Function: msg
 
+    msg may also be a function that takes no arguments and returns the message. It is only
+    called if a message of level will be output.
+
     level should be one of DEBUG, VERBOSE, INFO, WARNING, ERROR, or FAILURE.
     Use log level as follows:
             DEBUG: Very detailed information, such as network messages.
@@ -49,7 +225,7 @@ def log(msg, level="INFO"):
 
     """
 
-    global logDebug, logVerbose, logFile
+    global lastSecond, lastSecondText
 
     if level == "DEBUG" and logDebug == False:
         return
@@ -57,27 +233,25 @@ def log(msg, level="INFO"):
     if level == "VERBOSE" and logVerbose == False:
         return
 
+    if callable(msg):
+        msg = msg()
+
     try:
-        # Get the execution frame of the calling function and use it to determine the calling filename and function name
-        # This will fail if called from a python interactive shell.
-        frame = inspect.stack()[1]
-        module = inspect.getmodule(frame[0])
-        filename = os.path.basename(module.__file__)
-        modulename = module.__name__
-        function = frame[0].f_code.co_name
-        if function != '<module>':
-            function = function + '()'
+        # Get the execution frame of the calling function and use it to determine the calling module and function name
+        caller = callerName(sys._getframe(1))
     except Exception as e:
-        modulename = '-'
-        filename = '-'
-        function = '-'
+        caller = '-.-'
 
-    time = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    now = time.time()
+    second = int(now)
+    if second != lastSecond:
+        lastSecond = second
+        lastSecondText = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+    timeText = lastSecondText + '.%03d' % (int((now - second) * 1000))
 
-    output = level + ' ' + str(time) + ' ' + str(modulename) + '.' + str(function) + ': ' + str(msg)
+    output = level + ' ' + timeText + ' ' + caller + ': ' + str(msg)
 
     print(output)
 
-    if logFile:
-        with open(logFile,"a+") as f: 
-            f.write(output + "\n")
+    if logWriter:
+        logWriter.write(output + "\n", level == "ERROR" or level == "FAILURE")
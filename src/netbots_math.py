@@ -109,10 +109,11 @@ def intersectLineCircle(x1, y1, x2, y2, cx, cy, cradius):
     # now we know that the line to infinity intersects the circle.
     # but we need to figure out if the line segment touches or not.
     # really only need to test x or y, if one is true so will the other be.
+    # (x is not enough if the line is vertical so test both.)
     ix = (D * dy + sgn(dy) * dx * math.sqrt(delta)) / dr**2
     iy = (-1 * D * dx + abs(dy) * math.sqrt(delta)) / dr**2
     if (x1 < ix and ix < x2) or (x1 > ix and ix > x2) or \
-       (y1 < ix and ix < y2) or (y1 > ix and ix > y2):
+       (y1 < iy and iy < y2) or (y1 > iy and iy > y2):
         return True
 
     return False
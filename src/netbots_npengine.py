@@ -0,0 +1,320 @@
+import math
+import time
+
+from netbots_log import log
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+**About the numpy step engine**
+
+The default step engine in netbots_server.py walks d.bots one bot at a time. This
+module is an optional engine that keeps a struct-of-arrays copy of bot state (x, y,
+speed, direction, requested values and class parameters) in numpy arrays and advances
+all bots at once. It is selected with the server -engine numpy switch.
+
+The arrays are kept from step to step and are the live copy of each bot's position,
+speed and direction. Nothing is copied from d.bots at the start of a step except the bots
+that code outside the engine has changed since the last step (message handlers,
+collisions and hit damage call SrvData.botChanged()). initGame() drops the arrays so they
+are built again for the new game. The rest of step(), message handlers, viewers and the
+scoreboard read bot dicts, so after moving the engine copies back to d.bots only the
+values that changed: speed of accelerating bots, direction of turning bots and position
+of moving bots.
+
+Shells are handled the same way. Each step all shells in d.shells are gathered into
+arrays, moved and tested against all obstacles at once, and written back. Explosion
+damage for all exploding shells comes from one shell to bot distance matrix. The damage
+is still applied one shell at a time, in d.shells order, so a bot killed by one shell
+is not damaged by (and does not give shellDamage credit to) a later shell, just like the
+python engine.
+
+Arenas with fewer than minBots bots are stepped by the python engine even if numpy is
+selected. Bots only join between games so an arena uses the same engine for a whole game.
+
+numpy is not required to run NetBots. If it is not installed then available() returns
+False and only the default python engine can be used.
+"""
+
+
+# With fewer bots than this the fixed cost of each numpy call is more than the python
+# engine spends moving every bot one at a time, so step() uses the python engine instead.
+minBots = 128
+
+
+def available():
+    """ Returns True if numpy is installed and this engine can be used. """
+    return np is not None
+
+
+def use(d):
+    """ Returns True if step() should use this engine for arena d. """
+    return d.state['engine'] == 'numpy' and len(d.bots) >= minBots
+
+
+class BotArrays:
+    """
+    Struct-of-arrays copy of the motion state of d.bots used by the numpy engine. See
+    the top of this module for how it is kept up to date.
+    """
+
+    def __init__(self, d):
+        self.botsDict = d.bots
+        self.keys = list(d.bots.keys())
+        self.bots = [d.bots[src] for src in self.keys]
+        self.index = {src: i for i, src in enumerate(self.keys)}
+        self.changed = set()  # srcs of bots changed outside of the engine since the last refresh().
+        n = len(self.keys)
+
+        # Motion state, kept between steps.
+        self.x = np.fromiter((b['x'] for b in self.bots), float, n)
+        self.y = np.fromiter((b['y'] for b in self.bots), float, n)
+        self.currentSpeed = np.fromiter((b['currentSpeed'] for b in self.bots), float, n)
+        self.requestedSpeed = np.fromiter((b['requestedSpeed'] for b in self.bots), float, n)
+        self.currentDirection = np.fromiter((b['currentDirection'] for b in self.bots), float, n)
+        self.requestedDirection = np.fromiter((b['requestedDirection'] for b in self.bots), float, n)
+
+        # Class parameters, these only change when a bot joins.
+        params = [d.getClassParams(b['class']) for b in self.bots]
+        self.botAccRate = np.array([p.botAccRate for p in params], dtype=float)
+        self.botMaxSpeed = np.array([p.botMaxSpeed for p in params], dtype=float)
+        self.botMinTurnRate = np.array([p.botMinTurnRate for p in params], dtype=float)
+        self.botMaxTurnRate = np.array([p.botMaxTurnRate for p in params], dtype=float)
+        # turnRate and distance moved for each unit of currentSpeed.
+        self.botTurnRangePerSpeed = (self.botMaxTurnRate - self.botMinTurnRate) / 100
+        self.botMaxSpeedPerSpeed = self.botMaxSpeed / 100
+        self.botArmor = np.array([p.botArmor for p in params], dtype=float)
+
+        log("Built numpy bot arrays for " + str(n) + " bots.", "VERBOSE")
+
+    def matches(self, d):
+        """ Returns True if these arrays were built for the bots in d.bots. Bots only join, so comparing counts is enough. """
+        return self.botsDict is d.bots and len(self.keys) == len(d.bots)
+
+    def refresh(self):
+        """ Copy the motion state of bots in self.changed from their dicts into the arrays. """
+        for src in self.changed:
+            i = self.index[src]
+            bot = self.bots[i]
+            self.x[i] = bot['x']
+            self.y[i] = bot['y']
+            self.currentSpeed[i] = bot['currentSpeed']
+            self.requestedSpeed[i] = bot['requestedSpeed']
+            self.currentDirection[i] = bot['currentDirection']
+            self.requestedDirection[i] = bot['requestedDirection']
+        self.changed.clear()
+
+    def health(self):
+        """ Return array of the health of each bot, read from d.bots. """
+        return np.fromiter((b['health'] for b in self.bots), float, len(self.bots))
+
+    def scatter(self, field, indexes):
+        """ Copy array field (e.g. 'currentSpeed') back into the bot dicts of bots at indexes (an int array). """
+        values = getattr(self, field)[indexes].tolist()
+        for i, value in zip(indexes.tolist(), values):
+            self.bots[i][field] = value
+
+    def scatterPositions(self, indexes):
+        """ Copy x and y back into the bot dicts of bots at indexes (an int array). """
+        bots = self.bots
+        for i, x, y in zip(indexes.tolist(), self.x[indexes].tolist(), self.y[indexes].tolist()):
+            bot = bots[i]
+            bot['x'] = x
+            bot['y'] = y
+
+
+def getBotArrays(d):
+    """ Return the BotArrays for d with all changes to bots copied in, building them if needed. """
+    if d.npBots is None or not d.npBots.matches(d):
+        d.npBots = BotArrays(d)
+    else:
+        d.npBots.refresh()
+    return d.npBots
+
+
+def moveBots(d, aliveBots):
+    """
+    numpy version of netbots_server.moveBots(). Change the speed and direction of all bots
+    that are alive and then move them, all at once.
+    """
+    a = getBotArrays(d)
+    alive = np.fromiter(map(aliveBots.__contains__, a.keys), bool, len(a.keys))
+    oldSpeed = a.currentSpeed
+    oldDirection = a.currentDirection
+
+    # change speed if needed. Stepping toward requestedSpeed by at most botAccRate is a clip.
+    # Bots that are not alive have no acceleration so they keep their speed.
+    accRate = a.botAccRate * alive
+    speed = np.minimum(np.maximum(a.requestedSpeed, oldSpeed - accRate), oldSpeed + accRate)
+
+    # change direction if needed. Like netbots_server.moveBots(), the turn is negative if
+    # requestedDirection is up to pi clockwise, or more than pi counter clockwise over 0
+    # radians, and positive otherwise. i.e. if requestedDirection - currentDirection is
+    # pi or more once normalized. Bots turn by turnRate and stop at requestedDirection.
+    # Bots that are not alive request the direction they have so they do not turn.
+    req = np.where(alive, a.requestedDirection, oldDirection)
+    diff = np.mod(req - oldDirection, math.pi * 2)
+    negative = diff >= math.pi
+    remaining = np.where(negative, math.pi * 2 - diff, diff)  # how far is left to turn.
+    # how much can we turn at the speed we are going? (turn instanly if bot is not moving)
+    turnRate = a.botMaxTurnRate - a.botTurnRangePerSpeed * speed
+    direction = np.where((turnRate >= remaining) | (speed == 0), req,
+                         np.mod(oldDirection + np.where(negative, -turnRate, turnRate), math.pi * 2))
+
+    # move bots
+    distance = speed * a.botMaxSpeedPerSpeed * alive
+    a.x = a.x + distance * np.cos(direction)
+    a.y = a.y + distance * np.sin(direction)
+    a.currentSpeed = speed
+    a.currentDirection = direction
+
+    # copy back only what changed.
+    a.scatter('currentSpeed', (speed != oldSpeed).nonzero()[0])
+    a.scatter('currentDirection', (direction != oldDirection).nonzero()[0])
+    a.scatterPositions(distance.nonzero()[0])
+
+
+def moveShells(d):
+    """
+    numpy version of netbots_server.moveShells(). Move all shells at once, remove shells
+    that hit an obstacle or left the arena, and explode shells that have reached their
+    destination.
+    """
+    if not d.shells:
+        return
+
+    keys = list(d.shells.keys())
+    shells = [d.shells[src] for src in keys]
+    n = len(keys)
+    params = [d.getClassParams(d.bots[src]['class']) for src in keys]
+    shellSpeed = np.fromiter((p.shellSpeed for p in params), float, n)
+    explRadius = np.fromiter((p.explRadius for p in params), float, n)
+    explDamage = np.fromiter((p.explDamage for p in params), float, n)
+
+    oldx = np.fromiter((s['x'] for s in shells), float, n)
+    oldy = np.fromiter((s['y'] for s in shells), float, n)
+    direction = np.fromiter((s['direction'] for s in shells), float, n)
+    remaining = np.fromiter((s['distanceRemaining'] for s in shells), float, n)
+
+    # move shells
+    distance = np.minimum(shellSpeed, remaining)
+    x = oldx + distance * np.cos(direction)
+    y = oldy + distance * np.sin(direction)
+    remaining = remaining - distance
+
+    # did shells hit an obstacle? Only test (shell, obstacle) pairs that the obstacle grid
+    # says may touch.
+    hitObstacle = np.zeros(n, dtype=bool)
+    grid = d.getObstacleGrid()
+    shellIndexes = []
+    obstacleIndexes = []
+    for i in range(n):
+        near = grid.indexesNearSegment(oldx[i], oldy[i], x[i], y[i])
+        shellIndexes += [i] * len(near)
+        obstacleIndexes += near
+    if obstacleIndexes:
+        s = np.array(shellIndexes)
+        o = [grid.circles[j] for j in obstacleIndexes]
+        ox = np.array([c['x'] for c in o], dtype=float)
+        oy = np.array([c['y'] for c in o], dtype=float)
+        orad = np.array([c['radius'] for c in o], dtype=float)
+        hits = intersectLineCircles(oldx[s], oldy[s], x[s], y[s], ox, oy, orad)
+        hitObstacle[s[hits]] = True
+
+    # shells that did not hit an obstacle and whose explosion would touch inside of arena
+    arenaSize = d.conf['arenaSize']
+    inArena = ~hitObstacle & (x > explRadius * -1) & (x < arenaSize + explRadius) & \
+        (y > explRadius * -1) & (y < arenaSize + explRadius)
+    explode = inArena & (remaining <= 0)
+
+    for i in np.flatnonzero(inArena & ~explode).tolist():
+        shell = shells[i]
+        shell['x'] = float(x[i])
+        shell['y'] = float(y[i])
+        shell['distanceRemaining'] = float(remaining[i])
+
+    exploding = np.flatnonzero(explode).tolist()
+    if exploding:
+        startTime = time.perf_counter()
+        explodeShells(d, [keys[i] for i in exploding], x[exploding], y[exploding],
+                      explRadius[exploding], explDamage[exploding])
+        d.timers['explosions'].lap(startTime)
+
+    # remove shells that hit an obstacle, left the arena or exploded.
+    for i in np.flatnonzero(~inArena | explode).tolist():
+        del d.shells[keys[i]]
+
+
+def explodeShells(d, srcs, x, y, explRadius, explDamage):
+    """
+    Apply damage to bots from shells of srcs exploding at (x, y) and store the explosions
+    for viewers. Shells are applied in the order of srcs.
+    """
+    a = getBotArrays(d)
+
+    # distance from every exploding shell (row) to every bot (column)
+    distance = np.sqrt((a.x[None, :] - x[:, None])**2 + (a.y[None, :] - y[:, None])**2)
+    inRange = distance < explRadius[:, None]
+    damage = explDamage[:, None] * (1 - distance / explRadius[:, None])
+
+    health = a.health()
+    damaged = np.zeros(len(a.keys), dtype=bool)
+    for e in range(len(srcs)):
+        src = srcs[e]
+        hit = inRange[e] & (health > 0)
+        if hit.any():
+            health = np.where(hit, np.maximum(0, health - damage[e] * a.botArmor), health)
+            damaged |= hit
+            # allow recording of inflicting damage that is greater than health of hit robot.
+            # also record damage to oneself. Add one bot at a time, in d.bots order, so the
+            # total is rounded exactly like the python engine.
+            shooter = d.bots[src]
+            for dmg in damage[e][hit].tolist():
+                shooter['shellDamage'] += dmg
+
+        # store the explosion so viewers can display it.
+        d.explosions.add(d.state['serverSteps'], float(x[e]), float(y[e]), src)
+
+    for i in np.flatnonzero(damaged).tolist():
+        # health is 0 (int), not 0.0, when a bot dies, same as max(0, health) in the python engine.
+        d.bots[a.keys[i]]['health'] = float(health[i]) if health[i] > 0 else 0
+
+
+def intersectLineCircles(x1, y1, x2, y2, cx, cy, cradius):
+    """
+    numpy version of netbots_math.intersectLineCircle(). Arguments are arrays that
+    broadcast together. Returns boolean array that is True where line segment
+    (x1,y1) to (x2,y2) intersects circle (cx,cy,cradius). The same tests as the python
+    version are used so results are identical.
+    """
+    # move points so circle is at origin (0,0)
+    x1 = x1 - cx
+    y1 = y1 - cy
+    x2 = x2 - cx
+    y2 = y2 - cy
+
+    # see if one of the points is inside the circle
+    d1 = np.sqrt(x1**2 + y1**2)
+    d2 = np.sqrt(x2**2 + y2**2)
+    inside = (d1 <= cradius) | (d2 <= cradius)
+
+    # Find out if infinite line intersect circle
+    dx = x2 - x1
+    dy = y2 - y1
+    dr = np.sqrt(dx**2 + dy**2)
+    D = x1 * y2 - x2 * y1
+    delta = (cradius * cradius) * dr**2 - D**2
+
+    # does line segment touch the circle? (sqrt of negative delta is not used.)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sqrtDelta = np.sqrt(delta)
+        ix = (D * dy + np.where(dy < 0, -1, 1) * dx * sqrtDelta) / dr**2
+        iy = (-1 * D * dx + np.abs(dy) * sqrtDelta) / dr**2
+    touches = (x1 < ix) & (ix < x2) | (x1 > ix) & (ix > x2) | \
+        (y1 < iy) & (iy < y2) | (y1 > iy) & (iy > y2)
+
+    return inside | ((delta >= 0) & touches)
+
@@ -0,0 +1,102 @@
+import struct
+
+from netbots_log import log
+import netbots_ipc as nbipc
+
+"""
+**About Recordings**
+
+A recording holds everything needed to play an arena again exactly, with no sockets and
+no robots. It is written by the server -record switch and played back with -replay.
+
+The file is a series of records. Each record is a 4 byte little endian length followed
+by that many bytes of msgpack (using the same msgpack module as netbots_ipc).
+
+The first record is a header dict:
+
+    {'version': 3, 'seed': seed, 'conf': d.conf, 'starts': d.starts.asDict(),
+     'engine': d.state['engine'], 'collisionMaxIterations': d.state['collisionMaxIterations'],
+     'idlePolicy': d.state['idlePolicy'], 'idleMinSteps': d.state['idleMinSteps']}
+
+All other records are events, in the order they happened, stored as short lists. step is
+d.state['serverSteps'] at the time of the event:
+
+    [TICK, step]                  a scheduled server step (netbots_server.stepArena())
+    [MSG, step, src, msg]         msg from src was accepted and passed to processMsg()
+    [DROP_MSG, step, src, msg]    msg from src was dropped by dropMessage()
+    [DROP_REPLY, step, src]       the reply to the last msg from src was dropped by dropMessage()
+"""
+
+recordingVersion = 3
+
+# Event types
+TICK = 0
+MSG = 1
+DROP_MSG = 2
+DROP_REPLY = 3
+
+
+class Recorder:
+    """ Writes a recording of one arena to a file. """
+
+    def __init__(self, filename, d, seed=None):
+        """ Open filename and write the header for arena d. """
+        self.filename = filename
+        self.f = open(filename, "wb")
+        self.events = 0
+        self.write({
+            'version': recordingVersion,
+            'seed': seed,
+            'conf': d.conf,
+            'starts': d.starts.asDict(),
+            'engine': d.state['engine'],
+            'collisionMaxIterations': d.state['collisionMaxIterations'],
+            'idlePolicy': d.state['idlePolicy'],
+            'idleMinSteps': d.state['idleMinSteps']
+            })
+        log("Recording to " + filename)
+
+    def write(self, record):
+        b = nbipc.umsgpack.packb(record, use_bin_type=True)
+        self.f.write(struct.pack("<I", len(b)))
+        self.f.write(b)
+
+    def tick(self, d):
+        self.events += 1
+        self.write([TICK, d.state['serverSteps']])
+
+    def msg(self, d, src, msg):
+        self.events += 1
+        self.write([MSG, d.state['serverSteps'], src, msg])
+
+    def dropMsg(self, d, src, msg):
+        self.events += 1
+        self.write([DROP_MSG, d.state['serverSteps'], src, msg])
+
+    def dropReply(self, d, src):
+        self.events += 1
+        self.write([DROP_REPLY, d.state['serverSteps'], src])
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+            log("Recorded " + str(self.events) + " events to " + self.filename)
+
+
+def readRecords(filename):
+    """
+    Generator that yields each record of a recording. The header is the first record.
+    A record cut short at the end of the file (e.g. server was killed) is ignored.
+    """
+    with open(filename, "rb") as f:
+        while True:
+            head = f.read(4)
+            if len(head) < 4:
+                break
+            size = struct.unpack("<I", head)[0]
+            b = f.read(size)
+            if len(b) < size:
+                log("Recording " + filename + " ends with an incomplete record.", "WARNING")
+                break
+            yield nbipc.umsgpack.unpackb(b, raw=False)
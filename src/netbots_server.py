@@ -4,14 +4,22 @@ import signal
 import time
 import random
 import math
-import itertools
 import json
+import selectors
+import copy
+import os
+import multiprocessing
+import queue
 
 from netbots_log import log
 from netbots_log import setLogLevel
 import netbots_ipc as nbipc
 import netbots_srvmsghl as nbmsghl
 import netbots_math as nbmath
+import netbots_npengine as nbnp
+import netbots_spatial as nbspatial
+import netbots_recorder as nbrec
+import netbots_timers as nbtimers
 
 ########################################################
 # Server Data
@@ -19,6 +27,11 @@ import netbots_math as nbmath
 
 
 class SrvData:
+    """
+    All data for one arena (one game server). The class level values below are the defaults
+    for new arenas. Each SrvData instance gets its own copy of them (see __init__), so one
+    server can run many arenas at once.
+    """
     srvSocket = None
 
     conf = {
@@ -32,6 +45,9 @@ class SrvData:
         'stepMax': 1000,  # After this many steps in a game all bots will be killed
         # Amount of time server targets for each step. Server will sleep if game is running faster than this.
         'stepSec': 0.05,
+        # If True, step as soon as every bot that is alive has ended its turn (see endTurnRequest). stepSec is then
+        # the longest the server will wait for a slow bot.
+        'lockstep': False,
         'startPermutations':  False,  # Use all permutations of each set of random start locations.
         'simpleCollisions': False,  # Use simple collision system, affected by -hitdamage
         'scanMaxDistance': 1415,  # Maximum distance a scan can detect a robot.
@@ -150,19 +166,50 @@ class SrvData:
         'msgTime': 0,  # Total time spent processing messages
         'viewerMsgTime': 0,  # Total time spend sending information to the viewer
         'startTime': time.time(),
-        'explIndex': 0,
         'sleepTime': 0,
         'sleepCount': 0,
         'longStepCount': 0,
+        'stepJitterTotal': 0,  # Total time steps started after they were scheduled to start.
+        'stepJitterMax': 0,  # Longest time a step started after it was scheduled to start.
         'tourStartTime': False,
+        'collisionIterations': 0,  # Total collision solver iterations.
+        'collisionIterationsMax': 0,  # Most collision solver iterations needed in one step.
+        'collisionPenetrationMax': 0,  # Deepest overlap of a bot with a wall, obstacle or bot.
+        'collisionLimitCount': 0,  # Number of steps where collisionMaxIterations was reached.
+        'idleStepCount': 0,  # Steps in a row that nothing has happened in the game in progress (see isIdle()).
+        'idleJumpCount': 0,  # Number of games jumped to stepMax by the 'jump' idle policy.
+        'idleStepsSkipped': 0,  # Steps not played because games were jumped to stepMax.
+        'idleFastSteps': 0,  # Steps played with no pacing by the 'fast' idle policy.
+        'lockstepEarlySteps': 0,  # Steps started before stepSec because every bot had ended its turn.
+        'adaptChanges': 0,  # Number of times adaptStepSec() changed stepSec.
+        'adaptStepSecLow': 0,  # Lowest stepSec used.
+        'adaptStepSecHigh': 0,  # Highest stepSec used.
 
         # Server only conf which we don't want to share with robots
         'onlyLastSb': False,  # Only print the scoreboard when the server quits, rather than after every game.
         'jsonScoreboard': False,  # Save json formatted server data to filename before quiting.
+        'engine': 'python',  # Step engine used to move bots: 'python' or 'numpy'.
+        'collisionMaxIterations': 50,  # Max collision solver iterations per step.
+        'idlePolicy': 'off',  # What to do when a game is idle: 'off', 'jump' to stepMax, or play 'fast' with no pacing.
+        'idleMinSteps': 50,  # Steps that nothing must happen before a game is idle.
+        'adaptStepSec': False,  # Adjust stepSec during play toward adaptMissRate (see adaptStepSec()).
+        'adaptMissRate': 0.05,  # Target fraction of steps that bots miss.
+        'adaptSteps': 100,  # Game steps between adjustments of stepSec.
+        'stepSecMin': 0.001,  # Lowest stepSec adaptStepSec() may use.
+        'stepSecMax': 0.1,  # Highest stepSec adaptStepSec() may use.
         }
 
-    starts = []  # [ [locIndex, locIndex, ...], [locIndex, locIndex, ...], ...]
-    startLocs = []  # [{'x': x, 'y' y},{'x': x, 'y' y},...]
+    botMsgCount = {}  # {src: count, ...} Number of messages received from each src this step.
+    endedTurns = set()  # Set of srcs of alive bots that have ended their turn this step (see conf['lockstep']).
+    aliveCount = 0  # Number of bots alive at the start of this step. Only counted if conf['lockstep'].
+
+    # Bot latency, the time from a reply to a bot until its next message arrives. Only measured if state['adaptStepSec'].
+    lastReplyAt = {}  # {src: time.perf_counter() the last reply was sent, ...}
+    botLatency = {}  # {src: [total secs, count], ...} since the last adaptStepSec().
+    adaptStepCount = 0  # Game steps since the last adaptStepSec().
+    adaptMissedSteps = 0  # Bot steps missed in the game steps since the last adaptStepSec().
+
+    starts = None  # StartSchedule of the start locations of every game. Made by mkStartLocations().
     startBots = []  # [src, src, ...]
 
     bots = {}
@@ -190,6 +237,9 @@ class SrvData:
             }
         }
 
+    # Struct-of-arrays copy of bot state used by the numpy step engine (see netbots_npengine.py).
+    npBots = None
+
     shells = {}
     shellTemplate = {
         'x': 500,
@@ -198,7 +248,9 @@ class SrvData:
         'distanceRemaining': 100
         }
 
-    explosions = {}
+    # ExplosionRing of recent explosions. explosionTemplate is the format of each explosion in
+    # its asDict() view, which is what viewers receive.
+    explosions = None
     explosionTemplate = {
         'x': 500,
         'y': 500,
@@ -213,6 +265,115 @@ class SrvData:
         'port': 20011
         }
 
+    # Spatial indexes of conf['obstacles'] and conf['jamZones'] (see getObstacleGrid() and getJamZoneGrid()).
+    obstacleGrid = None
+    jamZoneGrid = None
+
+    # Set of srcs of bots fully inside a jam zone. Found once per step by findJammedBots().
+    jammedBots = set()
+
+    # Scan caches, cleared each step by resetScans().
+    scanIndexes = {}  # {src: nbspatial.AngularIndex, ...} Bots that src can detect, sorted by bearing.
+    scanResults = {}  # {(src, startRadians, endRadians): distance, ...}
+
+    # Effective class values, {className: ClassParams, ...}. Built by compileClassParams().
+    classParams = {}
+
+    # Random number generator for layouts (obstacles, jam zones and start locations). Seeded by -seed.
+    rng = random.Random()
+
+    # netbots_recorder.Recorder that this arena's inputs are written to, or None (see -record).
+    recorder = None
+
+    # Timed parts of the step and message loop. The step phases are in the order step() runs them.
+    # collideWalls, collideObstacles and collideBots are the parts of collisions spent finding
+    # and pushing out each kind of contact, summed over all iterations of the step. explosions
+    # is the part of shells spent exploding shells and is only counted in steps with explosions.
+    timerNames = ('step', 'move', 'collisions', 'collideWalls', 'collideObstacles', 'collideBots',
+                  'hitDamage', 'shells', 'explosions', 'scoring', 'scans',
+                  'recvReplyMsgs', 'sendToViwers', 'stepJitter')
+    timers = {}  # {name: nbtimers.TimeHistogram, ...}
+
+    def __init__(self):
+        """ Copy the default conf, state and game data into this arena. """
+        self.conf = copy.deepcopy(SrvData.conf)
+        self.state = copy.deepcopy(SrvData.state)
+        self.state['startTime'] = time.time()
+        self.state['adaptStepSecLow'] = self.state['adaptStepSecHigh'] = self.conf['stepSec']
+        self.botMsgCount = {}
+        self.endedTurns = set()
+        self.aliveCount = 0
+        self.lastReplyAt = {}
+        self.botLatency = {}
+        self.adaptStepCount = 0
+        self.adaptMissedSteps = 0
+        self.starts = None
+        self.startBots = []
+        self.bots = {}
+        self.npBots = None
+        self.shells = {}
+        self.explosions = ExplosionRing(self.conf['keepExplosionSteps'])
+        self.viewers = {}
+        self.classParams = {}
+        self.obstacleGrid = None
+        self.jamZoneGrid = None
+        self.jammedBots = set()
+        self.scanIndexes = {}
+        self.scanResults = {}
+        self.rng = random.Random()
+        self.recorder = None
+        self.timers = {name: nbtimers.TimeHistogram() for name in SrvData.timerNames}
+
+        self.nextStepAt = 0  # time.perf_counter() when the next step of this arena is due.
+        self.done = False  # True once this arena has played all its games, given up waiting for bots or could not lay out a game.
+
+    def compileClassParams(self):
+        """
+        Resolve the effective values of all class fields for every class in SrvData.conf once
+        so the step loop can read them as plain attributes. Call this whenever conf is changed.
+        """
+        self.classParams = {}
+        for c in ['default'] + list(self.conf['classes'].keys()):
+            self.classParams[c] = mkClassParams(self.conf, c)
+        log("Compiled class parameters for classes: " + str(list(self.classParams.keys())), "VERBOSE")
+
+    def getClassParams(self, c="default"):
+        """
+        Return the ClassParams record for class c. The record is built the first time a
+        class is used if compileClassParams() has not been called.
+        """
+        try:
+            return self.classParams[c]
+        except KeyError:
+            params = mkClassParams(self.conf, c)
+            self.classParams[c] = params
+            return params
+
+    def botChanged(self, src):
+        """
+        Call after changing the position, speed or direction of bot src anywhere other than
+        in a step engine, so the numpy engine copies the change into its arrays.
+        """
+        if self.npBots is not None:
+            self.npBots.changed.add(src)
+
+    def getObstacleGrid(self):
+        """
+        Return the nbspatial.CircleGrid of conf['obstacles']. The grid is built the first time
+        it is needed and only rebuilt if conf['obstacles'] is replaced or changed in length.
+        """
+        if self.obstacleGrid is None or not self.obstacleGrid.matches(self.conf['obstacles']):
+            radius = max([o['radius'] for o in self.conf['obstacles']], default=self.conf['botRadius'])
+            self.obstacleGrid = nbspatial.CircleGrid(self.conf['obstacles'], radius * 2)
+        return self.obstacleGrid
+
+    def getJamZoneGrid(self):
+        """ Same as getObstacleGrid() but for conf['jamZones']. """
+        if self.jamZoneGrid is None or not self.jamZoneGrid.matches(self.conf['jamZones']):
+            radius = max([jz['radius'] for jz in self.conf['jamZones']], default=self.conf['botRadius'])
+            self.jamZoneGrid = nbspatial.CircleGrid(self.conf['jamZones'], radius * 2)
+        return self.jamZoneGrid
+
     def getClassValue(self, fld, c="default"):
         """
         Use this function to get values from SrvData.conf that respect robot class. 
@@ -222,19 +383,101 @@ class SrvData:
         if fld not in self.conf['classFields']:
             raise Exception("ERROR, " + str(fld) + " not allowed in robot class.")
 
-        value = self.conf[fld]  # default value
-        if 'classes' in self.conf and c in self.conf['classes'] and fld in self.conf['classes'][c]:
+        try:
+            params = self.classParams[c]
+        except (AttributeError, KeyError):
+            # Viewers call this with their own data object that only has conf.
+            params = mkClassParams(self.conf, c)
+
+        return getattr(params, fld)
+
+
+class ClassParams:
+    """ Effective values of SrvData.conf['classFields'] for one robot class. """
+    __slots__ = SrvData.conf['classFields']
+
+
+def mkClassParams(conf, c="default"):
+    """ Return ClassParams with the effective value of each class field in conf for class c. """
+    params = ClassParams()
+    for fld in conf['classFields']:
+        value = conf[fld]  # default value
+        if 'classes' in conf and c in conf['classes'] and fld in conf['classes'][c]:
             if isinstance(value, (int, float)):
-                value *= self.conf['classes'][c][fld]  # class specific multiplier
+                value *= conf['classes'][c][fld]  # class specific multiplier
             else:
-                value = self.conf['classes'][c][fld]  # class specific value
-        
-        return value
+                value = conf['classes'][c][fld]  # class specific value
+        setattr(params, fld, value)
+    return params
+
+
+class ExplosionRing:
+    """
+    Explosions of the last keepSteps steps. They are only kept so viewers can animate them.
+
+    There is one slot for each of the last keepSteps steps, used in turn (slot is step %
+    keepSteps), so explosions age by the step count moving on and expire when their slot is
+    reused. Nothing is done to age explosions each step. Each explosion is a tuple of
+    (index, x, y, src) where index is a number that wraps at 65000 so viewers can tell
+    explosions apart.
+    """
+
+    def __init__(self, keepSteps):
+        self.keepSteps = keepSteps
+        self.slots = [[] for i in range(keepSteps)]
+        self.slotSteps = [None] * keepSteps  # Step that the explosions in each slot happened in.
+        self.nextIndex = 0
+
+    def add(self, step, x, y, src):
+        """ Add explosion at (x, y) of shell fired by src that happened in step. """
+        if self.keepSteps == 0:
+            return
+        i = step % self.keepSteps
+        if self.slotSteps[i] != step:
+            self.slots[i].clear()
+            self.slotSteps[i] = step
+        self.slots[i].append((self.nextIndex, x, y, src))
+        self.nextIndex += 1
+        if self.nextIndex > 65000:
+            self.nextIndex = 0
+
+    def clear(self):
+        for i in range(self.keepSteps):
+            self.slots[i].clear()
+            self.slotSteps[i] = None
+
+    def live(self, step):
+        """ Return list of (stepsAgo, (index, x, y, src)) of explosions not expired at end of step. """
+        found = []
+        for i in range(self.keepSteps):
+            if self.slotSteps[i] is not None and step - self.slotSteps[i] < self.keepSteps:
+                stepsAgo = step - self.slotSteps[i] + 1
+                for expl in self.slots[i]:
+                    found.append((stepsAgo, expl))
+        return found
+
+    def __len__(self):
+        """ Number of explosions stored, including any that have expired but not been overwritten. """
+        return sum(len(slot) for slot in self.slots)
+
+    def asDict(self, step):
+        """
+        Return explosions not expired at end of step as a dict in the format viewers expect:
+        {index: {'x': x, 'y': y, 'stepsAgo': stepsAgo, 'src': src}, ...}. stepsAgo is 1 for
+        explosions that happened in step.
+        """
+        return {index: {'x': x, 'y': y, 'stepsAgo': stepsAgo, 'src': src}
+                for stepsAgo, (index, x, y, src) in self.live(step)}
+
 
 ########################################################
 # Bot Message Processing
 ########################################################
 
+# Message types that do not change the game. Any other message from a bot may change the game.
+queryMsgs = ('getInfoRequest', 'getLocationRequest', 'getSpeedRequest', 'getDirectionRequest',
+             'getCanonRequest', 'scanRequest', 'endTurnRequest')
+
 
 def processMsg(d, msg, src):
     if msg['type'] == 'joinRequest':
@@ -244,6 +487,10 @@ def processMsg(d, msg, src):
     elif msg['type'] == 'viewKeepAlive':
         reply = nbmsghl.viewKeepAlive(d, msg, src)
     elif src in d.bots:  # all other messages are only allowed from bots that have joined the game
+        # a bot that may have changed the game ends any idle period.
+        if msg['type'] not in queryMsgs:
+            d.state['idleStepCount'] = 0
+
         # if this is a message type suppored by server
         if hasattr(nbmsghl, msg['type']):
             reply = getattr(nbmsghl, msg['type'])(d, msg, src)
@@ -275,7 +522,9 @@ def dropMessage(d):
 
 
 def recvReplyMsgs(d):
-    # process all messages in socket recv buffer
+    """
+    Process all messages in socket recv buffer. This may be called many times per step.
+    """
     startTime = time.perf_counter()
     msgQ = []
     more = True
@@ -288,11 +537,35 @@ def recvReplyMsgs(d):
             log(str(type(e)) + " " + str(e), "ERROR")
             more = False
 
-    botMsgCount = {}
+    replyMsgs(d, msgQ)
+
+    d.state['msgTime'] += d.timers['recvReplyMsgs'].lap(startTime) - startTime
+
+
+def replyMsgs(d, msgQ):
+    """
+    Process msgQ, a list of (msg, ip, port), and send replies.
+
+    Up to botMsgsPerStep messages from each src are processed each step. Any others
+    are dropped.
+    """
+    botMsgCount = d.botMsgCount
+    measureLatency = d.state['adaptStepSec']
+    if measureLatency:
+        now = time.perf_counter()
     for msg, ip, port in msgQ:
 
         src = nbipc.formatIpPort(ip, port)
 
+        # Only msgs that answer a reply are timed, so a dropped msg or reply (and the resend) is never counted.
+        if measureLatency and src in d.lastReplyAt:
+            latency = now - d.lastReplyAt.pop(src)
+            if src in d.botLatency:
+                d.botLatency[src][0] += latency
+                d.botLatency[src][1] += 1
+            else:
+                d.botLatency[src] = [latency, 1]
+
         # Track src counter and drop msg if we have already proccessed the max msgs for this src this step
         if src in botMsgCount:
             botMsgCount[src] += 1
@@ -300,24 +573,100 @@ def recvReplyMsgs(d):
             botMsgCount[src] = 1
         if botMsgCount[src] > d.conf['botMsgsPerStep']:
             continue
+        if botMsgCount[src] == d.conf['botMsgsPerStep'] and src in d.bots and d.bots[src]['health'] != 0:
+            # a bot that has used all its messages has ended its turn.
+            d.endedTurns.add(src)
         
         if dropMessage(d):
+            if d.recorder:
+                d.recorder.dropMsg(d, src, msg)
             continue
 
+        if d.recorder:
+            d.recorder.msg(d, src, msg)
         reply = processMsg(d, msg, src)
         if reply:
             if dropMessage(d):
+                if d.recorder:
+                    d.recorder.dropReply(d, src)
                 continue
             try:
-                d.srvSocket.sendMessage(reply, ip, port)
+                # replies are built by the server and go back to where the request came from.
+                d.srvSocket.sendMessage(reply, ip, port, checked=True)
+                if measureLatency:
+                    d.lastReplyAt[src] = now
             except Exception as e:
                 log(str(e), "ERROR")
 
+
+def startStepMsgs(d):
+    """
+    Call this once at the start of each step. Count a missed step for each bot that sent
+    no messages last step and reset the per step message counts. Returns the number of
+    bots that missed last step.
+    """
+    missed = 0
     for src in d.bots:
-        if src not in botMsgCount:
+        if src not in d.botMsgCount:
             d.bots[src]['missedSteps'] += 1
+            missed += 1
+    d.botMsgCount = {}
+    d.endedTurns = set()
+    if d.conf['lockstep']:
+        d.aliveCount = sum(1 for bot in d.bots.values() if bot['health'] != 0)
+    return missed
+
+
+def stepIfTurnsEnded(d):
+    """
+    If conf['lockstep'] and every bot that is alive has ended its turn this step, by sending
+    endTurnRequest or using all its botMsgsPerStep messages, then schedule the next step of
+    d for now rather than waiting for stepSec.
+    """
+    if d.conf['lockstep'] and d.aliveCount and len(d.endedTurns) >= d.aliveCount:
+        now = time.perf_counter()
+        if d.nextStepAt > now:
+            d.nextStepAt = now
+            d.state['lockstepEarlySteps'] += 1
+
 
-    d.state['msgTime'] += time.perf_counter() - startTime
+def adaptStepSec(d, missed):
+    """
+    Call once per game step if state['adaptStepSec'] with missed, the number of bots that
+    missed that step (see startStepMsgs()). Steps between games and while waiting for bots
+    to join are not game steps and so are not counted. Every adaptSteps game steps, compare
+    the fraction of steps bots missed (sent no messages) with adaptMissRate. If more were missed
+    then stepSec is made longer, and if less than half as many then it is made shorter, but
+    never shorter than the mean latency of the slowest bot since bots need at least one
+    reply per step. stepSec is kept between stepSecMin and stepSecMax.
+    """
+    d.adaptStepCount += 1
+    d.adaptMissedSteps += missed
+    if d.adaptStepCount < d.state['adaptSteps']:
+        return
+
+    missRate = d.adaptMissedSteps / max(1, d.adaptStepCount * len(d.bots))
+    slowest = max([total / count for total, count in d.botLatency.values()], default=0)
+    d.adaptStepCount = 0
+    d.adaptMissedSteps = 0
+    d.botLatency = {}
+
+    old = d.conf['stepSec']
+    new = old
+    if missRate > d.state['adaptMissRate']:
+        new = old * 1.25  # back off quickly so bots stop missing steps.
+    elif missRate < d.state['adaptMissRate'] / 2:
+        new = max(old * 0.9, slowest)  # speed up slowly.
+    new = min(max(new, d.state['stepSecMin']), d.state['stepSecMax'])
+
+    if new != old:
+        d.conf['stepSec'] = new
+        d.state['adaptChanges'] += 1
+        d.state['adaptStepSecLow'] = min(d.state['adaptStepSecLow'], new)
+        d.state['adaptStepSecHigh'] = max(d.state['adaptStepSecHigh'], new)
+        log(d.conf['serverName'] + " stepSec changed from " + '%.6f' % (old) + " to " + '%.6f' % (new) +
+            " (missed steps " + '%.2f' % (missRate * 100) + "%, slowest bot latency " +
+            '%.6f' % (slowest) + " secs).")
 
 
 def sendToViwers(d):
@@ -332,7 +681,7 @@ def sendToViwers(d):
                 'state': d.state,
                 'bots': d.bots,
                 'shells': d.shells,
-                'explosions': d.explosions
+                'explosions': d.explosions.asDict(d.state['serverSteps'])
         })
     for src in list(d.viewers.keys()):  # we need a list of keys so we can del from the viewers dict below
         v = d.viewers[src]
@@ -346,7 +695,7 @@ def sendToViwers(d):
             except Exception as e:
                 log(str(e), "ERROR")
                 
-    d.state['viewerMsgTime'] += time.perf_counter() - startTime
+    d.state['viewerMsgTime'] += d.timers['sendToViwers'].lap(startTime) - startTime
 
 ########################################################
 # Game Logic
@@ -362,12 +711,12 @@ def getHitSeverity(d, b1, a, b2 = None):
     'b2' is the other bot that collied if this is a bot on bot collision.
     '''
 
-    hitSeverity = b1['currentSpeed'] / 100.0 * d.getClassValue('botMaxSpeed', b1['class']) / \
+    hitSeverity = b1['currentSpeed'] / 100.0 * d.getClassParams(b1['class']).botMaxSpeed / \
                           d.conf['botMaxSpeed'] * math.cos(b1['currentDirection'] - a)
     if b2:
         # This may reduce hitSeverity if b2 is moving away from b1 or
         # increase hitSeverity if b2 moving towards b1.
-        hitSeverity += b2['currentSpeed'] / 100.0 * d.getClassValue('botMaxSpeed', b2['class']) / \
+        hitSeverity += b2['currentSpeed'] / 100.0 * d.getClassParams(b2['class']).botMaxSpeed / \
                           d.conf['botMaxSpeed'] * math.cos(b2['currentDirection'] - a + math.pi)
     if hitSeverity < 0:
         hitSeverity = 0
@@ -381,21 +730,33 @@ def findOverlapingBots(d, bots):
     bots can also contain health: {key:{'x': x,'y': y, 'health': h}, ...}
     Return any pair (key,key) of bots that overlap, else return False
     """
+    pairs = findAllOverlapingBots(d, bots)
+    if pairs:
+        return pairs[0]
+    return False
+
+
+def findAllOverlapingBots(d, bots):
+    """
+    bots is a dict/list of bot locations: {key:{'x': x,'y': y}, ...}
+    bots can also contain health: {key:{'x': x,'y': y, 'health': h}, ...}
+    Return list of all pairs [key,key] of bots that overlap. List is empty if no bots overlap.
+
+    Uses a spatial hash with cells one bot diameter wide so only bots in the same or
+    neighbouring cells are compared.
+    """
     try:
         keys = list(bots.keys())
     except AttributeError:
         keys = range(len(bots))
 
-    for i in range(0, len(keys) - 1):
-        boti = bots[keys[i]]
-        if 'health' not in boti or boti['health'] != 0:
-            for j in range(i + 1, len(keys)):
-                botj = bots[keys[j]]
-                if 'health' not in botj or botj['health'] != 0:
-                    if nbmath.distance(boti['x'], boti['y'], botj['x'], botj['y']) <= d.conf['botRadius'] * 2:
-                        return [keys[i], keys[j]]
+    points = []
+    for k in keys:
+        bot = bots[k]
+        if 'health' not in bot or bot['health'] != 0:
+            points.append((k, bot['x'], bot['y']))
 
-    return False
+    return nbspatial.closePairs(points, d.conf['botRadius'] * 2)
 
 
 def findOverlapingBotsAndObstacles(d, bots):
@@ -410,10 +771,11 @@ def findOverlapingBotsAndObstacles(d, bots):
     except AttributeError:
         keys = range(len(bots))
 
+    grid = d.getObstacleGrid()
     for k in keys:
         bot = bots[k]
         if 'health' not in bot or bot['health'] != 0:
-            for obstacle in d.conf['obstacles']:
+            for obstacle in grid.near(bot['x'], bot['y'], d.conf['botRadius']):
                 if nbmath.distance(bot['x'], bot['y'], obstacle['x'], obstacle['y']) <= \
                         d.conf['botRadius'] + obstacle['radius']:
                     return [k, obstacle]
@@ -421,12 +783,62 @@ def findOverlapingBotsAndObstacles(d, bots):
     return False
 
 
+def findAllOverlapingBotsAndObstacles(d, bots):
+    """
+    bots is a dict/list of bot locations: {key:{'x': x,'y': y}, ...}
+    bots can also contain health: {key:{'x': x,'y': y, 'health': h}, ...}
+    Return list of all pairs [key,obstacle] of bots and obstacles that overlap. List is empty if none overlap.
+    """
+
+    try:
+        keys = list(bots.keys())
+    except AttributeError:
+        keys = range(len(bots))
+
+    grid = d.getObstacleGrid()
+    pairs = []
+    for k in keys:
+        bot = bots[k]
+        if 'health' not in bot or bot['health'] != 0:
+            for obstacle in grid.near(bot['x'], bot['y'], d.conf['botRadius']):
+                if nbmath.distance(bot['x'], bot['y'], obstacle['x'], obstacle['y']) <= \
+                        d.conf['botRadius'] + obstacle['radius']:
+                    pairs.append([k, obstacle])
+
+    return pairs
+
+
+def findJammedBots(d):
+    """
+    Return set of srcs of all bots that are fully inside a jam zone. Scans do not detect these bots.
+    """
+    grid = d.getJamZoneGrid()
+    jammed = set()
+    for src, bot in d.bots.items():
+        for jz in grid.near(bot['x'], bot['y'], 0):
+            if nbmath.distance(bot['x'], bot['y'], jz['x'], jz['y']) + d.conf['botRadius'] < jz['radius']:
+                jammed.add(src)
+                break
+    return jammed
+
+
+def resetScans(d):
+    """
+    Call after bots move (once per step). Find which bots are jammed and clear scan indexes
+    and results cached during the last step.
+    """
+    d.jammedBots = findJammedBots(d)
+    d.scanIndexes = {}
+    d.scanResults = {}
+
+
 def mkObstacles(d, n):
     '''
     Randomly lay out obstacles with so they are at least 2 and a bit bot diameters away from any wall or other obstacle.
     '''
     obstacles = []
     rad = d.conf['arenaSize'] * d.conf['obstacleRadius'] / 100.0
+    grid = nbspatial.CircleGrid(obstacles, rad * 2)
 
     for i in range(n):
         overlaps = True
@@ -434,18 +846,18 @@ def mkObstacles(d, n):
         while overlaps:
             attempts += 1
             new = {
-                'x': random.random() * (d.conf['arenaSize'] - rad * 8.1) + rad * 4.1,
-                'y': random.random() * (d.conf['arenaSize'] - rad * 8.1) + rad * 4.1,
+                'x': d.rng.random() * (d.conf['arenaSize'] - rad * 8.1) + rad * 4.1,
+                'y': d.rng.random() * (d.conf['arenaSize'] - rad * 8.1) + rad * 4.1,
                 'radius': rad
                 }
             overlaps = False
-            for o in obstacles:
+            for o in grid.near(new['x'], new['y'], new['radius'] + d.conf['botRadius'] * 4.1):
                 if nbmath.distance(o['x'], o['y'], new['x'], new['y']) < o['radius'] + \
                         new['radius'] + d.conf['botRadius'] * 4.1:
                     overlaps = True
                     break
             if overlaps == False:
-                obstacles.append(new)
+                grid.add(new)
             else:
                 log("Obstacle overlapped during random layout. Trying again.", "VERBOSE")
                 if attempts > 999:
@@ -464,48 +876,150 @@ def mkJamZones(d, n):
 
     for i in range(n):
         jamZones.append({
-            'x': random.random() * d.conf['arenaSize'],
-            'y': random.random() * d.conf['arenaSize'],
+            'x': d.rng.random() * d.conf['arenaSize'],
+            'y': d.rng.random() * d.conf['arenaSize'],
             'radius': rad
             })
 
     return jamZones
 
 
-def mkStartLocations(d):
-    while len(d.starts) < d.conf['gamesToPlay']:
-        botsOverlap = True  # loop must run at least once.
-        botsObsOverlap = True
-        attempts = 0
-        while botsOverlap or botsObsOverlap:
-            startLocs = []
-            for i in range(d.conf['botsInGame']):
-                loc = {}
-                loc['x'] = random.random() * (d.conf['arenaSize'] * 0.8) + (d.conf['arenaSize'] * 0.1)
-                loc['y'] = random.random() * (d.conf['arenaSize'] * 0.8) + (d.conf['arenaSize'] * 0.1)
-                startLocs.append(loc)
-
-            botsOverlap = findOverlapingBots(d, startLocs)
-            botsObsOverlap = findOverlapingBotsAndObstacles(d, startLocs)
-            if botsOverlap:
-                log("Bots overlapped during random layout, trying again.", "VERBOSE")
-            elif botsObsOverlap:
-                log("Bots overlapped obstacles during random layout, trying again.", "VERBOSE")
+class StartLayoutError(Exception):
+    """Raised by mkStartLayout() when the bots do not all fit in the arena."""
+    pass
+
+
+def mkStartLayout(d, rng):
+    """
+    Return list of d.conf['botsInGame'] random start locations, [{'x': x, 'y': y}, ...], that
+    do not overlap each other or any obstacle. rng is a random.Random. Raises StartLayoutError
+    if the bots do not fit.
+
+    Bots are placed one at a time by random darts tested against a grid of the bots placed
+    so far. If the arena is too crowded for that then a Poisson disk sampling of the whole
+    start area is made, more densely packed each try, and bots are placed at a random
+    sample of its points.
+    """
+    n = d.conf['botsInGame']
+    botRadius = d.conf['botRadius']
+    lo = d.conf['arenaSize'] * 0.1
+    hi = d.conf['arenaSize'] * 0.9
+    obstacleGrid = d.getObstacleGrid()
+
+    def isFree(x, y):
+        for o in obstacleGrid.near(x, y, botRadius):
+            if nbmath.distance(x, y, o['x'], o['y']) <= botRadius + o['radius']:
+                return False
+        return True
+
+    points = nbspatial.dartThrow(n, lo, lo, hi, hi, botRadius * 2, rng, isFree)
+    if len(points) < n:
+        log("Bots could not be placed by random darts, using Poisson disk layout.", "VERBOSE")
+        for ring in (1.0, 0.25, 0.05):
+            points = nbspatial.poissonDisk(lo, lo, hi, hi, botRadius * 2, rng, isFree, ring=ring)
+            if len(points) >= n:
+                break
+        if len(points) < n:
+            raise StartLayoutError("Could not layout bots without overlapping. Only " + str(len(points)) +
+                                   " of " + str(n) + " bots fit.")
+        points = rng.sample(points, n)
+
+    return [{'x': x, 'y': y} for x, y in points]
+
+
+def nthPermutation(n, k):
+    """
+    Return permutation k (0 to n!-1) of range(n), in the same order as
+    itertools.permutations(range(n)), by decoding k as a Lehmer code.
+    """
+    items = list(range(n))
+    perm = []
+    for i in range(n, 0, -1):
+        j, k = divmod(k, math.factorial(i - 1))
+        perm.append(items.pop(j))
+    return perm
+
+
+class StartSchedule:
+    """
+    The start locations of each game, made when they are needed rather than all at server
+    start up, so start up time and memory do not grow with -games or -bots.
+
+    Games are played on layouts of random start locations (see mkStartLayout()). Without
+    -startperms each layout is used for one game. With -startperms each layout is used for
+    up to n! games, one for each way of assigning its locations to the n bots, in random
+    order. Only the current layout is kept. The order of permutations is the affine map
+    k -> (a * k + b) % n! with random a (coprime to n!) and b, and each permutation is decoded
+    from its index, so no list of starts or permutations is ever made.
+
+    Every layout and permutation order comes from its own random.Random(seed + layout), so
+    a schedule can be made again from asDict() (see netbots_recorder).
+    """
+
+    def __init__(self, games, botsInGame, permutations, seed, mkLayout, played=0):
+        """
+        Make schedule for games games of botsInGame bots. mkLayout(rng) must return a list of
+        botsInGame start locations. played is the number of games already started.
+        """
+        self.games = games
+        self.botsInGame = botsInGame
+        self.permutations = permutations
+        self.seed = seed
+        self.mkLayout = mkLayout
+        self.played = played
+        self.perLayout = math.factorial(botsInGame) if permutations else 1
+        self.layoutIndex = None
+        self.layout = None  # start locations of layout self.layoutIndex
+        self.orderA = 1  # permutation k of self.layout is (orderA * k + orderB) % perLayout
+        self.orderB = 0
+
+    def __len__(self):
+        """ Number of games left. """
+        return self.games - self.played
+
+    def getStart(self, game):
+        """ Return list of start locations of game (0 based), one for each bot in d.startBots order. """
+        layoutIndex, k = divmod(game, self.perLayout)
+        if layoutIndex != self.layoutIndex:
+            rng = random.Random(self.seed + layoutIndex)
+            self.layout = self.mkLayout(rng)
+            if self.perLayout > 1:
+                self.orderA = rng.randrange(1, self.perLayout)
+                while math.gcd(self.orderA, self.perLayout) != 1:
+                    self.orderA = rng.randrange(1, self.perLayout)
+                self.orderB = rng.randrange(self.perLayout)
+            self.layoutIndex = layoutIndex
+        perm = nthPermutation(self.botsInGame, (self.orderA * k + self.orderB) % self.perLayout)
+        return [self.layout[i] for i in perm]
+
+    def peek(self):
+        """ Return start locations of the next game without using them. """
+        return self.getStart(self.played)
+
+    def pop(self):
+        """ Return start locations of the next game. """
+        if self.played >= self.games:
+            raise IndexError("pop from empty StartSchedule")
+        start = self.getStart(self.played)
+        self.played += 1
+        return start
+
+    def asDict(self):
+        """ Return dict of the values needed to make this schedule again. """
+        return {'games': self.games, 'botsInGame': self.botsInGame, 'permutations': self.permutations,
+                'seed': self.seed, 'played': self.played}
 
-            attempts += 1
-            if attempts > 999:
-                log("Could not layout bots without overlapping.", "FAILURE")
-                quit()
-
-        d.startLocs.extend(startLocs)
-        locIndexes = range(len(d.startLocs) - d.conf['botsInGame'], len(d.startLocs))
-        if d.conf['startPermutations']:
-            startLocsPerms = itertools.permutations(locIndexes)
-            d.starts.extend(startLocsPerms)
-        else:
-            d.starts.append(list(locIndexes))
 
-    random.shuffle(d.starts)
+def mkStartLocations(d):
+    """
+    Set d.starts to a new StartSchedule for d.conf['gamesToPlay'] games. The layout of the
+    first game is made now so an arena that is too crowded fails at start up (raises
+    StartLayoutError). Later layouts are made by stepGame() before each game starts.
+    """
+    d.starts = StartSchedule(d.conf['gamesToPlay'], d.conf['botsInGame'], d.conf['startPermutations'],
+                             d.rng.getrandbits(64), lambda rng: mkStartLayout(d, rng))
+    if len(d.starts):
+        d.starts.peek()
 
 
 def initGame(d):
@@ -516,12 +1030,15 @@ def initGame(d):
     log("Starting Game " + str(d.state['gameNumber']))
 
     d.state['gameStep'] = 0
+    d.state['idleStepCount'] = 0
     
     """
     for each bot
         reset health 100
         reset speed and direction values to 0
     """
+    # numpy engine arrays are built again from the new game's bots.
+    d.npBots = None
     for src, bot in d.bots.items():
         bot['health'] = 100
         bot['currentSpeed'] = 0
@@ -533,36 +1050,36 @@ def initGame(d):
     start = d.starts.pop()
     for i in range(d.conf['botsInGame']):
         src = d.startBots[i]
-        d.bots[src]['x'] = d.startLocs[start[i]]['x']
-        d.bots[src]['y'] = d.startLocs[start[i]]['y']
+        d.bots[src]['x'] = start[i]['x']
+        d.bots[src]['y'] = start[i]['y']
 
     # delete all shells and explosions.
     d.shells = {}
-    d.explosions = {}
-
-
-def step(d):
-    startTime = time.perf_counter()
+    if d.explosions.keepSteps == d.conf['keepExplosionSteps']:
+        d.explosions.clear()
+    else:
+        d.explosions = ExplosionRing(d.conf['keepExplosionSteps'])
 
-    d.state['gameStep'] += 1
-    d.state['serverSteps'] += 1
+    resetScans(d)
 
-    # for each bot that is alive, copy health to so we know what it was at the start of the step.
-    aliveBots = {}
-    for src, bot in d.bots.items():
-        if bot['health'] != 0:
-            aliveBots[src] = bot['health']
 
+def moveBots(d, aliveBots):
+    """
+    Change the speed and direction of all bots that are alive and then move them.
+    aliveBots is a dict of {src: health} for bots that were alive at the start of the step.
+    """
     # for all bots that are alive
     for src, bot in d.bots.items():
         if src in aliveBots:
+            params = d.getClassParams(bot['class'])
+
             # change speed if needed
             if bot['currentSpeed'] > bot['requestedSpeed']:
-                bot['currentSpeed'] -= d.getClassValue('botAccRate', bot['class'])
+                bot['currentSpeed'] -= params.botAccRate
                 if bot['currentSpeed'] < bot['requestedSpeed']:
                     bot['currentSpeed'] = bot['requestedSpeed']
             elif bot['currentSpeed'] < bot['requestedSpeed']:
-                bot['currentSpeed'] += d.getClassValue('botAccRate', bot['class'])
+                bot['currentSpeed'] += params.botAccRate
                 if bot['currentSpeed'] > bot['requestedSpeed']:
                     bot['currentSpeed'] = bot['requestedSpeed']
 
@@ -573,9 +1090,8 @@ def step(d):
                     bot['currentDirection'] = bot['requestedDirection']
                 else:
                     # how much can we turn at the speed we are going?
-                    turnRate = d.getClassValue('botMinTurnRate', bot['class']) \
-                        + (d.getClassValue('botMaxTurnRate', bot['class']) -
-                           d.getClassValue('botMinTurnRate', bot['class'])) \
+                    turnRate = params.botMinTurnRate \
+                        + (params.botMaxTurnRate - params.botMinTurnRate) \
                         * (1 - bot['currentSpeed'] / 100)
 
                     # if turn is negative and does not pass over 0 radians
@@ -609,139 +1125,197 @@ def step(d):
             if bot['currentSpeed'] != 0:
                 bot['x'], bot['y'] = nbmath.project(bot['x'], bot['y'],
                                         bot['currentDirection'],
-                                        bot['currentSpeed'] / 100.0 * d.getClassValue('botMaxSpeed', bot['class']))
+                                        bot['currentSpeed'] / 100.0 * params.botMaxSpeed)
 
-    # set starting hitSeverity to 0 for all robots. hitSeverity == 0 means robot did not 
-    # hit anything this step.
-    for src, bot in d.bots.items():
-        bot['hitSeverity'] = 0.0
 
-    # do until we get one clean pass where no bot hitting wall, obstacle or other bot.
-    foundOverlap = True
-    while foundOverlap:
-        foundOverlap = False
+def resolveCollisions(d):
+    """
+    Move bots so that none are hitting a wall, obstacle or other bot and record the
+    worst hitSeverity of each bot in bot['hitSeverity'].
 
-        # detect if bots hit walls. if they, did move them so they are just barely not touching,
+    Each iteration finds every wall, obstacle and bot contact in one sweep and then
+    applies all of the push-outs together. Iterations repeat until a sweep finds no
+    contacts or state['collisionMaxIterations'] is reached. If the limit is reached then
+    bots are moved back inside the arena walls so they are never left outside the arena.
+    """
+    radius = d.conf['botRadius']
+    arenaSize = d.conf['arenaSize']
+
+    iterations = 0
+    maxPenetration = 0
+    converged = False
+    wallTime = obstacleTime = botTime = 0.0
+    phaseTime = time.perf_counter()
+    while iterations < d.state['collisionMaxIterations']:
+        iterations += 1
+        moves = {}  # {src: [dx, dy], ...} total push-out for each bot this iteration.
+
+        # detect if bots hit walls.
         for src, bot in d.bots.items():
+            dx = 0
+            dy = 0
             hitSeverity = 0
-            if bot['x'] - d.conf['botRadius'] < 0:
+            if bot['x'] - radius < 0:
                 # hit left side
-                bot['x'] = d.conf['botRadius'] + 1
+                dx = radius + 1 - bot['x']
+                maxPenetration = max(maxPenetration, radius - bot['x'])
                 hitSeverity = getHitSeverity(d, bot, math.pi)
-            if bot['x'] + d.conf['botRadius'] > d.conf['arenaSize']:
+            if bot['x'] + radius > arenaSize:
                 # hit right side
-                bot['x'] = d.conf['arenaSize'] - d.conf['botRadius'] - 1
+                dx = arenaSize - radius - 1 - bot['x']
+                maxPenetration = max(maxPenetration, bot['x'] + radius - arenaSize)
                 hitSeverity = getHitSeverity(d, bot, 0)
-            if bot['y'] - d.conf['botRadius'] < 0:
+            if bot['y'] - radius < 0:
                 # hit bottom side
-                bot['y'] = d.conf['botRadius'] + 1
+                dy = radius + 1 - bot['y']
+                maxPenetration = max(maxPenetration, radius - bot['y'])
                 hitSeverity = getHitSeverity(d, bot, math.pi * 3 / 2)
-            if bot['y'] + d.conf['botRadius'] > d.conf['arenaSize']:
+            if bot['y'] + radius > arenaSize:
                 # hit top side
-                bot['y'] = d.conf['arenaSize'] - d.conf['botRadius'] - 1
-                hitSeverity = getHitSeverity(d, bot, math.pi/2)
-    
-            if hitSeverity:
-                foundOverlap = True
+                dy = arenaSize - radius - 1 - bot['y']
+                maxPenetration = max(maxPenetration, bot['y'] + radius - arenaSize)
+                hitSeverity = getHitSeverity(d, bot, math.pi / 2)
+
+            if dx or dy:
+                moves[src] = [dx, dy]
                 bot['hitSeverity'] = max(bot['hitSeverity'], hitSeverity)
 
-        # detect if bots hit obstacles, if the did move them so they are just barely not touching,
-        overlap = findOverlapingBotsAndObstacles(d, d.bots)
-        while overlap:
-            foundOverlap = True
-            b = d.bots[overlap[0]]
-            o = overlap[1]
+        now = time.perf_counter()
+        wallTime += now - phaseTime
+        phaseTime = now
+
+        # detect if bots hit obstacles.
+        for src, o in findAllOverlapingBotsAndObstacles(d, d.bots):
+            b = d.bots[src]
+            between = nbmath.distance(o['x'], o['y'], b['x'], b['y'])
+            maxPenetration = max(maxPenetration, radius + o['radius'] - between)
             # find angle to move bot directly away from obstacle
             a = nbmath.angle(o['x'], o['y'], b['x'], b['y'])
             # find min distance to move bot so it don't touch (plus 0.5 for safety).
-            distance = d.conf['botRadius'] + o['radius'] + 0.5 - nbmath.distance(o['x'], o['y'], b['x'], b['y'])
-            # move bot
-            b['x'], b['y'] = nbmath.project(b['x'], b['y'], a, distance)
+            distance = radius + o['radius'] + 0.5 - between
+            addMove(moves, src, a, distance)
             # record damage
             hitSeverity = getHitSeverity(d, b, a + math.pi)
             b['hitSeverity'] = max(b['hitSeverity'], hitSeverity)
-            # check for more bots overlapping
-            overlap = findOverlapingBotsAndObstacles(d, d.bots)
-                    
-        # detect if bots hit other bots, if the did move them so they are just barely not touching,
-        overlap = findOverlapingBots(d, d.bots)
-        while overlap:
-            foundOverlap = True
-            b1 = d.bots[overlap[0]]
-            b2 = d.bots[overlap[1]]
+
+        now = time.perf_counter()
+        obstacleTime += now - phaseTime
+        phaseTime = now
+
+        # detect if bots hit other bots.
+        for src1, src2 in findAllOverlapingBots(d, d.bots):
+            b1 = d.bots[src1]
+            b2 = d.bots[src2]
+            between = nbmath.distance(b1['x'], b1['y'], b2['x'], b2['y'])
+            maxPenetration = max(maxPenetration, radius * 2 - between)
             # find angle to move bot directly away from each other
             a = nbmath.angle(b1['x'], b1['y'], b2['x'], b2['y'])
             # find min distance to move each bot so they don't touch (plus 0.5 for saftly).
-            between = nbmath.distance(b1['x'], b1['y'], b2['x'], b2['y'])
-            distance = between / 2 - (between - d.conf['botRadius']) + 0.5
-            # move bots
-            b1['x'], b1['y'] = nbmath.project(b1['x'], b1['y'], a + math.pi, distance)
-            b2['x'], b2['y'] = nbmath.project(b2['x'], b2['y'], a, distance)
+            distance = between / 2 - (between - radius) + 0.5
+            addMove(moves, src1, a + math.pi, distance)
+            addMove(moves, src2, a, distance)
             # record damage
             hitSeverity = getHitSeverity(d, b1, a, b2)
             b1['hitSeverity'] = max(b1['hitSeverity'], hitSeverity)
             b2['hitSeverity'] = max(b2['hitSeverity'], hitSeverity)
-            # check for more bots overlapping
-            overlap = findOverlapingBots(d, d.bots)
 
-    # give damage (only once this step) to bots that hit things. Also stop them.
-    for src, bot in d.bots.items():
-        if bot['hitSeverity']:
-            if d.conf['simpleCollisions']:
-                bot['hitSeverity'] = 1
-            bot['health'] = max(0, bot['health'] - bot['hitSeverity'] * d.conf['hitDamage'] * d.getClassValue('botArmor', bot['class']))
-            bot['currentSpeed'] = 0
-            bot['requestedSpeed'] = 0
-        del bot['hitSeverity']
+        now = time.perf_counter()
+        botTime += now - phaseTime
+        phaseTime = now
+
+        if not moves:
+            converged = True
+            break
+
+        # move all bots that hit something.
+        for src, move in moves.items():
+            bot = d.bots[src]
+            bot['x'] += move[0]
+            bot['y'] += move[1]
+            d.botChanged(src)
+
+    if not converged:
+        # Walls win over other contacts. Never leave a bot outside the arena.
+        for src, bot in d.bots.items():
+            bot['x'] = min(max(bot['x'], radius + 1), arenaSize - radius - 1)
+            bot['y'] = min(max(bot['y'], radius + 1), arenaSize - radius - 1)
+            d.botChanged(src)
+        d.state['collisionLimitCount'] += 1
+        log("Collisions not resolved after " + str(iterations) + " iterations.", "VERBOSE")
+
+    d.timers['collideWalls'].add(wallTime)
+    d.timers['collideObstacles'].add(obstacleTime)
+    d.timers['collideBots'].add(botTime)
+
+    d.state['collisionIterations'] += iterations
+    d.state['collisionIterationsMax'] = max(d.state['collisionIterationsMax'], iterations)
+    d.state['collisionPenetrationMax'] = max(d.state['collisionPenetrationMax'], maxPenetration)
+
+
+def addMove(moves, src, a, distance):
+    """ Add a push-out of distance at angle a to the total move for bot src. """
+    dx, dy = nbmath.project(0, 0, a, distance)
+    if src in moves:
+        moves[src][0] += dx
+        moves[src][1] += dy
+    else:
+        moves[src] = [dx, dy]
+
+
+def moveShells(d):
+    """
+    Move all shells. Remove shells that hit an obstacle or left the arena and explode
+    shells that have reached their destination, damaging bots in range.
+    """
+    grid = d.getObstacleGrid()
+    explosions = 0
+    explosionTime = 0.0
 
     # for all shells
     for src in list(d.shells.keys()):
         shell = d.shells[src]
+        params = d.getClassParams(d.bots[src]['class'])
+        explRadius = params.explRadius
 
         # remember shells start point before moving
         oldx = shell['x']
         oldy = shell['y']
 
         # move shell
-        distance = min(d.getClassValue('shellSpeed', d.bots[src]['class']), shell['distanceRemaining'])
+        distance = min(params.shellSpeed, shell['distanceRemaining'])
         shell['x'], shell['y'] = nbmath.project(shell['x'], shell['y'], shell['direction'], distance)
         shell['distanceRemaining'] -= distance
 
         # did shell hit an obstacle?
         shellHitObstacle = False
-        for o in d.conf['obstacles']:
+        for o in grid.nearSegment(oldx, oldy, shell['x'], shell['y']):
             if nbmath.intersectLineCircle(oldx, oldy, shell['x'], shell['y'], o['x'], o['y'], o['radius']):
                 shellHitObstacle = True
+                break
 
         # if did not hit an obstacle and shell's explosion would touch inside of arena
         if not shellHitObstacle and \
-           (shell['x'] > d.getClassValue('explRadius', d.bots[src]['class']) * -1 and shell['x'] < d.conf['arenaSize'] + d.getClassValue('explRadius', d.bots[src]['class']) and
-                shell['y'] > d.getClassValue('explRadius', d.bots[src]['class']) * -1 and shell['y'] < d.conf['arenaSize'] + d.getClassValue('explRadius', d.bots[src]['class'])):
+           (shell['x'] > explRadius * -1 and shell['x'] < d.conf['arenaSize'] + explRadius and
+                shell['y'] > explRadius * -1 and shell['y'] < d.conf['arenaSize'] + explRadius):
 
             # if shell has reached it destination then explode.
             if shell['distanceRemaining'] <= 0:
+                startTime = time.perf_counter()
                 # apply damage to bots.
                 for k, bot in d.bots.items():
                     if bot['health'] > 0:
                         distance = nbmath.distance(bot['x'], bot['y'], shell['x'], shell['y'])
-                        if distance < d.getClassValue('explRadius', d.bots[src]['class']):
-                            damage = d.getClassValue('explDamage', d.bots[src]['class']) * (1 - distance / d.getClassValue('explRadius', d.bots[src]['class']))
-                            bot['health'] = max(0, bot['health'] - (damage * d.getClassValue('botArmor', bot['class'])))
+                        if distance < explRadius:
+                            damage = params.explDamage * (1 - distance / explRadius)
+                            bot['health'] = max(0, bot['health'] - (damage * d.getClassParams(bot['class']).botArmor))
                             # allow recording of inflicting damage that is greater than health of hit robot.
                             # also record damage to oneself.
                             d.bots[src]['shellDamage'] += damage
 
-                # store the explosion so viewers can display it. we can't use src as index because it is possible for two explosions
-                # from same bot to exist (but not likly).
-                d.explosions[d.state['explIndex']] = {
-                    'x': shell['x'],
-                    'y': shell['y'],
-                    'stepsAgo': 0,
-                    'src': src  # this is needed by viewer to color this explosion based on the bot who fired it.
-                    }
-                d.state['explIndex'] += 1
-                if d.state['explIndex'] > 65000:
-                    d.state['explIndex'] = 0
+                # store the explosion so viewers can display it.
+                d.explosions.add(d.state['serverSteps'], shell['x'], shell['y'], src)
+                explosions += 1
+                explosionTime += time.perf_counter() - startTime
 
                 # this shell exploed so remove it
                 del d.shells[src]
@@ -749,15 +1323,60 @@ def step(d):
             # shell hit obstacle or left arena so remove it without exploding
             del d.shells[src]
 
-    # Remove old explosions and add 1 to other explosions stepsAgo.
-    # Note, We only keep these around so the viewer can do a nice animation
-    # over a number of steps before they are removed.
-    for key in list(d.explosions.keys()):
-        expl = d.explosions[key]
-        if expl['stepsAgo'] == d.conf['keepExplosionSteps']:
-            del d.explosions[key]
-        else:
-            expl['stepsAgo'] += 1
+    if explosions:
+        d.timers['explosions'].add(explosionTime)
+
+
+def step(d):
+    startTime = time.perf_counter()
+    timers = d.timers
+
+    d.state['gameStep'] += 1
+    d.state['serverSteps'] += 1
+
+    # for each bot that is alive, copy health to so we know what it was at the start of the step.
+    aliveBots = {}
+    for src, bot in d.bots.items():
+        if bot['health'] != 0:
+            aliveBots[src] = bot['health']
+
+    # move all bots that are alive
+    useNumpy = nbnp.use(d)
+    if useNumpy:
+        nbnp.moveBots(d, aliveBots)
+    else:
+        moveBots(d, aliveBots)
+    phaseTime = timers['move'].lap(startTime)
+
+    # set starting hitSeverity to 0 for all robots. hitSeverity == 0 means robot did not 
+    # hit anything this step.
+    for src, bot in d.bots.items():
+        bot['hitSeverity'] = 0.0
+
+    # move bots so none are hitting a wall, obstacle or other bot.
+    resolveCollisions(d)
+    phaseTime = timers['collisions'].lap(phaseTime)
+
+    # give damage (only once this step) to bots that hit things. Also stop them.
+    for src, bot in d.bots.items():
+        if bot['hitSeverity']:
+            if d.conf['simpleCollisions']:
+                bot['hitSeverity'] = 1
+            bot['health'] = max(0, bot['health'] - bot['hitSeverity'] * d.conf['hitDamage'] * d.getClassParams(bot['class']).botArmor)
+            bot['currentSpeed'] = 0
+            bot['requestedSpeed'] = 0
+            d.botChanged(src)
+        del bot['hitSeverity']
+    phaseTime = timers['hitDamage'].lap(phaseTime)
+
+    # move all shells, exploding those that reached their destination.
+    if useNumpy:
+        nbnp.moveShells(d)
+    else:
+        moveShells(d)
+    phaseTime = timers['shells'].lap(phaseTime)
+
+    # Note, explosions are not aged here. They expire as the step count moves on (see ExplosionRing).
 
     # find how many points bots that died this step will get. (Based on how many bots have died previouly)
     if len(aliveBots) == d.conf['botsInGame']:
@@ -787,18 +1406,94 @@ def step(d):
         d.bots[src]['health'] = 0
         d.bots[src]['points'] += 10  # last robot (winner)
         del aliveBots[src]
+    if d.state['idlePolicy'] != 'off':
+        countIdleStep(d, aliveBots)
+    phaseTime = timers['scoring'].lap(phaseTime)
+
+    # bots do not move again until next step so work out what scans can see once for all scans this step.
+    resetScans(d)
+    phaseTime = timers['scans'].lap(phaseTime)
+
+    d.state['stepTime'] += timers['step'].lap(startTime, phaseTime) - startTime
+
+
+def countIdleStep(d, aliveBots):
+    """
+    Count this step as idle if no bot in aliveBots is moving or turning and no shells are
+    in flight, otherwise start counting again. Messages that may change the game also
+    restart the count (see processMsg()).
+    """
+    if d.shells or not aliveBots:
+        d.state['idleStepCount'] = 0
+        return
+    for src in aliveBots:
+        bot = d.bots[src]
+        if bot['currentSpeed'] != 0 or bot['requestedSpeed'] != 0 or bot['currentDirection'] != bot['requestedDirection']:
+            d.state['idleStepCount'] = 0
+            return
+    d.state['idleStepCount'] += 1
+
+
+def isIdle(d):
+    """
+    Return True if nothing has happened in the game in progress for idleMinSteps steps. Until
+    a bot sends a message that is not a query, every step left in the game will be the same
+    so the scores at stepMax are already known.
+    """
+    return d.state['idlePolicy'] != 'off' and d.state['idleStepCount'] >= d.state['idleMinSteps']
+
 
-    d.state['stepTime'] += time.perf_counter() - startTime
+def jumpToStepMax(d):
+    """
+    If d.state['idlePolicy'] is 'jump' and the game is idle then move the game on so the next
+    step() is stepMax, where the game ends with the same scores as playing every step.
+    """
+    if d.state['idlePolicy'] == 'jump' and isIdle(d):
+        skipped = d.conf['stepMax'] - 1 - d.state['gameStep']
+        if skipped > 0:
+            log("Game idle for " + str(d.state['idleStepCount']) + " steps. Skipping " + str(skipped) +
+                " steps to stepMax.", "VERBOSE")
+            d.state['gameStep'] += skipped
+            d.state['idleJumpCount'] += 1
+            d.state['idleStepsSkipped'] += skipped
 
 
 ########################################################
 # Stats and Points Logging
 ########################################################
 
+def timersScoreboard(d):
+    """ Return a table of d.timers for logScoreboard(). Times are in milliseconds except Total. """
+    output = f"  {'Timer':>16}" +\
+        f"  {'Count':>10}" +\
+        f"  {'Total(s)':>10}" +\
+        f"  {'Mean(ms)':>10}" +\
+        f"  {'p50(ms)':>10}" +\
+        f"  {'p99(ms)':>10}" +\
+        f"  {'Max(ms)':>10}" +\
+        "\n " + "-" * 84
+    for name in SrvData.timerNames:
+        t = d.timers[name].asDict()
+        output += "\n" +\
+            f"  {name:>16}" +\
+            f"  {t['count']:>10}" +\
+            f"  {t['total']:>10.3f}" +\
+            f"  {t['mean'] * 1000:>10.3f}" +\
+            f"  {t['p50'] * 1000:>10.3f}" +\
+            f"  {t['p99'] * 1000:>10.3f}" +\
+            f"  {t['max'] * 1000:>10.3f}"
+    return output
+
+
 def logScoreboard(d):
     now = time.time()
-    totalRecv = sum(d.srvSocket.recv.values())
-    totalSent = sum(d.srvSocket.sent.values())
+    if d.srvSocket:
+        totalRecv = sum(d.srvSocket.recv.values())
+        totalSent = sum(d.srvSocket.sent.values())
+    else:
+        # headless mode and merged results have no socket.
+        totalRecv = d.state.get('msgsIn', 0)
+        totalSent = d.state.get('msgsOut', 0)
     output = "\n\n                  ------ Scoreboard ------" +\
         "\n               Tournament Time: " + '%.3f' % (now - d.state['tourStartTime']) + " secs." +\
         "\n                         Games: " + str(d.state['gameNumber']) +\
@@ -816,7 +1511,21 @@ def logScoreboard(d):
         "\n                Steps / Second: " + '%.3f' % (d.state['serverSteps'] / float(max(1, time.time() - d.state['tourStartTime']))) +\
         "\n                 Time Sleeping: " + '%.3f' % (float(d.state['sleepTime'])) + " secs." +\
         "\n            Average Sleep Time: " + '%.6f' % (float(d.state['sleepTime']) / max(1, d.state['sleepCount'])) + " secs." +\
+        "\n     Average Step Start Jitter: " + '%.6f' % (d.state['stepJitterTotal'] / max(1, d.state['serverSteps'])) + " secs." +\
+        "\n         Max Step Start Jitter: " + '%.6f' % (d.state['stepJitterMax']) + " secs." +\
         "\n     Steps Slower Than stepSec: " + str(d.state['longStepCount']) + f" ({float(d.state['longStepCount']) / float(max(1,d.state['serverSteps'])) * 100.0:>4.2f}%)" +\
+        "\n Avg Collision Iterations/Step: " + '%.3f' % (d.state['collisionIterations'] / max(1, d.state['serverSteps'])) +\
+        "\n Max Collision Iterations/Step: " + str(d.state['collisionIterationsMax']) +\
+        "\n      Steps at Collision Limit: " + str(d.state['collisionLimitCount']) +\
+        "\n     Max Collision Penetration: " + '%.3f' % (d.state['collisionPenetrationMax']) +\
+        "\n       Games Jumped to stepMax: " + str(d.state['idleJumpCount']) +\
+        "\n            Idle Steps Skipped: " + str(d.state['idleStepsSkipped']) +\
+        "\n          Idle Steps Not Paced: " + str(d.state['idleFastSteps']) +\
+        "\n          Early Lockstep Steps: " + str(d.state['lockstepEarlySteps']) +\
+        "\n               stepSec Changes: " + str(d.state['adaptChanges']) +\
+        "\n        stepSec Now (Low-High): " + '%.6f' % (d.conf['stepSec']) + " (" + '%.6f' % (d.state['adaptStepSecLow']) +\
+        "-" + '%.6f' % (d.state['adaptStepSecHigh']) + ") secs." +\
+        "\n\n" + timersScoreboard(d) +\
         "\n\n" +\
         f"  {' ':>16}" +\
         f"  {'---- Score -----':>16}" +\
@@ -867,8 +1576,67 @@ def jsonScoreboard(d):
         d.state['tourEndTime'] = time.time()
         d.state['tourTime'] = d.state['tourEndTime'] - d.state['tourStartTime']
         d.state['longStepPercent'] = float(d.state['longStepCount']) / float(max(1,d.state['serverSteps'])) * 100.0
+        timers = {name: t.asDict() for name, t in d.timers.items()}
         with open(d.state['jsonScoreboard'],"w") as f: 
-            f.write(json.dumps({'conf': d.conf,'state': d.state, 'bots': d.bots}))
+            f.write(json.dumps({'conf': d.conf,'state': d.state, 'bots': d.bots, 'timers': timers}))
+
+def arenaResult(d):
+    """ Return the results of arena d as a dict that can be sent between processes. """
+    state = dict(d.state)
+    if d.srvSocket:
+        state['msgsIn'] = sum(d.srvSocket.recv.values())
+        state['msgsOut'] = sum(d.srvSocket.sent.values())
+    return {'conf': d.conf, 'state': state, 'bots': d.bots, 'timers': d.timers}
+
+
+# How mergeResults() combines each state value of many results.
+mergeSum = ('gameNumber', 'serverSteps', 'stepTime', 'msgTime', 'viewerMsgTime', 'sleepTime', 'sleepCount',
+            'longStepCount', 'stepJitterTotal', 'dropCount', 'collisionIterations', 'collisionLimitCount',
+            'idleJumpCount', 'idleStepsSkipped', 'idleFastSteps', 'lockstepEarlySteps', 'adaptChanges',
+            'msgsIn', 'msgsOut')
+mergeMax = ('stepJitterMax', 'collisionIterationsMax', 'collisionPenetrationMax', 'adaptStepSecHigh')
+mergeMin = ('startTime', 'tourStartTime', 'adaptStepSecLow')
+mergeBotSum = ('points', 'firedCount', 'shellDamage', 'missedSteps', 'winHealth', 'winCount')
+
+
+def mergeResults(results):
+    """
+    results is a list of dicts from arenaResult(). Return a SrvData with conf of the
+    first result, state stats combined across all results and bots summed by src so
+    logScoreboard() and jsonScoreboard() show totals for all results.
+    """
+    d = SrvData()
+    d.conf = results[0]['conf']
+
+    for fld in mergeSum:
+        d.state[fld] = sum(r['state'].get(fld, 0) for r in results)
+    for fld in mergeMax:
+        d.state[fld] = max(r['state'][fld] for r in results)
+    for fld in mergeMin:
+        times = [r['state'][fld] for r in results if r['state'][fld]]
+        d.state[fld] = min(times) if times else False
+    for r in results:
+        for name, t in r['timers'].items():
+            d.timers[name].merge(t)
+
+    botSteps = {}  # {src: steps, ...} Steps taken by the arenas each bot played in.
+    for r in results:
+        for src, bot in r['bots'].items():
+            if src in d.bots:
+                for fld in mergeBotSum:
+                    d.bots[src][fld] += bot[fld]
+                botSteps[src] += r['state']['serverSteps']
+            else:
+                d.bots[src] = copy.deepcopy(bot)
+                botSteps[src] = r['state']['serverSteps']
+
+    # Scale missedSteps so missed step % is out of all steps rather than only the steps of the bot's arenas.
+    # Round so missedSteps is still a whole number of steps, as in the scoreboard of one arena.
+    for src, bot in d.bots.items():
+        bot['missedSteps'] = round(bot['missedSteps'] * d.state['serverSteps'] / max(1, botSteps[src]))
+
+    return d
+
 
 ########################################################
 # Main Loop
@@ -891,17 +1659,431 @@ class Range(argparse.Action):
         
 
 def quit(signal=None, frame=None):
-    global d
-    log(d.srvSocket.getStats())
-    logScoreboard(d)
+    global arenas
+    for d in arenas:
+        if not d.done:
+            logArenaEnd(d)
+        if d.recorder:
+            d.recorder.close()
     log("Quiting", "INFO")
     exit()
 
 
-def main():
-    global d  # d is global so quit() can access it.
+def logArenaEnd(d):
+    """ Log socket stats and the scoreboard of arena d. """
+    log("Final results of " + d.conf['serverName'] + ":")
+    if d.srvSocket:
+        log(d.srvSocket.getStats())
+    logScoreboard(d)
+
+
+def stepGame(d):
+    """
+    Take one step of the game in progress, or start the next game if there are enough
+    bots, or quit if all games have been played. Returns True if a game step was taken.
+    """
+    aliveBots = 0
+    for src, bot in d.bots.items():
+        if bot['health'] != 0:
+            aliveBots += 1
+
+    if aliveBots > 0:  # if there is an ongoing game
+        jumpToStepMax(d)
+        step(d)
+        return True
+    elif len(d.bots) == d.conf['botsInGame']:  # if we have enough bots to start playing
+        if not d.state['tourStartTime']:
+            d.state['tourStartTime'] = time.time()
+
+        if d.conf['gamesToPlay'] != d.state['gameNumber']:
+            try:
+                # Make the next layout before initGame() so if it does not fit only this arena stops.
+                d.starts.peek()
+            except StartLayoutError as e:
+                log(str(e) + " Stopping " + d.conf['serverName'] + " after " + str(d.state['gameNumber']) +
+                    " games.", "ERROR")
+                jsonScoreboard(d)
+                d.done = True
+                return False
+            if not d.state['onlyLastSb']:
+                logScoreboard(d)
+            initGame(d)
+        else:
+            log("All games have been played in " + d.conf['serverName'] + ".")
+            jsonScoreboard(d)
+            d.done = True
+    elif d.conf['maxSecsToJoin'] < float(time.time() - d.state['startTime']):
+        log("Not enough bots joined " + d.conf['serverName'] + " before max seconds to join ( " +
+            str(d.conf['maxSecsToJoin']) + " sec). Exiting.", "ERROR")
+        d.done = True
+
+    return False
+
+
+def stepArena(d):
+    """
+    Process one scheduled step of arena d and schedule the next one. Steps are kept on a
+    fixed schedule rather than drifting from when the last step ended.
+    """
+    now = time.perf_counter()
+
+    if d.recorder:
+        d.recorder.tick(d)
+
+    # only count slow steps and jitter if we actually process a step this time around.
+    countSlowStep = stepGame(d)
+    if countSlowStep:
+        jitter = now - d.nextStepAt
+        d.timers['stepJitter'].add(jitter)
+        d.state['stepJitterTotal'] += jitter
+        d.state['stepJitterMax'] = max(d.state['stepJitterMax'], jitter)
+
+    missed = startStepMsgs(d)
+    if countSlowStep and d.state['adaptStepSec']:
+        adaptStepSec(d, missed)
+    sendToViwers(d)
+
+    if d.state['idlePolicy'] == 'fast' and countSlowStep and isIdle(d):
+        # Nothing will happen until a bot acts, so play the next step as soon as messages are read.
+        d.state['idleFastSteps'] += 1
+        d.nextStepAt = time.perf_counter()
+        return
+
+    d.nextStepAt += d.conf['stepSec']
+    now = time.perf_counter()
+    if now >= d.nextStepAt:
+        if countSlowStep:
+            d.state['longStepCount'] += 1
+            log(d.conf['serverName'] + " running slower than " + str(d.conf['stepSec']) + " sec/step.", "VERBOSE")
+        if now >= d.nextStepAt + d.conf['stepSec']:
+            # More than a whole step behind. Skip to the latest step on the schedule instead of
+            # running a burst of steps to catch up.
+            d.nextStepAt += math.floor((now - d.nextStepAt) / d.conf['stepSec']) * d.conf['stepSec']
+
+
+def mkArena(args, arena):
+    """
+    Return a new SrvData with conf set from the command line args. arena is the arena
+    number, 0 to args.arenas-1. Each arena has its own obstacles, jam zones and start
+    locations, and its own options if they were given with -arenaconf.
+    """
+    if args.arenaArgs:
+        args = args.arenaArgs[arena]
     d = SrvData()
+    if args.seed is not None:
+        d.rng.seed(args.seed + arena)
+    d.conf['serverName'] = args.serverName
+    if args.arenas > 1:
+        d.conf['serverName'] += " Arena " + str(arena)
+    d.conf['gamesToPlay'] = args.gamesToPlay
+    d.conf['botsInGame'] = args.botsInGame
+    d.conf['stepSec'] = args.stepSec
+    d.conf['lockstep'] = args.lockstep
+    d.state['adaptStepSec'] = args.adaptStepSec
+    d.state['adaptMissRate'] = args.adaptMissRate
+    d.state['adaptSteps'] = args.adaptSteps
+    d.state['stepSecMin'] = args.stepSecMin
+    d.state['stepSecMax'] = args.stepSecMax
+    d.state['adaptStepSecLow'] = d.state['adaptStepSecHigh'] = args.stepSec
+    d.conf['stepMax'] = args.stepMax
+    d.conf['dropRate'] = args.dropRate
+    d.state['dropNext'] = args.dropRate
+    d.conf['botMsgsPerStep'] = args.botMsgsPerStep
+    d.conf['arenaSize'] = args.arenaSize
+    d.conf['botRadius'] = args.botRadius
+    d.conf['explRadius'] = args.explRadius
+    d.conf['botMaxSpeed'] = args.botMaxSpeed
+    d.conf['botAccRate'] = args.botAccRate
+    d.conf['shellSpeed'] = args.shellSpeed
+    d.conf['hitDamage'] = args.hitDamage
+    d.conf['explDamage'] = args.explDamage
+    d.conf['obstacleRadius'] = args.obstacleRadius
+    d.conf['obstacles'] = mkObstacles(d, args.obstacles)
+    d.conf['jamZones'] = mkJamZones(d, args.jamZones)
+    d.conf['allowClasses'] = args.allowClasses
+    d.conf['simpleCollisions'] = args.simpleCollisions
+    d.conf['startPermutations'] = args.startPermutations
+    d.conf['scanMaxDistance'] = args.scanMaxDistance
+    d.conf['noViewers'] = args.noViewers
+    d.conf['maxSecsToJoin'] = args.maxSecsToJoin
+    d.state['onlyLastSb'] = args.onlyLastSb
+    d.state['jsonScoreboard'] = args.jsonScoreboard
+    if args.jsonScoreboard:
+        d.state['jsonScoreboard'] = arenaFilename(args, args.jsonScoreboard, arena)
+    d.state['engine'] = args.engine
+    d.state['collisionMaxIterations'] = args.collisionMaxIterations
+    d.state['idlePolicy'] = args.idlePolicy
+    d.state['idleMinSteps'] = args.idleMinSteps
+    d.compileClassParams()
+
+    mkStartLocations(d)
+
+    if args.record:
+        d.recorder = nbrec.Recorder(arenaFilename(args, args.record, arena), d,
+                                    None if args.seed is None else args.seed + arena)
+
+    return d
+
 
+serverWideArgs = ('serverIP', 'serverPort', 'arenas', 'workers', 'replay', 'arenaConf', 'debug', 'verbose')
+
+
+def loadArenaArgs(parser, args):
+    """
+    Return [args of arena 0, args of arena 1, ...] where the args of arena n are args with
+    entry n of the -arenaconf file parsed on top. The file is a JSON list with a list of
+    options for each arena, e.g. [["-bots", 2], ["-arenasize", 500, "-obstacles", 0]].
+    Arenas after the last entry use args as is.
+    """
+    try:
+        with open(args.arenaConf) as f:
+            arenaConf = json.load(f)
+    except Exception as e:
+        log("Could not read -arenaconf file: " + str(e), "FAILURE")
+        exit()
+
+    if not isinstance(arenaConf, list) or not all(isinstance(options, list) for options in arenaConf):
+        log("-arenaconf file must contain a list with a list of options for each arena.", "FAILURE")
+        exit()
+    if len(arenaConf) > args.arenas:
+        log("-arenaconf file has options for " + str(len(arenaConf)) + " arenas but -arenas is " +
+            str(args.arenas) + ".", "FAILURE")
+        exit()
+
+    arenaArgs = []
+    for arena in range(args.arenas):
+        if arena >= len(arenaConf):
+            arenaArgs.append(args)
+            continue
+        options = [str(o) for o in arenaConf[arena]]
+        a = parser.parse_args(options, namespace=copy.copy(args))
+        for dest in serverWideArgs:
+            if getattr(a, dest) != getattr(args, dest):
+                log("Arena " + str(arena) + " options " + str(options) + " change " + dest +
+                    " which applies to all arenas and can only be given on the command line.", "FAILURE")
+                exit()
+        arenaArgs.append(a)
+
+    return arenaArgs
+
+
+def arenaFilename(args, filename, arena):
+    """ Return filename for arena. Each arena saves to its own file, e.g. results.json -> results-arena0.json """
+    if args.arenas > 1:
+        root, ext = os.path.splitext(filename)
+        return root + "-arena" + str(arena) + ext
+    return filename
+
+
+def replayRecording(filename, onlyLastSb=False):
+    """
+    Play a recording made with -record (see netbots_recorder) through processMsg() and
+    stepGame() with no sockets, no robots and no step pacing. Returns the SrvData of the
+    replayed arena.
+    """
+    records = nbrec.readRecords(filename)
+    header = next(records, None)
+    if header is None or header.get('version') != nbrec.recordingVersion:
+        raise Exception(filename + " is not a version " + str(nbrec.recordingVersion) + " recording.")
+
+    d = SrvData()
+    d.conf = header['conf']
+    d.conf['dropRate'] = 0  # Drops are in the recording.
+    d.conf['noViewers'] = True
+    starts = header['starts']
+    d.starts = StartSchedule(starts['games'], starts['botsInGame'], starts['permutations'], starts['seed'],
+                             lambda rng: mkStartLayout(d, rng), starts['played'])
+    d.state['engine'] = header['engine']
+    d.state['collisionMaxIterations'] = header['collisionMaxIterations']
+    d.state['idlePolicy'] = header['idlePolicy']
+    d.state['idleMinSteps'] = header['idleMinSteps']
+    d.state['onlyLastSb'] = onlyLastSb
+    d.compileClassParams()
+
+    startTime = time.perf_counter()
+    events = 0
+    diverged = False
+    for rec in records:
+        events += 1
+        kind = rec[0]
+        if kind == nbrec.TICK:
+            if rec[1] != d.state['serverSteps'] and not diverged:
+                log("Replay of " + filename + " is at step " + str(d.state['serverSteps']) +
+                    " but recording was at step " + str(rec[1]) + ".", "WARNING")
+                diverged = True
+            stepGame(d)
+            startStepMsgs(d)
+        elif kind == nbrec.MSG or kind == nbrec.DROP_MSG:
+            src = rec[2]
+            if src in d.botMsgCount:
+                d.botMsgCount[src] += 1
+            else:
+                d.botMsgCount[src] = 1
+            if kind == nbrec.MSG:
+                processMsg(d, rec[3], src)
+            else:
+                d.state['dropCount'] += 1
+        elif kind == nbrec.DROP_REPLY:
+            d.state['dropCount'] += 1
+
+    log("Replayed " + str(events) + " events of " + filename + " in " +
+        '%.3f' % (time.perf_counter() - startTime) + " secs.")
+    return d
+
+
+# select() cannot wait on file descriptors of FD_SETSIZE (1024) or more. Each arena uses a
+# socket, and a file with -record, so no process runs more than this many arenas.
+maxArenasPerProcess = 400
+
+arenas = []  # [SrvData, ...] All arenas run by this process. This is global so quit() can access it.
+
+
+def runArenas(args, arenaNumbers, resultQ=None):
+    """
+    Run arenas arenaNumbers (list of arena numbers) until they have all finished. If
+    resultQ is given then the arenaResult() of each arena is put on it when the arena finishes.
+    """
+    global arenas
+
+    for arena in arenaNumbers:
+        try:
+            arenas.append(mkArena(args, arena))
+        except StartLayoutError as e:
+            log(str(e), "FAILURE")
+            quit()
+
+    log(lambda: "Server Configuration: " + str(arenas[0].conf), "VERBOSE")
+
+    # Wait for messages with select() since it has sub-millisecond timeouts. It only takes file
+    # descriptors below FD_SETSIZE (1024), see maxArenasPerProcess.
+    sel = selectors.SelectSelector()
+    for arena, d in zip(arenaNumbers, arenas):
+        try:
+            d.srvSocket = nbipc.NetBotSocket(args.serverIP, args.serverPort + arena)
+        except Exception as e:
+            log(str(e), "FAILURE")
+            quit()
+        sel.register(d.srvSocket.s, selectors.EVENT_READ, d)
+        if args.arenas > 1:
+            log(d.conf['serverName'] + " listening on port " + str(args.serverPort + arena))
+
+    now = time.perf_counter()
+    for d in arenas:
+        d.nextStepAt = now
+
+    running = list(arenas)
+    while running:
+        now = time.perf_counter()
+        for d in running:
+            if now >= d.nextStepAt:
+                stepArena(d)
+                if d.done:
+                    sel.unregister(d.srvSocket.s)
+                    logArenaEnd(d)
+                    if d.recorder:
+                        d.recorder.close()
+                    if resultQ:
+                        resultQ.put(arenaResult(d))
+        running = [d for d in running if not d.done]
+        if not running:
+            break
+
+        # Sleep until a message arrives or the next step of any arena is due. Process messages as they arrive.
+        now = time.perf_counter()
+        timeout = min(d.nextStepAt for d in running) - now
+        if timeout > 0:
+            events = sel.select(timeout)
+            sleepTime = time.perf_counter() - now
+            for d in running:
+                d.state['sleepCount'] += 1
+                d.state['sleepTime'] += sleepTime
+        else:
+            events = sel.select(0)
+        for key, mask in events:
+            recvReplyMsgs(key.data)
+            stepIfTurnsEnded(key.data)
+
+
+def runWorker(args, arenaNumbers, resultQ):
+    """ Entry point of a worker process started by runSupervisor(). """
+
+    def stopWorker(signum=None, frame=None):
+        # Send the results so far of arenas that have not finished so the supervisor can
+        # still merge them, then quit. Ignore more signals so results are only sent once.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for d in arenas:
+            if not d.done:
+                resultQ.put(arenaResult(d))
+        quit()
+
+    signal.signal(signal.SIGINT, stopWorker)
+    signal.signal(signal.SIGTERM, stopWorker)
+    setLogLevel(args.debug, args.verbose)
+    # Forked workers start with the same random state, so reseed or all arenas would be the same.
+    random.seed()
+    runArenas(args, arenaNumbers, resultQ)
+
+
+def runSupervisor(args):
+    """
+    Spread args.arenas arenas over args.workers worker processes, each of which owns the
+    ports of its arenas. Wait for the results of all arenas and log one scoreboard (and
+    save one json file) with the totals of all arenas.
+
+    If the supervisor gets SIGINT (Ctrl-C) or SIGTERM then it stops the workers, which
+    send the results so far of their unfinished arenas, and the scoreboard and json file
+    have the totals of what was played.
+    """
+    stopSignals = []  # Signals received. The wait loop below stops the workers when this is not empty.
+
+    def stopSupervisor(signum, frame):
+        stopSignals.append(signum)
+
+    # Set before starting workers so a signal can not arrive while a worker has no handler.
+    # Workers set their own handlers (see runWorker()).
+    signal.signal(signal.SIGINT, stopSupervisor)
+    signal.signal(signal.SIGTERM, stopSupervisor)
+
+    resultQ = multiprocessing.Queue()
+    workers = []
+    for w in range(args.workers):
+        arenaNumbers = list(range(w, args.arenas, args.workers))
+        p = multiprocessing.Process(target=runWorker, args=(args, arenaNumbers, resultQ))
+        p.start()
+        workers.append(p)
+        log("Started worker " + str(w) + " (pid " + str(p.pid) + ") for arenas " + str(arenaNumbers))
+
+    results = []
+    stopping = False
+    while len(results) < args.arenas:
+        if stopSignals and not stopping:
+            stopping = True
+            log("Stopping workers. Results so far of all arenas will be merged.")
+            for p in workers:
+                if p.is_alive():
+                    p.terminate()
+        try:
+            results.append(resultQ.get(timeout=1))
+        except queue.Empty:
+            if not any(p.is_alive() for p in workers):
+                if not stopping:
+                    log("All workers quit before all arenas finished.", "ERROR")
+                break
+
+    for p in workers:
+        p.join()
+
+    if results:
+        log("Results of " + str(len(results)) + " arenas" + (" (stopped before all games were played)" if stopping else "") + ":")
+        d = mergeResults(results)
+        logScoreboard(d)
+        if args.jsonScoreboard:
+            d.state['jsonScoreboard'] = args.jsonScoreboard
+            jsonScoreboard(d)
+
+
+def main():
     random.seed()
 
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -909,6 +2091,14 @@ def main():
                         default='127.0.0.1', help='My IP Address')
     parser.add_argument('-p', metavar='Server_Port', dest='serverPort', type=int,
                         default=20000, help='My port number')
+    parser.add_argument('-arenas', metavar='int', dest='arenas', type=int, min=1, max=1000, action=Range,
+                        default=1, help='Number of independent arenas (games) to run. Arena n uses port number + n.')
+    parser.add_argument('-arenaconf', metavar='filename', dest='arenaConf', type=str,
+                        default=None, help='JSON file with a list of options for each arena, '
+                        'e.g. [["-bots", 2], ["-arenasize", 500]]. Arena n uses entry n on top of the other options.')
+    parser.add_argument('-workers', metavar='int', dest='workers', type=int,
+                        default=1, help='Number of processes to spread arenas over. 0 == one per CPU core. '
+                        'Raised if needed so no process runs more than 400 arenas.')
     parser.add_argument('-name', metavar='Server_Name', dest='serverName', type=str,
                         default="Netbots Server", help='Name displayed by connected viewers.')
     parser.add_argument('-games', metavar='int', dest='gamesToPlay', type=int,
@@ -917,6 +2107,19 @@ def main():
                         default=4, help='Number of bots required to join before game can start.')
     parser.add_argument('-stepsec', metavar='sec', dest='stepSec', type=float,
                         default=0.05, help='How many seconds between server steps.')
+    parser.add_argument('-lockstep', dest='lockstep', action='store_true',
+                        default=False, help='Step as soon as every alive robot has sent endTurnRequest or used all '
+                        '-msgperstep messages. -stepsec is then the longest a step waits.')
+    parser.add_argument('-adaptstep', dest='adaptStepSec', action='store_true',
+                        default=False, help='Adjust -stepsec during play so robots miss about -adaptmiss of steps.')
+    parser.add_argument('-adaptmiss', metavar='float', dest='adaptMissRate', type=float,
+                        default=0.05, help='Target fraction of steps robots miss with -adaptstep.')
+    parser.add_argument('-adaptsteps', metavar='int', dest='adaptSteps', type=int,
+                        default=100, help='Game steps between -adaptstep adjustments.')
+    parser.add_argument('-stepsecmin', metavar='sec', dest='stepSecMin', type=float,
+                        default=0.001, help='Shortest step -adaptstep may use.')
+    parser.add_argument('-stepsecmax', metavar='sec', dest='stepSecMax', type=float,
+                        default=0.1, help='Longest step -adaptstep may use.')
     parser.add_argument('-stepmax', metavar='int', dest='stepMax', type=int,
                         default=1000, help='Max steps in one game.')
     parser.add_argument('-droprate', metavar='int', dest='dropRate', type=int,
@@ -961,6 +2164,21 @@ def main():
                         default=False, help='Only print the scoreboard when the server quits.')
     parser.add_argument('-jsonsb', metavar='filename', dest='jsonScoreboard', type=str,
                         default=False, help='Save json formatted server data to filename before quiting.')
+    parser.add_argument('-seed', metavar='int', dest='seed', type=int,
+                        default=None, help='Random seed for obstacles, jam zones and start locations. Arena n uses seed + n.')
+    parser.add_argument('-record', metavar='filename', dest='record', type=str,
+                        default=None, help='Record all bot messages to filename so the games can be replayed.')
+    parser.add_argument('-replay', metavar='filename', dest='replay', type=str,
+                        default=None, help='Replay a recording made with -record, log the scoreboard, and quit.')
+    parser.add_argument('-collisioniters', dest='collisionMaxIterations', type=int, min=1, max=1000, action=Range,
+                        default=50, help='Max collision solver iterations per step.')
+    parser.add_argument('-idle', dest='idlePolicy', type=str, choices=['off', 'jump', 'fast'],
+                        default='off', help='When no bot moves, turns, fires or sets anything for -idlesteps steps: '
+                        'jump the game to stepMax, or play the steps fast with no pacing.')
+    parser.add_argument('-idlesteps', metavar='int', dest='idleMinSteps', type=int,
+                        default=50, help='Steps with nothing happening before a game is idle (see -idle).')
+    parser.add_argument('-engine', dest='engine', type=str, choices=['python', 'numpy'],
+                        default='python', help='Step engine. numpy moves all bots at once and requires numpy. Arenas with fewer than 128 bots always use python.')
     parser.add_argument('-debug', dest='debug', action='store_true',
                         default=False, help='Print DEBUG level log messages.')
     parser.add_argument('-verbose', dest='verbose', action='store_true',
@@ -968,92 +2186,43 @@ def main():
     args = parser.parse_args()
 
     setLogLevel(args.debug, args.verbose)
-    d.conf['serverName'] = args.serverName
-    d.conf['gamesToPlay'] = args.gamesToPlay
-    d.conf['botsInGame'] = args.botsInGame
-    d.conf['stepSec'] = args.stepSec
-    d.conf['stepMax'] = args.stepMax
-    d.conf['dropRate'] = args.dropRate
-    d.state['dropNext'] = args.dropRate
-    d.conf['botMsgsPerStep'] = args.botMsgsPerStep
-    d.conf['arenaSize'] = args.arenaSize
-    d.conf['botRadius'] = args.botRadius
-    d.conf['explRadius'] = args.explRadius
-    d.conf['botMaxSpeed'] = args.botMaxSpeed
-    d.conf['botAccRate'] = args.botAccRate
-    d.conf['shellSpeed'] = args.shellSpeed
-    d.conf['hitDamage'] = args.hitDamage
-    d.conf['explDamage'] = args.explDamage
-    d.conf['obstacleRadius'] = args.obstacleRadius
-    d.conf['obstacles'] = mkObstacles(d, args.obstacles)
-    d.conf['jamZones'] = mkJamZones(d, args.jamZones)
-    d.conf['allowClasses'] = args.allowClasses
-    d.conf['simpleCollisions'] = args.simpleCollisions
-    d.conf['startPermutations'] = args.startPermutations
-    d.conf['scanMaxDistance'] = args.scanMaxDistance
-    d.conf['noViewers'] = args.noViewers
-    d.conf['maxSecsToJoin'] = args.maxSecsToJoin
-    d.state['onlyLastSb'] = args.onlyLastSb
-    d.state['jsonScoreboard'] = args.jsonScoreboard
 
-    mkStartLocations(d)
+    args.arenaArgs = None
+    if args.arenaConf:
+        args.arenaArgs = loadArenaArgs(parser, args)
 
-    log("Server Name: " + d.conf['serverName'])
-    log("Server Version: " + d.conf['serverVersion'])
-    log("Argument List:" + str(sys.argv))
+    if any(a.engine == 'numpy' for a in args.arenaArgs or [args]) and not nbnp.available():
+        log("The numpy step engine was requested but numpy is not installed.", "FAILURE")
+        exit()
 
-    log("Server Configuration: " + str(d.conf), "VERBOSE")
+    if args.workers == 0:
+        args.workers = os.cpu_count() or 1
+    args.workers = max(1, min(args.workers, args.arenas))
+    if args.arenas > args.workers * maxArenasPerProcess:
+        args.workers = math.ceil(args.arenas / maxArenasPerProcess)
+        log("At most " + str(maxArenasPerProcess) + " arenas can run in one process. Using " +
+            str(args.workers) + " workers.", "WARNING")
 
-    try:
-        d.srvSocket = nbipc.NetBotSocket(args.serverIP, args.serverPort)
-    except Exception as e:
-        log(str(e), "FAILURE")
-        quit()
+    log("Server Name: " + args.serverName)
+    log("Server Version: " + SrvData.conf['serverVersion'])
+    log("Argument List:" + str(sys.argv))
 
-    nextStepAt = time.perf_counter() + d.conf['stepSec']
-    while True:
-        aliveBots = 0
-        for src, bot in d.bots.items():
-            if bot['health'] != 0:
-                aliveBots += 1
-
-        # only count slow steps if we actually process a step this time around.
-        countSlowStep = False
-
-        if aliveBots > 0:  # if there is an ongoing game
-            countSlowStep = True
-            step(d)
-        elif len(d.bots) == d.conf['botsInGame']:  # if we have enough bots to start playing
-            if not d.state['tourStartTime']:
-                d.state['tourStartTime'] = time.time()
-
-            if d.conf['gamesToPlay'] != d.state['gameNumber']:
-                if not d.state['onlyLastSb']:
-                    logScoreboard(d)
-                initGame(d)
-            else:
-                log("All games have been played.")
-                jsonScoreboard(d)
-                quit()
-        elif d.conf['maxSecsToJoin'] < float(time.time() - d.state['startTime']): 
-            log("Not enough bots joined game before max seconds to join ( " + d.conf['maxSecsToJoin'] + " sec). Exiting.", "ERROR")
+    if args.replay:
+        try:
+            d = replayRecording(args.replay, args.onlyLastSb)
+        except Exception as e:
+            log(str(e), "FAILURE")
             exit()
+        logScoreboard(d)
+        if args.jsonScoreboard:
+            d.state['jsonScoreboard'] = args.jsonScoreboard
+            jsonScoreboard(d)
+    elif args.workers == 1:
+        runArenas(args, list(range(args.arenas)))
+    else:
+        runSupervisor(args)
 
-        recvReplyMsgs(d)
-
-        sendToViwers(d)
-
-        ptime = time.perf_counter()
-        if ptime < nextStepAt:
-            d.state['sleepCount'] += 1
-            d.state['sleepTime'] += nextStepAt - ptime
-            while ptime < nextStepAt:
-                ptime = time.perf_counter()
-        elif countSlowStep:
-            d.state['longStepCount'] += 1
-            log("Server running slower than " + str(d.conf['stepSec']) + " sec/step.", "VERBOSE")
-
-        nextStepAt = ptime + d.conf['stepSec']
+    log("Quiting", "INFO")
 
 
 if __name__ == "__main__":
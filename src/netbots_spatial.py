@@ -0,0 +1,275 @@
+import math
+from bisect import bisect_left
+from bisect import bisect_right
+
+import netbots_math as nbmath
+
+"""
+**About Spatial Indexes**
+
+The functions and classes in this module speed up finding things that are close to
+each other in the arena. They divide the arena into a uniform grid of square cells and
+only compare things that are in the same or neighbouring cells, rather than comparing
+everything with everything.
+
+closePairs() is for things that move, like bots, and builds a new grid each time it is
+called. CircleGrid is for circles that never move, like obstacles, and is built once.
+
+AngularIndex is not a grid. It sorts the bearings from one point to many others so the
+nearest point inside a wedge of angles (a scan) can be found without testing every point.
+
+PointGrid, dartThrow() and poissonDisk() place points that must not be too close to
+each other, like the start locations of bots.
+"""
+
+
+def cellOf(x, y, cellSize):
+    """ Return (column, row) of grid cell that contains point (x,y). """
+    return (math.floor(x / cellSize), math.floor(y / cellSize))
+
+
+def closePairs(points, maxDistance):
+    """
+    points is a list of (key, x, y).
+    Return list of all pairs [key, key] of points that are maxDistance or closer to each other.
+
+    Uses a spatial hash with cells maxDistance wide, so only points in the same or
+    neighbouring cells need to be compared. Each pair is returned once with keys in the
+    same order they appear in points.
+    """
+    if maxDistance <= 0:
+        return []
+
+    grid = {}
+    for i in range(len(points)):
+        cell = cellOf(points[i][1], points[i][2], maxDistance)
+        if cell in grid:
+            grid[cell].append(i)
+        else:
+            grid[cell] = [i]
+
+    pairs = []
+    for (cx, cy), cellPoints in grid.items():
+        # Compare points within this cell.
+        for a in range(len(cellPoints) - 1):
+            i = cellPoints[a]
+            for b in range(a + 1, len(cellPoints)):
+                j = cellPoints[b]
+                if nbmath.distance(points[i][1], points[i][2], points[j][1], points[j][2]) <= maxDistance:
+                    pairs.append((i, j))
+
+        # Compare with half of the neighbouring cells so each pair of cells is only visited once.
+        for neighbour in ((cx + 1, cy - 1), (cx + 1, cy), (cx + 1, cy + 1), (cx, cy + 1)):
+            if neighbour not in grid:
+                continue
+            for i in cellPoints:
+                for j in grid[neighbour]:
+                    if nbmath.distance(points[i][1], points[i][2], points[j][1], points[j][2]) <= maxDistance:
+                        pairs.append((min(i, j), max(i, j)))
+
+    # Return pairs in the same order a full pairwise scan of points would find them.
+    pairs.sort()
+    return [[points[i][0], points[j][0]] for i, j in pairs]
+
+
+class CircleGrid:
+    """
+    Index of circles that do not move, such as obstacles. Each circle is stored in every
+    grid cell that its bounding box touches, so finding the circles near a point or line
+    segment only looks at the few cells around it rather than at every circle.
+
+    Queries return candidates, circles whose bounding box touches the query box, in the
+    order they were added. Callers still do their own exact distance or intersection test.
+    """
+
+    # Boxes are padded by this much so rounding can never hide a circle that just touches.
+    pad = 1e-6
+
+    def __init__(self, circles, cellSize):
+        """
+        circles is a list of circles: [{'x': x, 'y': y, 'radius': r}, ...]. The grid keeps
+        a reference to this list and add() appends to it.
+        """
+        self.circles = circles
+        self.cellSize = cellSize
+        self.grid = {}  # {(column, row): [index, ...], ...}
+        self.indexed = 0  # Number of circles in self.circles that have been added to the grid.
+        for i in range(len(circles)):
+            self.insert(i)
+
+    def matches(self, circles):
+        """ Returns True if this grid indexes all of circles (the same list it was built from). """
+        return self.circles is circles and self.indexed == len(circles)
+
+    def add(self, circle):
+        """ Append circle to self.circles and add it to the grid. """
+        self.circles.append(circle)
+        self.insert(len(self.circles) - 1)
+
+    def insert(self, i):
+        c = self.circles[i]
+        for cell in self.cellsInBox(c['x'] - c['radius'], c['y'] - c['radius'],
+                                    c['x'] + c['radius'], c['y'] + c['radius']):
+            if cell in self.grid:
+                self.grid[cell].append(i)
+            else:
+                self.grid[cell] = [i]
+        self.indexed += 1
+
+    def cellsInBox(self, x1, y1, x2, y2):
+        """ Return list of (column, row) of all cells that touch box from (x1,y1) to (x2,y2) where x1 <= x2 and y1 <= y2. """
+        c1, r1 = cellOf(x1 - self.pad, y1 - self.pad, self.cellSize)
+        c2, r2 = cellOf(x2 + self.pad, y2 + self.pad, self.cellSize)
+        return [(c, r) for c in range(c1, c2 + 1) for r in range(r1, r2 + 1)]
+
+    def indexesInBox(self, x1, y1, x2, y2):
+        """ Return sorted list of indexes into self.circles of circles that may touch box from (x1,y1) to (x2,y2). """
+        if not self.grid:
+            return []
+        found = set()
+        for cell in self.cellsInBox(x1, y1, x2, y2):
+            if cell in self.grid:
+                found.update(self.grid[cell])
+        return sorted(found)
+
+    def near(self, x, y, distance):
+        """ Return list of circles that may be distance or closer to point (x,y). """
+        return [self.circles[i] for i in self.indexesInBox(x - distance, y - distance, x + distance, y + distance)]
+
+    def indexesNearSegment(self, x1, y1, x2, y2):
+        """ Return sorted list of indexes into self.circles of circles that may touch line segment (x1,y1) to (x2,y2). """
+        return self.indexesInBox(min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+
+    def nearSegment(self, x1, y1, x2, y2):
+        """ Return list of circles that may touch line segment (x1,y1) to (x2,y2). """
+        return [self.circles[i] for i in self.indexesNearSegment(x1, y1, x2, y2)]
+
+
+class AngularIndex:
+    """
+    Bearings and distances from one point to many other points, sorted by bearing. The
+    nearest point inside a wedge of angles is found with a bisect at each end of the wedge
+    and a min() of the distances in between.
+    """
+
+    def __init__(self, x, y, points, maxDistance):
+        """
+        Index points, a list of (x, y), as seen from (x, y). Points further than maxDistance,
+        or at distance 0, are left out.
+        """
+        found = []
+        for px, py in points:
+            dis = nbmath.distance(x, y, px, py)
+            if dis != 0 and dis <= maxDistance:
+                found.append((nbmath.angle(x, y, px, py), dis))
+        found.sort()
+        self.angles = [a for a, dis in found]
+        self.distances = [dis for a, dis in found]
+
+    def nearest(self, startRad, endRad):
+        """
+        Return distance to the nearest point with a bearing between startRad and counter
+        clockwise to endRad, or 0 if there are none. Angles on the edges of the wedge are
+        included, the same as nbmath.contains().
+        """
+        lo = bisect_left(self.angles, startRad)
+        hi = bisect_right(self.angles, endRad)
+
+        if startRad >= endRad:  # if we are scanning clockwise over 0 radians.
+            found = []
+            if lo < len(self.angles):
+                found.append(min(self.distances[lo:]))
+            if hi > 0:
+                found.append(min(self.distances[:hi]))
+            return min(found) if found else 0
+        elif lo < hi:
+            return min(self.distances[lo:hi])
+        return 0
+
+
+class PointGrid:
+    """
+    Points that must all be more than minDistance apart. Cells are minDistance wide so a
+    new point only needs to be compared with points in the same and neighbouring cells.
+    """
+
+    def __init__(self, minDistance):
+        self.minDistance = minDistance
+        self.grid = {}  # {(column, row): [(x, y), ...], ...}
+        self.points = []  # [(x, y), ...] in the order they were added.
+
+    def isClear(self, x, y):
+        """ Return True if (x,y) is more than minDistance from every point in the grid. """
+        cx, cy = cellOf(x, y, self.minDistance)
+        for c in range(cx - 1, cx + 2):
+            for r in range(cy - 1, cy + 2):
+                for px, py in self.grid.get((c, r), ()):
+                    if nbmath.distance(x, y, px, py) <= self.minDistance:
+                        return False
+        return True
+
+    def add(self, x, y):
+        cell = cellOf(x, y, self.minDistance)
+        if cell in self.grid:
+            self.grid[cell].append((x, y))
+        else:
+            self.grid[cell] = [(x, y)]
+        self.points.append((x, y))
+
+
+def dartThrow(n, x1, y1, x2, y2, minDistance, rng, isFree=None, attempts=100):
+    """
+    Return list of up to n random points (x, y) inside box (x1,y1) to (x2,y2) that are all
+    more than minDistance apart and for which isFree(x, y) is True. Each point is tried up
+    to attempts times, so fewer than n points are returned if the box is nearly full.
+    rng is a random.Random.
+    """
+    grid = PointGrid(minDistance)
+    for i in range(n):
+        for a in range(attempts):
+            x = x1 + rng.random() * (x2 - x1)
+            y = y1 + rng.random() * (y2 - y1)
+            if grid.isClear(x, y) and (isFree is None or isFree(x, y)):
+                grid.add(x, y)
+                break
+        else:
+            break
+    return grid.points
+
+
+def poissonDisk(x1, y1, x2, y2, minDistance, rng, isFree=None, k=30, ring=1.0):
+    """
+    Return list of points (x, y) inside box (x1,y1) to (x2,y2) that are all more than
+    minDistance apart and for which isFree(x, y) is True, using Bridson's Poisson disk
+    sampling. New points are tried in a ring minDistance to minDistance * (1 + ring)
+    around existing ones, k times each, so the box is filled even when random darts
+    would rarely land in the gaps. A smaller ring packs points more densely but less
+    randomly. rng is a random.Random.
+    """
+    grid = PointGrid(minDistance)
+    r = minDistance * (1 + 1e-9)  # points exactly minDistance apart would overlap.
+
+    def tryAdd(x, y):
+        if x1 <= x <= x2 and y1 <= y <= y2 and grid.isClear(x, y) and (isFree is None or isFree(x, y)):
+            grid.add(x, y)
+            return True
+        return False
+
+    # Seed from random darts so areas cut off from each other by obstacles are all filled.
+    for seed in range(k):
+        if not tryAdd(x1 + rng.random() * (x2 - x1), y1 + rng.random() * (y2 - y1)):
+            continue
+        active = [grid.points[-1]]
+        while active:
+            i = rng.randrange(len(active))
+            ax, ay = active[i]
+            for j in range(k):
+                angle = rng.random() * 2 * math.pi
+                dis = r * (1 + rng.random() * ring)
+                if tryAdd(ax + math.cos(angle) * dis, ay + math.sin(angle) * dis):
+                    active.append(grid.points[-1])
+                    break
+            else:
+                active[i] = active[-1]
+                active.pop()
+    return grid.points
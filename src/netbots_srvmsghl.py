@@ -3,7 +3,7 @@ import re
 import copy
 
 from netbots_log import log
-import netbots_math as nbmath
+import netbots_spatial as nbspatial
 
 
 def joinRequest(d, msg, src):
@@ -31,11 +31,13 @@ def joinRequest(d, msg, src):
         d.bots[src]['name'] = msg['name']
         if 'class' in msg:
             d.bots[src]['class'] = msg['class']
+        # resolve class values now so the step loop does not have to.
+        d.getClassParams(d.bots[src]['class'])
         d.startBots.append(src)
         result = "OK"
         log("Bot joined game: " + d.bots[src]['name'] + " (" + src + ")")
 
-    log("Bots in Game: " + str(d.bots), "VERBOSE")
+    log(lambda: "Bots in Game: " + str(d.bots), "VERBOSE")
 
     if result == "OK":
         return {'type': "joinReply", 'conf': d.conf}
@@ -80,6 +82,7 @@ def setSpeedRequest(d, msg, src):
         return {'type': 'Error', 'result': "Can't process setSpeedRequest when health == 0"}
     else:
         d.bots[src]['requestedSpeed'] = msg['requestedSpeed']
+        d.botChanged(src)
         return {
             'type': "setSpeedReply",
         }
@@ -101,6 +104,7 @@ def setDirectionRequest(d, msg, src):
         return {'type': 'Error', 'result': "Can't process setDirectionRequest when health == 0"}
     else:
         d.bots[src]['requestedDirection'] = msg['requestedDirection']
+        d.botChanged(src)
         return {
             'type': "setDirectionReply"
         }
@@ -143,25 +147,15 @@ def scanRequest(d, msg, src):
     if d.bots[src]['health'] == 0:
         return {'type': 'Error', 'result': "Can't process ScanRequest when health == 0"}
     else:
-        distance = 0
-        bot = d.bots[src]
-        for src2, bot2 in d.bots.items():
-            if src != src2 and bot2['health'] != 0:
-                # don't detect bot2 if it's fully inside a jam Zone.
-                jammed = False
-                for jz in d.conf['jamZones']:
-                    if nbmath.distance(bot2['x'], bot2['y'], jz['x'], jz['y']) + d.conf['botRadius'] < jz['radius']:
-                        jammed = True
-
-                if not jammed:
-                    dis = nbmath.contains(bot['x'], bot['y'], msg['startRadians'],
-                                          msg['endRadians'], bot2['x'], bot2['y'])
-                    
-                    if dis <= d.conf['scanMaxDistance'] and dis != 0:
-                        if distance == 0:
-                            distance = dis
-                        elif dis < distance:
-                            distance = dis
+        # Bots do not move between steps so identical scans in the same step get the same reply.
+        key = (src, msg['startRadians'], msg['endRadians'])
+        if key in d.scanResults:
+            distance = d.scanResults[key]
+        else:
+            if src not in d.scanIndexes:
+                d.scanIndexes[src] = mkScanIndex(d, src)
+            distance = d.scanIndexes[src].nearest(msg['startRadians'], msg['endRadians'])
+            d.scanResults[key] = distance
         
         d.bots[src]['last']['scanRequest'] = {'startRadians': msg['startRadians'], 'endRadians': msg['endRadians']}
 
@@ -171,6 +165,28 @@ def scanRequest(d, msg, src):
         }
 
 
+def mkScanIndex(d, src):
+    """
+    Return nbspatial.AngularIndex of all bots that bot src can detect with a scan this step.
+    """
+    bot = d.bots[src]
+    points = []
+    for src2, bot2 in d.bots.items():
+        # don't detect bot2 if it's dead or fully inside a jam Zone.
+        if src != src2 and bot2['health'] != 0 and src2 not in d.jammedBots:
+            points.append((bot2['x'], bot2['y']))
+    return nbspatial.AngularIndex(bot['x'], bot['y'], points, d.conf['scanMaxDistance'])
+
+
+def endTurnRequest(d, msg, src):
+    # Dead bots have no turn to end but may still send this, so it is never an error.
+    if d.bots[src]['health'] != 0:
+        d.endedTurns.add(src)
+    return {
+        'type': "endTurnReply"
+    }
+
+
 def addViewerRequest(d, msg, src):
     if d.conf['noViewers']:
         return {'type': 'Error', 'result': "Viewers are not allowed to join."}
@@ -0,0 +1,96 @@
+import math
+import time
+
+"""
+**About Timers**
+
+TimeHistogram keeps a fixed size histogram of durations so the server can report the
+median (p50), 99th percentile (p99) and max time of each part of a step over a whole
+tournament without storing every sample.
+
+Buckets are spaced logarithmically: each power of 2 seconds is split into subBuckets
+buckets, so a percentile is reported within about 1/subBuckets (12.5%) of the real value.
+Durations below 2**minExp secs (about 2 microseconds) are counted in the first bucket and
+durations of 2**maxExp secs (128 secs) or more in the last.
+"""
+
+minExp = -19
+maxExp = 7
+subBuckets = 8
+bucketCount = (maxExp - minExp) * subBuckets
+
+
+def bucketOf(secs):
+    """ Return index of bucket that holds duration secs. """
+    if secs <= 0:
+        return 0
+    m, e = math.frexp(secs)  # secs == m * 2**e and 0.5 <= m < 1
+    i = (e - 1 - minExp) * subBuckets + int((m * 2 - 1) * subBuckets)
+    return min(max(i, 0), bucketCount - 1)
+
+
+def bucketTop(i):
+    """ Return the upper edge of bucket i in secs. """
+    e, s = divmod(i, subBuckets)
+    return math.ldexp(1 + (s + 1) / subBuckets, e + minExp)
+
+
+class TimeHistogram:
+    """ Count, total, max and a bounded histogram of durations in seconds. """
+
+    def __init__(self):
+        self.counts = [0] * bucketCount
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, secs):
+        """ Add one duration of secs. """
+        self.counts[bucketOf(secs)] += 1
+        self.count += 1
+        self.total += secs
+        if secs > self.max:
+            self.max = secs
+
+    def lap(self, startTime, now=None):
+        """
+        Add the time from startTime to now (time.perf_counter()) and return now, so the
+        next phase can be timed from where this one ended.
+        """
+        if now is None:
+            now = time.perf_counter()
+        self.add(now - startTime)
+        return now
+
+    def merge(self, other):
+        """ Add all durations counted by other, another TimeHistogram, to this one. """
+        for i in range(bucketCount):
+            self.counts[i] += other.counts[i]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """ Return duration that p percent (0 to 100) of durations are less than or equal to. 0 if empty. """
+        if self.count == 0:
+            return 0.0
+        needed = self.count * p / 100.0
+        seen = 0
+        for i in range(bucketCount):
+            seen += self.counts[i]
+            if seen >= needed and seen > 0:
+                if i == bucketCount - 1:  # The last bucket has no upper edge.
+                    return self.max
+                return min(bucketTop(i), self.max)
+        return self.max
+
+    def asDict(self):
+        """ Return summary of this histogram as a json friendly dict. """
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max
+            }
@@ -0,0 +1,227 @@
+import os
+import sys
+import math
+import copy
+import json
+import random
+import argparse
+import platform
+import time
+
+# include the netbot src directory in sys.path so we can import modules from it.
+robotpath = os.path.dirname(os.path.abspath(__file__))
+srcpath = os.path.join(os.path.dirname(robotpath), "src")
+sys.path.insert(0, srcpath)
+
+import netbots_server as nbsrv
+import netbots_srvmsghl as nbmsghl
+import netbots_npengine as nbnp
+import netbots_timers as nbtimers
+from netbots_log import setLogLevel
+from netbots_log import log
+
+"""
+Benchmarks of the server step engine with synthetic load.
+
+Each scenario builds a SrvData directly (no sockets, no robots) and plays a number of
+steps. Every step some bots change speed and direction, some fire, and some scan. step()
+is timed by the server's own phase timers (SrvData.timers) and each scanRequest() is timed
+here. All random choices are seeded so every run of a scenario does the same work.
+
+    python test/benchmarks.py -save before.json
+    ... change the server ...
+    python test/benchmarks.py -baseline before.json
+
+With -baseline the exit code is 1 if the mean time of any compared timer is more than
+-tolerance slower than the baseline.
+"""
+
+benchmarkVersion = 1
+
+# Timers saved for each scenario. 'scan' is timed by this script, the others are SrvData.timers.
+savedTimers = ('step', 'move', 'collisions', 'collideWalls', 'collideObstacles', 'collideBots', 'shells',
+               'explosions', 'scan')
+
+# Timers compared with the baseline.
+comparedTimers = ('step', 'collisions', 'scan')
+
+
+def mkScenario(name, bots, fireRate=0.05, obstacles=0, jamZones=0, simpleCollisions=False, botClass=None,
+               engine='python'):
+    """
+    Return a scenario dict. fireRate is the chance each step that an alive bot with no shell in
+    flight fires. If botClass is None then bots cycle through every robot class.
+    """
+    return {'name': name, 'bots': bots, 'fireRate': fireRate, 'obstacles': obstacles, 'jamZones': jamZones,
+            'simpleCollisions': simpleCollisions, 'botClass': botClass, 'engine': engine}
+
+
+def mkScenarios():
+    scenarios = []
+    for n in [4, 16, 64, 128, 256, 1024]:
+        scenarios.append(mkScenario("bots" + str(n), n))
+    scenarios.append(mkScenario("bots64-noshells", 64, fireRate=0))
+    scenarios.append(mkScenario("bots64-manyshells", 64, fireRate=0.5))
+    scenarios.append(mkScenario("bots64-obstacles", 64, obstacles=20, jamZones=10))
+    scenarios.append(mkScenario("bots256-obstacles", 256, obstacles=100, jamZones=40))
+    scenarios.append(mkScenario("bots64-simplecollisions", 64, simpleCollisions=True))
+    for c in nbsrv.SrvData.conf['classes'].keys():
+        scenarios.append(mkScenario("bots64-" + c, 64, botClass=c))
+    if nbnp.available():
+        for n in [128, 256, 1024]:
+            scenarios.append(mkScenario("bots" + str(n) + "-numpy", n, engine='numpy'))
+    return scenarios
+
+
+def mkArena(scenario, rnd):
+    """ Return a SrvData with scenario's bots joined and the first game started. """
+    n = scenario['bots']
+    d = nbsrv.SrvData()
+    d.rng.seed(rnd.random())
+    d.conf['botsInGame'] = n
+    d.conf['gamesToPlay'] = 100000
+    d.conf['stepMax'] = 1000000
+    # Keep about 16 bots per 1000x1000 and obstacles the same size in every arena.
+    d.conf['arenaSize'] = min(32767, max(1000, int(1000 * math.sqrt(n / 16))))
+    d.conf['obstacleRadius'] = 5 * 1000 / d.conf['arenaSize']
+    d.conf['obstacles'] = nbsrv.mkObstacles(d, scenario['obstacles'])
+    d.conf['jamZones'] = nbsrv.mkJamZones(d, scenario['jamZones'])
+    d.conf['allowClasses'] = True
+    d.conf['simpleCollisions'] = scenario['simpleCollisions']
+    d.conf['noViewers'] = True
+    d.state['engine'] = scenario['engine']
+    d.compileClassParams()
+
+    classes = list(d.conf['classes'].keys())
+    for i in range(n):
+        src = "127.0.0.1:" + str(20000 + i)
+        d.bots[src] = copy.deepcopy(d.botTemplate)
+        d.bots[src]['name'] = "bot" + str(i)
+        d.bots[src]['class'] = scenario['botClass'] or classes[i % len(classes)]
+        d.startBots.append(src)
+
+    nbsrv.mkStartLocations(d)
+    nbsrv.initGame(d)
+    return d
+
+
+def runScenario(scenario, steps, seed=1):
+    """ Play steps steps of scenario and return its results dict. """
+    rnd = random.Random(seed)
+    d = mkArena(scenario, rnd)
+    scanTimer = nbtimers.TimeHistogram()
+    scanWidth = math.pi / 8
+
+    startTime = time.perf_counter()
+    for s in range(steps):
+        alive = [src for src, bot in d.bots.items() if bot['health'] != 0]
+        if len(alive) <= 1:
+            nbsrv.initGame(d)
+            alive = list(d.bots.keys())
+
+        for src in alive:
+            if rnd.random() < 0.05:
+                nbsrv.processMsg(d, {'type': 'setDirectionRequest', 'requestedDirection': rnd.random() * 2 * math.pi}, src)
+                nbsrv.processMsg(d, {'type': 'setSpeedRequest', 'requestedSpeed': rnd.choice([0, 50, 100])}, src)
+            if src not in d.shells and rnd.random() < scenario['fireRate']:
+                nbsrv.processMsg(d, {'type': 'fireCanonRequest', 'direction': rnd.random() * 2 * math.pi,
+                                     'distance': rnd.random() * 500 + 50}, src)
+
+        # Up to 32 bots do a full sweep of scans each step.
+        for src in rnd.sample(alive, min(32, len(alive))):
+            start = rnd.random() * 2 * math.pi
+            for i in range(4):
+                msg = {'type': 'scanRequest', 'startRadians': (start + i * scanWidth) % (2 * math.pi),
+                       'endRadians': (start + (i + 1) * scanWidth) % (2 * math.pi)}
+                t = time.perf_counter()
+                nbmsghl.scanRequest(d, msg, src)
+                scanTimer.lap(t)
+
+        nbsrv.step(d)
+    runTime = time.perf_counter() - startTime
+
+    result = {name: d.timers[name].asDict() for name in savedTimers if name in d.timers}
+    result['scan'] = scanTimer.asDict()
+    result['stepsPerSec'] = steps / max(1e-9, d.timers['step'].total)
+    result['runTime'] = runTime
+    result['games'] = d.state['gameNumber']
+    return result
+
+
+def compareResults(results, baseline, tolerance):
+    """
+    Log the change in mean time of comparedTimers of each scenario in both results and
+    baseline. Return list of (scenario, timer) that are more than tolerance slower.
+    """
+    regressions = []
+    log(f"{'Scenario':>26}  {'Timer':>10}  {'Base(ms)':>10}  {'Now(ms)':>10}  {'Change':>8}")
+    for name, result in results['scenarios'].items():
+        if name not in baseline['scenarios']:
+            log(f"{name:>26}  not in baseline")
+            continue
+        for timer in comparedTimers:
+            base = baseline['scenarios'][name][timer]['mean']
+            now = result[timer]['mean']
+            if base == 0:
+                continue
+            change = (now - base) / base
+            flag = ""
+            if change > tolerance:
+                regressions.append((name, timer))
+                flag = "  REGRESSION"
+            log(f"{name:>26}  {timer:>10}  {base * 1000:>10.4f}  {now * 1000:>10.4f}  {change * 100:>7.1f}%" + flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-steps', metavar='int', dest='steps', type=int,
+                        default=2000, help='Steps to play in each scenario.')
+    parser.add_argument('-only', metavar='str', dest='only', type=str,
+                        default=None, help='Only run scenarios with this in their name.')
+    parser.add_argument('-save', metavar='filename', dest='save', type=str,
+                        default=None, help='Save results as json to filename.')
+    parser.add_argument('-baseline', metavar='filename', dest='baseline', type=str,
+                        default=None, help='Compare results with json saved earlier by -save.')
+    parser.add_argument('-tolerance', metavar='float', dest='tolerance', type=float,
+                        default=0.25, help='Fraction slower than baseline that is a regression.')
+    args = parser.parse_args()
+
+    # Game start logs and such are not interesting here.
+    setLogLevel(False, False)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('version') != benchmarkVersion:
+            log(args.baseline + " is not a version " + str(benchmarkVersion) + " benchmark file.", "FAILURE")
+            exit(2)
+
+    results = {'version': benchmarkVersion, 'python': platform.python_version(), 'steps': args.steps,
+               'time': time.time(), 'scenarios': {}}
+    for scenario in mkScenarios():
+        if args.only and args.only not in scenario['name']:
+            continue
+        result = runScenario(scenario, args.steps)
+        results['scenarios'][scenario['name']] = result
+        log(f"{scenario['name']:>26}: {result['stepsPerSec']:>9.1f} steps/sec" +
+            f"  step p50 {result['step']['p50'] * 1000:.3f} ms  p99 {result['step']['p99'] * 1000:.3f} ms" +
+            f"  collisions {result['collisions']['mean'] * 1000:.3f} ms  scan {result['scan']['mean'] * 1000:.4f} ms")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1)
+        log("Saved results to " + args.save)
+
+    if baseline:
+        regressions = compareResults(results, baseline, args.tolerance)
+        if regressions:
+            log(str(len(regressions)) + " timers are more than " + str(args.tolerance * 100) +
+                "% slower than " + args.baseline, "ERROR")
+            exit(1)
+        log("No regressions compared to " + args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,13 @@
+import io
 import os
 import sys
 import math
+import time
+import copy
+import random
+import itertools
+import asyncio
+import contextlib
 
 # include the netbot src directory in sys.path so we can import modules from it.
 robotpath = os.path.dirname(os.path.abspath(__file__))
@@ -10,6 +17,10 @@ sys.path.insert(0, srcpath)
 import netbots_server as nbsrv
 import netbots_ipc as nbipc
 import netbots_math as nbmath
+import netbots_npengine as nbnp
+import netbots_headless as nbheadless
+import netbots_timers as nbtimers
+import netbots_log as nblog
 from netbots_log import setLogLevel
 from netbots_log import log
 
@@ -84,8 +95,953 @@ def testHitSeverity():
     if round(nbsrv.getHitSeverity(d,b1, math.pi, b2),8) != round(0,8):
         log("test 19 failed","ERROR")
 
+def mkTestBots(d, n, seed=1):
+    """ Return a dict of n alive bots with random location, speed and direction. """
+    rnd = random.Random(seed)
+    bots = {}
+    classes = list(d.conf['classes'].keys())
+    for i in range(n):
+        bot = copy.deepcopy(d.botTemplate)
+        bot['name'] = "bot" + str(i)
+        bot['class'] = classes[i % len(classes)]
+        bot['health'] = 100
+        bot['x'] = rnd.random() * d.conf['arenaSize']
+        bot['y'] = rnd.random() * d.conf['arenaSize']
+        bot['currentSpeed'] = rnd.choice([0, 0, 50, 100, rnd.random() * 100])
+        bot['requestedSpeed'] = rnd.choice([0, 100, rnd.random() * 100])
+        bot['currentDirection'] = rnd.random() * 2 * math.pi
+        bot['requestedDirection'] = rnd.choice([0, bot['currentDirection'], rnd.random() * 2 * math.pi])
+        bots['127.0.0.1:' + str(20000 + i)] = bot
+    return bots
+
+
+def testNumpyMoveBots():
+    if not nbnp.available():
+        log("numpy not installed, skipping numpy engine tests.", "WARNING")
+        return
+
+    d1 = nbsrv.SrvData()
+    d1.bots = mkTestBots(d1, 60)
+    d2 = nbsrv.SrvData()
+    d2.bots = copy.deepcopy(d1.bots)
+    d2.bots[list(d2.bots.keys())[0]]['health'] = 0
+    d1.bots[list(d1.bots.keys())[0]]['health'] = 0
+
+    for i in range(200):
+        aliveBots = {src: bot['health'] for src, bot in d1.bots.items() if bot['health'] != 0}
+        nbsrv.moveBots(d1, aliveBots)
+        nbnp.moveBots(d2, aliveBots)
+
+    for src in d1.bots:
+        for fld in ('x', 'y', 'currentSpeed', 'currentDirection'):
+            if abs(d1.bots[src][fld] - d2.bots[src][fld]) > 1e-6:
+                log("numpy moveBots test failed for " + src + " " + fld + ": " +
+                    str(d1.bots[src][fld]) + " != " + str(d2.bots[src][fld]), "ERROR")
+
+    # Play whole steps, with bots changed by messages, collisions and hit damage between
+    # moves, so the numpy engine's arrays must pick up changes made outside of it. Use
+    # the numpy engine even though there are fewer than nbnp.minBots bots.
+    minBots = nbnp.minBots
+    nbnp.minBots = 0
+    arenas = []
+    for engine in ('python', 'numpy'):
+        d = nbsrv.SrvData()
+        d.rng.seed(5)
+        d.conf['botsInGame'] = 16
+        d.conf['stepMax'] = 100000
+        d.state['engine'] = engine
+        for i in range(16):
+            src = "127.0.0.1:" + str(20000 + i)
+            d.bots[src] = copy.deepcopy(d.botTemplate)
+            d.startBots.append(src)
+        nbsrv.mkStartLocations(d)
+        nbsrv.initGame(d)
+        arenas.append(d)
+
+    rnd = random.Random(6)
+    for i in range(300):
+        msgs = []
+        for src in arenas[0].bots:
+            if rnd.random() < 0.1:
+                msgs.append(({'type': 'setDirectionRequest', 'requestedDirection': rnd.random() * 2 * math.pi}, src))
+                msgs.append(({'type': 'setSpeedRequest', 'requestedSpeed': rnd.choice([0, 50, 100])}, src))
+        for d in arenas:
+            for msg, src in msgs:
+                nbsrv.processMsg(d, dict(msg), src)
+            nbsrv.step(d)
+    nbnp.minBots = minBots
+
+    for src in arenas[0].bots:
+        for fld in ('x', 'y', 'currentSpeed', 'requestedSpeed', 'currentDirection', 'health'):
+            if abs(arenas[0].bots[src][fld] - arenas[1].bots[src][fld]) > 1e-6:
+                log("numpy step test failed for " + src + " " + fld + ": " +
+                    str(arenas[0].bots[src][fld]) + " != " + str(arenas[1].bots[src][fld]), "ERROR")
+                return
+    if arenas[0].state['gameNumber'] != 1 or arenas[1].npBots is None:
+        log("numpy step test failed, game ended early or numpy engine not used.", "ERROR")
+
+
+def testNumpyMoveShells():
+    if not nbnp.available():
+        return
+
+    d1 = nbsrv.SrvData()
+    d1.rng.seed(11)
+    d1.conf['obstacles'] = nbsrv.mkObstacles(d1, 6)
+    d1.bots = mkTestBots(d1, 60, seed=2)
+    d2 = nbsrv.SrvData()
+    d2.conf['obstacles'] = d1.conf['obstacles']
+    d2.bots = copy.deepcopy(d1.bots)
+
+    rnd = random.Random(4)
+    for i in range(100):
+        for src, bot in d1.bots.items():
+            if bot['health'] > 0 and src not in d1.shells and rnd.random() < 0.3:
+                shell = {'x': bot['x'], 'y': bot['y'], 'direction': rnd.random() * math.pi * 2,
+                         'distanceRemaining': rnd.choice([10, 75, rnd.random() * 1000])}
+                d1.shells[src] = shell
+                d2.shells[src] = dict(shell)
+        nbsrv.moveShells(d1)
+        nbnp.moveShells(d2)
+
+        if d1.shells != d2.shells or d1.explosions.live(0) != d2.explosions.live(0):
+            log("numpy moveShells test 1 failed, shells or explosions differ at step " + str(i), "ERROR")
+            return
+        for src in d1.bots:
+            for fld in ('health', 'shellDamage'):
+                if d1.bots[src][fld] != d2.bots[src][fld]:
+                    log("numpy moveShells test 2 failed for " + src + " " + fld + ": " +
+                        str(d1.bots[src][fld]) + " != " + str(d2.bots[src][fld]), "ERROR")
+                    return
+
+    if len(d1.explosions) == 0 or min(b['health'] for b in d1.bots.values()) != 0:
+        log("numpy moveShells test 3 failed, test did not explode shells or kill bots.", "ERROR")
+
+
+def testIntersectLineCircle():
+    # segment far from circle but on a line that passes through it.
+    if nbmath.intersectLineCircle(100, 1, 1000, 10, 0, 0, 10):
+        log("intersectLineCircle test 1 failed, far away segment intersects.", "ERROR")
+    # segments that pass through circle without an end inside it, nearly horizontal and nearly vertical.
+    if not nbmath.intersectLineCircle(-20, 0, 20, 0.1, 0, 0, 10):
+        log("intersectLineCircle test 2 failed.", "ERROR")
+    if not nbmath.intersectLineCircle(0, -20, 0.1, 20, 0, 0, 10):
+        log("intersectLineCircle test 3 failed.", "ERROR")
+
+
+def testCircleGrid():
+    d = nbsrv.SrvData()
+    d.conf['arenaSize'] = 4000
+    d.conf['obstacleRadius'] = 1
+    d.rng.seed(5)
+    d.conf['obstacles'] = nbsrv.mkObstacles(d, 100)
+    grid = d.getObstacleGrid()
+    if grid is not d.getObstacleGrid():
+        log("circle grid test 1 failed, grid was rebuilt.", "ERROR")
+
+    rnd = random.Random(6)
+    for i in range(2000):
+        x = rnd.random() * 4000
+        y = rnd.random() * 4000
+        brute = [o for o in d.conf['obstacles'] if nbmath.distance(x, y, o['x'], o['y']) <= 100 + o['radius']]
+        near = [o for o in grid.near(x, y, 100) if nbmath.distance(x, y, o['x'], o['y']) <= 100 + o['radius']]
+        if brute != near:
+            log("circle grid test 2 failed at " + str((x, y)), "ERROR")
+            break
+
+        x2, y2 = nbmath.project(x, y, rnd.random() * math.pi * 2, rnd.random() * 1200)
+        brute = [o for o in d.conf['obstacles'] if nbmath.intersectLineCircle(x, y, x2, y2, o['x'], o['y'], o['radius'])]
+        near = [o for o in grid.nearSegment(x, y, x2, y2) if nbmath.intersectLineCircle(x, y, x2, y2, o['x'], o['y'], o['radius'])]
+        if brute != near:
+            log("circle grid test 3 failed at " + str((x, y, x2, y2)), "ERROR")
+            break
+
+    d.conf['obstacles'] = d.conf['obstacles'][:10]
+    if d.getObstacleGrid() is grid or len(d.getObstacleGrid().circles) != 10:
+        log("circle grid test 4 failed, grid not rebuilt after obstacles changed.", "ERROR")
+
+
+def testJammedBots():
+    d = nbsrv.SrvData()
+    d.conf['jamZones'] = [{'x': 500, 'y': 500, 'radius': 50}, {'x': 100, 'y': 100, 'radius': 50}]
+    d.bots = mkTestBots(d, 3)
+    scanner, hider, other = list(d.bots.keys())
+    d.bots[scanner].update({'x': 800, 'y': 500})
+    d.bots[hider].update({'x': 510, 'y': 500})  # fully inside first jam zone.
+    d.bots[other].update({'x': 130, 'y': 100})  # only partly inside second jam zone.
+
+    d.jammedBots = nbsrv.findJammedBots(d)
+    if d.jammedBots != {hider}:
+        log("jammed bots test 1 failed, jammedBots = " + str(d.jammedBots), "ERROR")
+
+    scan = {'type': 'scanRequest', 'startRadians': math.pi * 0.9, 'endRadians': math.pi * 1.1}
+    if nbsrv.processMsg(d, scan, scanner)['distance'] != 0:
+        log("jammed bots test 2 failed, jammed bot was detected.", "ERROR")
+
+    # jammedBots and scan results only change when scans are reset (once per step).
+    d.bots[hider]['x'] = 600
+    if nbsrv.processMsg(d, scan, scanner)['distance'] != 0:
+        log("jammed bots test 3 failed, scan result changed before reset.", "ERROR")
+    nbsrv.resetScans(d)
+    if nbsrv.processMsg(d, scan, scanner)['distance'] != 200:
+        log("jammed bots test 4 failed, bot not detected after leaving jam zone.", "ERROR")
+
+
+def testScanIndex():
+    d = nbsrv.SrvData()
+    d.conf['scanMaxDistance'] = 600
+    d.conf['jamZones'] = nbsrv.mkJamZones(d, 10)
+    d.bots = mkTestBots(d, 80, seed=8)
+    keys = list(d.bots.keys())
+    for src in keys[:5]:
+        d.bots[src]['health'] = 0
+    d.bots[keys[6]]['x'] = d.bots[keys[7]]['x']  # two bots at the same place
+    d.bots[keys[6]]['y'] = d.bots[keys[7]]['y']
+    nbsrv.resetScans(d)
+
+    rnd = random.Random(9)
+    wedges = [(0, 0), (0, math.pi * 2), (math.pi * 2, 0), (math.pi, math.pi)]
+    for i in range(200):
+        wedges.append((rnd.random() * math.pi * 2, rnd.random() * math.pi * 2))
+
+    for src in keys[5:]:
+        bot = d.bots[src]
+        for startRad, endRad in wedges:
+            expected = 0
+            for src2, bot2 in d.bots.items():
+                if src != src2 and bot2['health'] != 0 and src2 not in d.jammedBots:
+                    dis = nbmath.contains(bot['x'], bot['y'], startRad, endRad, bot2['x'], bot2['y'])
+                    if dis <= d.conf['scanMaxDistance'] and dis != 0 and (expected == 0 or dis < expected):
+                        expected = dis
+            reply = nbsrv.processMsg(d, {'type': 'scanRequest', 'startRadians': startRad, 'endRadians': endRad}, src)
+            if reply['distance'] != expected:
+                log("scan index test failed for " + src + " " + str((startRad, endRad)) + ": " +
+                    str(reply['distance']) + " != " + str(expected), "ERROR")
+                return
+
+
+def testFindAllOverlapingBots():
+    d = nbsrv.SrvData()
+    bots = mkTestBots(d, 200, seed=2)
+    bots[list(bots.keys())[5]]['health'] = 0
+
+    expected = []
+    keys = list(bots.keys())
+    for i in range(len(keys)):
+        for j in range(i + 1, len(keys)):
+            bi = bots[keys[i]]
+            bj = bots[keys[j]]
+            if bi['health'] != 0 and bj['health'] != 0 and \
+                    nbmath.distance(bi['x'], bi['y'], bj['x'], bj['y']) <= d.conf['botRadius'] * 2:
+                expected.append([keys[i], keys[j]])
+
+    pairs = nbsrv.findAllOverlapingBots(d, bots)
+    if pairs != expected:
+        log("findAllOverlapingBots test 1 failed: " + str(pairs) + " != " + str(expected), "ERROR")
+
+    if nbsrv.findOverlapingBots(d, bots) != expected[0]:
+        log("findOverlapingBots test 2 failed", "ERROR")
+
+    if nbsrv.findOverlapingBots(d, [{'x': 100, 'y': 100}, {'x': 200, 'y': 100}]) != False:
+        log("findOverlapingBots test 3 failed", "ERROR")
+
+
+def testResolveCollisions():
+    d = nbsrv.SrvData()
+    d.state = copy.deepcopy(d.state)
+    d.bots = mkTestBots(d, 100, seed=4)
+    for src, bot in d.bots.items():
+        bot['hitSeverity'] = 0.0
+
+    nbsrv.resolveCollisions(d)
+    if nbsrv.findAllOverlapingBots(d, d.bots):
+        log("resolveCollisions test 1 failed, bots still overlap.", "ERROR")
+    if d.state['collisionIterations'] < 2 or d.state['collisionPenetrationMax'] <= 0:
+        log("resolveCollisions test 2 failed, stats not recorded: " + str(d.state), "ERROR")
+    if d.state['collisionLimitCount'] != 0:
+        log("resolveCollisions test 3 failed, limit reached.", "ERROR")
+
+    # Reaching the iteration limit must still leave every bot inside the arena.
+    d.bots = mkTestBots(d, 100, seed=5)
+    for src, bot in d.bots.items():
+        bot['hitSeverity'] = 0.0
+        bot['x'] = -100
+    d.state['collisionMaxIterations'] = 1
+    nbsrv.resolveCollisions(d)
+    if d.state['collisionLimitCount'] != 1:
+        log("resolveCollisions test 4 failed, limit not counted.", "ERROR")
+    for src, bot in d.bots.items():
+        if bot['x'] < d.conf['botRadius'] or bot['x'] > d.conf['arenaSize'] - d.conf['botRadius'] or \
+                bot['y'] < d.conf['botRadius'] or bot['y'] > d.conf['arenaSize'] - d.conf['botRadius']:
+            log("resolveCollisions test 5 failed, bot left outside arena: " + str(bot), "ERROR")
+            break
+
+
+def testClassParams():
+    d = nbsrv.SrvData()
+    d.compileClassParams()
+
+    class ConfOnly:
+        conf = d.conf
+
+    for c in d.conf['classes']:
+        for fld in d.conf['classFields']:
+            expected = d.conf[fld] * d.conf['classes'][c].get(fld, 1)
+            if round(d.getClassValue(fld, c), 8) != round(expected, 8):
+                log("class params test 1 failed for " + c + " " + fld, "ERROR")
+            if getattr(d.getClassParams(c), fld) != d.getClassValue(fld, c):
+                log("class params test 2 failed for " + c + " " + fld, "ERROR")
+            if nbsrv.SrvData.getClassValue(ConfOnly(), fld, c) != d.getClassValue(fld, c):
+                log("class params test 3 failed for " + c + " " + fld, "ERROR")
+
+    try:
+        d.getClassValue('arenaSize', 'heavy')
+        log("class params test 4 failed, exception not raised.", "ERROR")
+    except Exception:
+        pass
+
+
+def testStartStepMsgs():
+    d = nbsrv.SrvData()
+    d.bots = {'a': {'missedSteps': 0}, 'b': {'missedSteps': 0}}
+    d.botMsgCount = {'a': 2}
+
+    missed = nbsrv.startStepMsgs(d)
+    if d.bots['a']['missedSteps'] != 0 or d.bots['b']['missedSteps'] != 1 or missed != 1:
+        log("start step msgs test 1 failed, missedSteps = " + str(d.bots) + " missed " + str(missed), "ERROR")
+    if d.botMsgCount != {}:
+        log("start step msgs test 2 failed, botMsgCount not reset.", "ERROR")
+
+    missed = nbsrv.startStepMsgs(d)
+    if d.bots['a']['missedSteps'] != 1 or d.bots['b']['missedSteps'] != 2 or missed != 2:
+        log("start step msgs test 3 failed, missedSteps = " + str(d.bots) + " missed " + str(missed), "ERROR")
+
+
+def testSrvDataArenas():
+    d1 = nbsrv.SrvData()
+    d2 = nbsrv.SrvData()
+    d1.conf['botsInGame'] = 8
+    d1.state['gameNumber'] = 3
+    d1.bots['a'] = {}
+    d1.startBots.append('a')
+
+    if d2.conf['botsInGame'] != 4 or nbsrv.SrvData.conf['botsInGame'] != 4:
+        log("arena test 1 failed, conf is shared.", "ERROR")
+    if d2.state['gameNumber'] != 0 or nbsrv.SrvData.state['gameNumber'] != 0:
+        log("arena test 2 failed, state is shared.", "ERROR")
+    if d2.bots != {} or d2.startBots != []:
+        log("arena test 3 failed, game data is shared.", "ERROR")
+
+
+def testHeadless():
+    def play(seed):
+        robots = [nbheadless.SittingDuck(), nbheadless.WallBanger(), nbheadless.LightHouse(), nbheadless.LightHouse()]
+        return nbheadless.runHeadless(robots, {'gamesToPlay': 2, 'stepMax': 300}, seed=seed)
+
+    random.seed(1)
+    state = random.getstate()
+    d1 = play(7)
+    d2 = play(7)
+    if random.getstate() != state:
+        log("headless test 5 failed, runHeadless changed the random module state.", "ERROR")
+    if d1.state['gameNumber'] != 2:
+        log("headless test 1 failed, games played: " + str(d1.state['gameNumber']), "ERROR")
+    if [b['points'] for b in d1.bots.values()] != [b['points'] for b in d2.bots.values()]:
+        log("headless test 2 failed, same seed gave different points.", "ERROR")
+    if sum([b['missedSteps'] for b in d1.bots.values()]) != 0:
+        log("headless test 3 failed, robots missed steps.", "ERROR")
+    if d1.bots is d2.bots or d1.conf is nbsrv.SrvData.conf:
+        log("headless test 4 failed, runs share data.", "ERROR")
+
+
+def testHeadlessPool():
+    def mkRobots():
+        return [nbheadless.SittingDuck(), nbheadless.WallBanger(), nbheadless.LightHouse(), nbheadless.LightHouse()]
+
+    conf = {'gamesToPlay': 2, 'stepMax': 300}
+    batch0 = nbheadless.runHeadless(mkRobots(), conf, seed=7)
+    batch1 = nbheadless.runHeadless(mkRobots(), conf, seed=8)
+    pooled = nbheadless.runHeadlessPool(mkRobots(), {'gamesToPlay': 4, 'stepMax': 300}, seed=7, workers=2)
+
+    if pooled.state['gameNumber'] != 4:
+        log("headless pool test 1 failed, games played: " + str(pooled.state['gameNumber']), "ERROR")
+    if pooled.state['serverSteps'] != batch0.state['serverSteps'] + batch1.state['serverSteps']:
+        log("headless pool test 2 failed, steps not summed.", "ERROR")
+    for src in batch0.bots:
+        if pooled.bots[src]['points'] != batch0.bots[src]['points'] + batch1.bots[src]['points']:
+            log("headless pool test 3 failed, points not summed for " + src, "ERROR")
+
+
+def testSeededLayout():
+    def layout(seed):
+        d = nbsrv.SrvData()
+        d.rng.seed(seed)
+        d.conf['obstacles'] = nbsrv.mkObstacles(d, 5)
+        d.conf['jamZones'] = nbsrv.mkJamZones(d, 3)
+        nbsrv.mkStartLocations(d)
+        return d
+
+    d1 = layout(3)
+    random.seed()  # the global random state must not matter.
+    d2 = layout(3)
+    d3 = layout(4)
+    if d1.conf['obstacles'] != d2.conf['obstacles'] or d1.conf['jamZones'] != d2.conf['jamZones']:
+        log("seeded layout test 1 failed, same seed gave different obstacles or jam zones.", "ERROR")
+    if [d1.starts.pop() for i in range(len(d1.starts))] != [d2.starts.pop() for i in range(len(d2.starts))]:
+        log("seeded layout test 2 failed, same seed gave different starts.", "ERROR")
+    if d1.conf['obstacles'] == d3.conf['obstacles']:
+        log("seeded layout test 3 failed, different seeds gave the same obstacles.", "ERROR")
+
+
+def testRecordReplay():
+    filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), "unittests-recording.tmp")
+    robots = [nbheadless.SittingDuck(), nbheadless.WallBanger(), nbheadless.LightHouse(), nbheadless.LightHouse()]
+    try:
+        d1 = nbheadless.runHeadless(robots, {'gamesToPlay': 2, 'stepMax': 300}, obstacles=3, jamZones=2,
+                                    seed=7, record=filename)
+        d2 = nbsrv.replayRecording(filename, True)
+    finally:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    if d1.state['serverSteps'] != d2.state['serverSteps'] or d1.state['gameNumber'] != d2.state['gameNumber']:
+        log("record replay test 1 failed, replay played different steps or games.", "ERROR")
+    if d1.conf['obstacles'] != d2.conf['obstacles'] or d1.starts.asDict() != d2.starts.asDict():
+        log("record replay test 2 failed, replay has a different layout.", "ERROR")
+    for src, bot in d1.bots.items():
+        # Headless counts missed steps itself, so only compare game results.
+        for k in ['points', 'health', 'x', 'y', 'firedCount', 'shellDamage', 'winCount', 'winHealth']:
+            if bot[k] != d2.bots[src][k]:
+                log("record replay test 3 failed, " + src + " " + k + " differs: " + str(bot[k]) +
+                    " != " + str(d2.bots[src][k]), "ERROR")
+
+
+def testIdleJump():
+    class WallSitter(nbheadless.HeadlessRobot):
+        """ Drives into the east wall at the start of each game and then sits there. """
+        name = "WallSitter"
+
+        def play(self, srv):
+            info = srv.sendRecvMessage({'type': 'getInfoRequest'})
+            if info['health'] != 0 and info['gameStep'] == 0:
+                srv.sendRecvMessage({'type': 'setDirectionRequest', 'requestedDirection': 0})
+                srv.sendRecvMessage({'type': 'setSpeedRequest', 'requestedSpeed': 50})
+
+    def run(idle, record=None):
+        robots = [WallSitter(), WallSitter(), nbheadless.SittingDuck(), nbheadless.SittingDuck()]
+        return nbheadless.runHeadless(robots, {'gamesToPlay': 3, 'stepMax': 2000}, seed=3, record=record, idle=idle)
+
+    filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), "unittests-recording.tmp")
+    try:
+        d1 = run('off')
+        d2 = run('jump', filename)
+        d3 = nbsrv.replayRecording(filename, True)
+    finally:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    if d2.state['idleJumpCount'] != 3 or d2.state['serverSteps'] + d2.state['idleStepsSkipped'] != d1.state['serverSteps']:
+        log("idle jump test 1 failed, jumped " + str(d2.state['idleJumpCount']) + " games, " +
+            str(d2.state['serverSteps']) + " + " + str(d2.state['idleStepsSkipped']) + " steps != " +
+            str(d1.state['serverSteps']), "ERROR")
+    for src, bot in d1.bots.items():
+        for k in ['points', 'health', 'x', 'y', 'winCount', 'winHealth']:
+            if bot[k] != d2.bots[src][k]:
+                log("idle jump test 2 failed, " + src + " " + k + " differs: " + str(bot[k]) +
+                    " != " + str(d2.bots[src][k]), "ERROR")
+    if d3.state['serverSteps'] != d2.state['serverSteps'] or d3.state['idleStepsSkipped'] != d2.state['idleStepsSkipped']:
+        log("idle jump test 3 failed, replay did not jump the same steps.", "ERROR")
+
+    # Only messages that are not queries stop a game from being idle.
+    d = nbsrv.SrvData()
+    d.state['idlePolicy'] = 'jump'
+    d.state['idleMinSteps'] = 5
+    d.bots = mkTestBots(d, 2)
+    for i, bot in enumerate(d.bots.values()):
+        bot['x'] = bot['y'] = 200 + i * 500
+        bot['currentSpeed'] = bot['requestedSpeed'] = 0
+        bot['currentDirection'] = bot['requestedDirection'] = 0
+    src = list(d.bots.keys())[0]
+    for i in range(10):
+        nbsrv.processMsg(d, {'type': 'setSpeedRequest', 'requestedSpeed': 0}, src)
+        nbsrv.step(d)
+    if nbsrv.isIdle(d):
+        log("idle jump test 4 failed, game with setSpeedRequest each step is idle.", "ERROR")
+    for i in range(5):
+        nbsrv.processMsg(d, {'type': 'getInfoRequest'}, src)
+        nbsrv.step(d)
+    if not nbsrv.isIdle(d):
+        log("idle jump test 5 failed, game with only queries is not idle.", "ERROR")
+
+
+def testLockstep():
+    class ReplySink:
+        def sendMessage(self, msg, ip, port, checked=False):
+            pass
+
+    d = nbsrv.SrvData()
+    d.srvSocket = ReplySink()
+    d.conf['lockstep'] = True
+    d.conf['dropRate'] = 0
+    d.bots = mkTestBots(d, 3)
+    srcs = list(d.bots.keys())
+    d.bots[srcs[2]]['health'] = 0
+    nbsrv.startStepMsgs(d)
+    d.nextStepAt = time.perf_counter() + 60
+
+    # bot 0 ends its turn with endTurnRequest and bot 1 by using all its messages. bot 2 is dead.
+    nbsrv.processMsg(d, {'type': 'endTurnRequest'}, srcs[0])
+    nbsrv.stepIfTurnsEnded(d)
+    if d.nextStepAt < time.perf_counter() + 30:
+        log("lockstep test 1 failed, stepped before all bots ended their turn.", "ERROR")
+    ip, port = srcs[1].split(":")
+    nbsrv.replyMsgs(d, [({'type': 'getInfoRequest'}, ip, int(port))] * d.conf['botMsgsPerStep'])
+    nbsrv.stepIfTurnsEnded(d)
+    if d.nextStepAt > time.perf_counter() or d.state['lockstepEarlySteps'] != 1:
+        log("lockstep test 2 failed, did not step once all bots ended their turn.", "ERROR")
+
+    nbsrv.startStepMsgs(d)
+    if d.endedTurns or d.aliveCount != 2:
+        log("lockstep test 3 failed, turns not reset for next step: " + str(d.endedTurns), "ERROR")
+
+
+def testAdaptStepSec():
+    def adapt(d, missed=0):
+        # missed bot steps are all in the first game step.
+        for i in range(d.state['adaptSteps']):
+            nbsrv.adaptStepSec(d, missed if i == 0 else 0)
+        return d.conf['stepSec']
+
+    d = nbsrv.SrvData()
+    d.state['adaptStepSec'] = True
+    d.state['adaptSteps'] = 10
+    d.bots = {'a': {'missedSteps': 0}, 'b': {'missedSteps': 0}}
+
+    if abs(adapt(d) - 0.045) > 1e-9:
+        log("adapt step sec test 1 failed, no missed steps gave stepSec " + str(d.conf['stepSec']), "ERROR")
+    if abs(adapt(d, 5) - 0.045 * 1.25) > 1e-9:  # 5 of 20 bot steps missed.
+        log("adapt step sec test 2 failed, missed steps gave stepSec " + str(d.conf['stepSec']), "ERROR")
+    d.botLatency = {'a': [0.001, 1], 'b': [0.11, 2]}
+    if abs(adapt(d) - 0.055) > 1e-9:
+        log("adapt step sec test 3 failed, slowest bot latency gave stepSec " + str(d.conf['stepSec']), "ERROR")
+    for i in range(10):
+        adapt(d, 10)
+    if d.conf['stepSec'] != d.state['stepSecMax'] or d.state['adaptStepSecHigh'] != d.state['stepSecMax']:
+        log("adapt step sec test 4 failed, stepSec " + str(d.conf['stepSec']) + " over stepSecMax.", "ERROR")
+    if d.state['adaptChanges'] != 6 or abs(d.state['adaptStepSecLow'] - 0.045) > 1e-9:
+        log("adapt step sec test 5 failed, changes " + str(d.state['adaptChanges']) + " low " +
+            str(d.state['adaptStepSecLow']), "ERROR")
+
+    # Steps missed between games or while waiting for bots to join are not game steps.
+    d = nbsrv.SrvData()
+    d.state['adaptStepSec'] = True
+    d.state['adaptSteps'] = 10
+    d.bots = {'a': {'missedSteps': 1000}, 'b': {'missedSteps': 0}}
+    if abs(adapt(d) - 0.045) > 1e-9:
+        log("adapt step sec test 7 failed, missed steps outside games gave stepSec " + str(d.conf['stepSec']), "ERROR")
+
+    # Latency is measured from a reply to the next message from the same bot.
+    class ReplySink:
+        def sendMessage(self, msg, ip, port, checked=False):
+            pass
+
+    d = nbsrv.SrvData()
+    d.srvSocket = ReplySink()
+    d.state['adaptStepSec'] = True
+    d.conf['dropRate'] = 0
+    d.bots = mkTestBots(d, 1)
+    ip, port = list(d.bots.keys())[0].split(":")
+    nbsrv.replyMsgs(d, [({'type': 'getInfoRequest'}, ip, int(port))])
+    nbsrv.replyMsgs(d, [({'type': 'getInfoRequest'}, ip, int(port))])
+    if [v[1] for v in d.botLatency.values()] != [1]:
+        log("adapt step sec test 6 failed, bot latency " + str(d.botLatency), "ERROR")
+
+
+def testMsgValidators():
+    valid = [
+        {'type': 'joinRequest', 'name': 'Bot'},
+        {'type': 'joinRequest', 'name': 'Bot', 'class': 'heavy', 'msgID': 3, 'replyData': [1, 2]},
+        {'type': 'scanRequest', 'startRadians': 0, 'endRadians': math.pi * 2},
+        {'type': 'getInfoReply', 'gameNumber': 1, 'gameStep': 5, 'health': 99.5, 'points': 3},
+        {'type': 'getCanonReply', 'shellInProgress': False},
+        {'type': 'endTurnRequest'}
+        ]
+    invalid = [
+        {'type': 'joinRequest'},  # missing field
+        {'type': 'joinRequest', 'name': ''},  # str too short
+        {'type': 'joinRequest', 'name': 'Bot', 'class_o': 'heavy'},  # optional marker in field name
+        {'type': 'scanRequest', 'startRadians': 7, 'endRadians': 1},  # out of range
+        {'type': 'scanRequest', 'startRadians': "0", 'endRadians': 1},  # wrong type
+        {'type': 'getInfoRequest', 'extra': 1}  # extra field
+        ]
+    for msg in valid:
+        result = nbipc.msgValidators[msg['type']](msg)
+        if result is not None:
+            log("msg validators test 1 failed, valid msg rejected: " + result, "ERROR")
+    for msg in invalid:
+        if nbipc.msgValidators[msg['type']](msg) is None:
+            log("msg validators test 2 failed, invalid msg accepted: " + str(msg), "ERROR")
+    if set(nbipc.msgValidators.keys()) != set(nbipc.MsgDef.keys()):
+        log("msg validators test 3 failed, not every MsgDef type has a validator.", "ERROR")
+    if nbipc.msgTypeTuple('(int,float)') != (int, float):
+        log("msg validators test 4 failed, type tuple " + str(nbipc.msgTypeTuple('(int,float)')), "ERROR")
+
+
+def testLogWriter():
+    filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), "unittests-log.tmp")
+    for background in [False, True]:
+        writer = nblog.LogWriter(filename, maxBytes=100, backups=2, background=background)
+        for i in range(30):
+            writer.write("line " + str(i).zfill(4) + "\n")  # 10 chars, so 10 lines per file.
+        writer.close()
+        try:
+            files = [filename + ".2", filename + ".1", filename]
+            lines = []
+            for f in files:
+                with open(f) as fp:
+                    lines += fp.read().splitlines()
+            if lines != ["line " + str(i).zfill(4) for i in range(30)]:
+                log("log writer test 1 failed, background " + str(background) + " lines " + str(lines), "ERROR")
+        finally:
+            for f in [filename, filename + ".1", filename + ".2", filename + ".3"]:
+                if os.path.exists(f):
+                    os.remove(f)
+
+    called = []
+    nblog.log(lambda: called.append(1) or "not logged", "DEBUG")
+    if called or nblog.logEnabled("DEBUG") or not nblog.logEnabled("INFO"):
+        log("log writer test 2 failed, DEBUG message was built while DEBUG is off.", "ERROR")
+    if nblog.callerName(sys._getframe()) != "__main__.testLogWriter()":
+        log("log writer test 3 failed, caller name " + nblog.callerName(sys._getframe()), "ERROR")
+
+
+def testReplyStash():
+    srv = nbipc.NetBotSocket('127.0.0.1', 0)
+    srvPort = srv.s.getsockname()[1]
+    bot = nbipc.NetBotSocket('127.0.0.1', 0, '127.0.0.1', srvPort)
+    botPort = bot.s.getsockname()[1]
+
+    # The server does not reply in time so the first request fails.
+    first = {'type': 'setSpeedRequest', 'requestedSpeed': 50}
+    try:
+        bot.sendRecvMessage(first, retries=1, delay=0.01)
+        log("reply stash test 1 failed, request with no reply did not raise.", "ERROR")
+    except nbipc.NetBotSocketException:
+        pass
+    request, ip, port = srv.recvMessage()
+
+    # The late reply to the first request arrives while the bot waits for the second.
+    srv.sendMessage({'type': 'setSpeedReply', 'msgID': request['msgID']}, '127.0.0.1', botPort)
+    srv.sendMessage({'type': 'getLocationReply', 'x': 1, 'y': 2, 'msgID': bot.msgID + 1}, '127.0.0.1', botPort)
+    time.sleep(0.05)
+    reply = bot.sendRecvMessage({'type': 'getLocationRequest'}, delay=1)
+    if reply != {'type': 'getLocationReply', 'x': 1, 'y': 2} or first['msgID'] not in bot.replyStash:
+        log("reply stash test 2 failed, reply " + str(reply) + " stash " + str(bot.replyStash), "ERROR")
+
+    # Trying the first request again is answered from the stash without sending it again.
+    sent = bot.sent[nbipc.formatIpPort('127.0.0.1', srvPort)]
+    reply = bot.sendRecvMessage(first, retries=1, delay=0.01, msgID=first['msgID'])
+    if reply != {'type': 'setSpeedReply'} or bot.sent[nbipc.formatIpPort('127.0.0.1', srvPort)] != sent or \
+            bot.replyStashHits != 1 or bot.replyStash:
+        log("reply stash test 3 failed, reply " + str(reply) + " hits " + str(bot.replyStashHits), "ERROR")
+
+    # Stash is bounded by size and age.
+    bot.replyStashSize = 2
+    for i in range(3):
+        bot.stashReply({'type': 'setSpeedReply', 'msgID': i}, '127.0.0.1', srvPort)
+    if list(bot.replyStash.keys()) != [1, 2]:
+        log("reply stash test 4 failed, stash " + str(bot.replyStash), "ERROR")
+    bot.replyStashSecs = 0
+    if bot.popStashedReply(2, '127.0.0.1', srvPort) is not None or bot.replyStash:
+        log("reply stash test 5 failed, stash " + str(bot.replyStash), "ERROR")
+
+    # A second copy of the reply to a call that was answered (it was sent twice) is not kept.
+    bot.replyStashSecs = 10.0
+    srv.sendMessage({'type': 'setSpeedReply', 'msgID': first['msgID']}, '127.0.0.1', botPort)
+    srv.sendMessage({'type': 'getLocationReply', 'x': 1, 'y': 2, 'msgID': bot.msgID + 1}, '127.0.0.1', botPort)
+    time.sleep(0.05)
+    reply = bot.sendRecvMessage({'type': 'getLocationRequest'}, delay=1)
+    if reply != {'type': 'getLocationReply', 'x': 1, 'y': 2} or bot.replyStash or bot.replyStashDrops != 1:
+        log("reply stash test 6 failed, stash " + str(bot.replyStash) + " drops " + str(bot.replyStashDrops), "ERROR")
+
+    # A msgID that is used again for a new request is no longer answered.
+    bot.msgID = first['msgID'] - 1
+    srv.sendMessage({'type': 'setSpeedReply', 'msgID': first['msgID']}, '127.0.0.1', botPort)
+    time.sleep(0.05)
+    reply = bot.sendRecvMessage({'type': 'setSpeedRequest', 'requestedSpeed': 10}, delay=1)
+    if reply != {'type': 'setSpeedReply'} or first['msgID'] not in bot.answered:
+        log("reply stash test 7 failed, reply " + str(reply) + " answered " + str(bot.answered), "ERROR")
+
+    srv.s.close()
+    bot.s.close()
+
+
+def testRttEstimator():
+    rtt = nbipc.RttEstimator()
+    rtt.backoff()
+    if rtt.rto is not None or rtt.backoffs != 0:
+        log("rtt test 1 failed, backoff before first sample changed rto " + str(rtt.rto), "ERROR")
+
+    # RFC 6298: srtt = r, rttvar = r / 2 then rttvar = 3/4 rttvar + 1/4 |srtt - r|, srtt = 7/8 srtt + 1/8 r
+    rtt.sample(0.1)
+    if abs(rtt.srtt - 0.1) > 1e-9 or abs(rtt.rttvar - 0.05) > 1e-9 or abs(rtt.rto - 0.3) > 1e-9:
+        log("rtt test 2 failed, srtt " + str(rtt.srtt) + " rttvar " + str(rtt.rttvar) + " rto " + str(rtt.rto), "ERROR")
+    rtt.sample(0.2)
+    if abs(rtt.srtt - 0.1125) > 1e-9 or abs(rtt.rttvar - 0.0625) > 1e-9 or abs(rtt.rto - 0.3625) > 1e-9:
+        log("rtt test 3 failed, srtt " + str(rtt.srtt) + " rttvar " + str(rtt.rttvar) + " rto " + str(rtt.rto), "ERROR")
+    rtt.backoff()
+    if abs(rtt.rto - 0.725) > 1e-9 or rtt.backoffs != 1:
+        log("rtt test 4 failed, backoff gave rto " + str(rtt.rto), "ERROR")
+    for i in range(10):
+        rtt.backoff()
+    if rtt.rto != rtt.rtoMax:
+        log("rtt test 5 failed, backoff not limited to rtoMax " + str(rtt.rto), "ERROR")
+    for i in range(100):
+        rtt.sample(0.0001)
+    if rtt.rto != rtt.rtoMin:
+        log("rtt test 6 failed, rto not limited to rtoMin " + str(rtt.rto), "ERROR")
+
+    # Karn's rule: a request that needed a resend is not sampled and backs off rto.
+    srv = nbipc.NetBotSocket('127.0.0.1', 0)
+    srvPort = srv.s.getsockname()[1]
+    bot = nbipc.NetBotSocket('127.0.0.1', 0, '127.0.0.1', srvPort)
+    botPort = bot.s.getsockname()[1]
+    rtt = bot.getRttEstimator(nbipc.formatIpPort('127.0.0.1', srvPort))
+    srv.sendMessage({'type': 'setSpeedReply', 'msgID': bot.msgID + 1}, '127.0.0.1', botPort)
+    time.sleep(0.05)
+    bot.sendRecvMessage({'type': 'setSpeedRequest', 'requestedSpeed': 50}, delay=1)
+    if rtt.samples != 1 or rtt.rto != rtt.rtoMin:
+        log("rtt test 7 failed, samples " + str(rtt.samples) + " rto " + str(rtt.rto), "ERROR")
+    try:
+        bot.sendRecvMessage({'type': 'setSpeedRequest', 'requestedSpeed': 50}, retries=2)
+    except nbipc.NetBotSocketException:
+        pass
+    if rtt.samples != 1 or rtt.backoffs != 1 or rtt.rto != rtt.rtoMin * 2 or bot.sendRecvMessageResends != 1:
+        log("rtt test 8 failed, samples " + str(rtt.samples) + " backoffs " + str(rtt.backoffs) + " rto " + str(rtt.rto), "ERROR")
+    if "Retransmit Timeout (RTO): 10.000 ms" not in bot.getStats():
+        log("rtt test 9 failed, rto not in stats " + bot.getStats(), "ERROR")
+    srv.s.close()
+    bot.s.close()
+
+
+def testAsyncNetBotSocket():
+    async def run():
+        srv = await nbipc.AsyncNetBotSocket.create('127.0.0.1', 0)
+        srvPort = srv.transport.get_extra_info('sockname')[1]
+        bot = await nbipc.AsyncNetBotSocket.create('127.0.0.1', 0, '127.0.0.1', srvPort)
+
+        async def serve():
+            # Wait for all 4 requests, ignore the first copy of the scan (as if it was dropped),
+            # then reply in reverse order. Only the scan has a short enough delay to be resent.
+            # Each reply is sent twice, as if a resend was answered too.
+            requests = {}
+            ignored = False
+            while len(requests) < 4:
+                msg, ip, port = await srv.recvMessage()
+                if msg['type'] == 'scanRequest' and not ignored:
+                    ignored = True
+                    continue
+                if msg['msgID'] not in requests:
+                    requests[msg['msgID']] = (msg, ip, port)
+            for msg, ip, port in reversed(list(requests.values())):
+                reply = {'type': msg['type'].replace('Request', 'Reply'), 'msgID': msg['msgID']}
+                if msg['type'] == 'getLocationRequest':
+                    reply.update({'x': 1, 'y': 2})
+                elif msg['type'] == 'scanRequest':
+                    reply['distance'] = 3
+                elif msg['type'] == 'getCanonRequest':
+                    reply = {'type': 'Error', 'result': "Test error.", 'msgID': msg['msgID']}
+                srv.sendMessage(reply, ip, port)
+                srv.sendMessage(reply, ip, port)
+
+        async def canon():
+            try:
+                await bot.sendRecvMessage({'type': 'getCanonRequest'}, delay=5)
+                return None
+            except nbipc.NetBotSocketException as e:
+                return str(e)
+
+        server = asyncio.ensure_future(serve())
+        results = await asyncio.gather(
+            bot.sendRecvMessage({'type': 'getLocationRequest'}, delay=5),
+            bot.sendRecvMessage({'type': 'scanRequest', 'startRadians': 0, 'endRadians': 1}, delay=0.05),
+            bot.sendRecvMessage({'type': 'setSpeedRequest', 'requestedSpeed': 50}, delay=5),
+            canon())
+        await server
+        await asyncio.sleep(0.1)  # let the second copies of the replies arrive.
+        srv.close()
+        bot.close()
+        return results, bot
+
+    results, bot = asyncio.run(run())
+    if results[0] != {'type': 'getLocationReply', 'x': 1, 'y': 2} or results[1] != {'type': 'scanReply', 'distance': 3} or \
+            results[2] != {'type': 'setSpeedReply'}:
+        log("async socket test 1 failed, replies not matched to requests: " + str(results), "ERROR")
+    if results[3] != "Received Error Message: Test error.":
+        log("async socket test 2 failed, Error reply gave: " + str(results[3]), "ERROR")
+    if bot.sendRecvMessageResends != 1 or bot.waiting:
+        log("async socket test 3 failed, resends " + str(bot.sendRecvMessageResends) + " waiting " + str(bot.waiting), "ERROR")
+    if not bot.received.empty():
+        log("async socket test 4 failed, " + str(bot.received.qsize()) + " late replies were queued.", "ERROR")
+
+
+def testStartSchedule():
+    perms = [list(p) for p in itertools.permutations(range(4))]
+    if [nbsrv.nthPermutation(4, k) for k in range(24)] != perms:
+        log("start schedule test 1 failed, nthPermutation does not match itertools.permutations.", "ERROR")
+
+    d = nbsrv.SrvData()
+    d.rng.seed(1)
+    d.conf['gamesToPlay'] = 30
+    d.conf['startPermutations'] = True
+    nbsrv.mkStartLocations(d)
+    starts = [d.starts.pop() for i in range(len(d.starts))]
+    first = sorted((loc['x'], loc['y']) for loc in starts[0])
+    for start in starts[:24]:
+        if sorted((loc['x'], loc['y']) for loc in start) != first:
+            log("start schedule test 2 failed, permutations of a layout use different locations.", "ERROR")
+    if len(set(tuple((loc['x'], loc['y']) for loc in start) for start in starts)) != 30:
+        log("start schedule test 3 failed, a start was used twice.", "ERROR")
+    try:
+        d.starts.pop()
+        log("start schedule test 4 failed, pop from empty schedule did not raise IndexError.", "ERROR")
+    except IndexError:
+        pass
+
+    # 10 bots have 3628800 permutations per layout. None of them should be made up front.
+    d.conf['botsInGame'] = 10
+    d.conf['gamesToPlay'] = 1000
+    nbsrv.mkStartLocations(d)
+    if len(d.starts) != 1000 or len(d.starts.pop()) != 10:
+        log("start schedule test 5 failed, 10 bot schedule.", "ERROR")
+
+    # Too crowded for random darts, so the Poisson disk layout is needed.
+    d = nbsrv.SrvData()
+    d.rng.seed(2)
+    d.conf['arenaSize'] = 600
+    d.conf['obstacleRadius'] = 8
+    d.conf['obstacles'] = [{'x': 300, 'y': 300, 'radius': 48}]
+    d.conf['botsInGame'] = 65
+    nbsrv.mkStartLocations(d)
+    for i in range(len(d.starts)):
+        locs = d.starts.pop()
+        if len(locs) != 65 or nbsrv.findOverlapingBots(d, locs) or nbsrv.findOverlapingBotsAndObstacles(d, locs):
+            log("start schedule test 6 failed, crowded layout overlaps.", "ERROR")
+
+    # A later layout that does not fit stops only its arena, after the games already played.
+    d = nbsrv.SrvData()
+    d.conf['stepMax'] = 10
+    for i in range(d.conf['botsInGame']):
+        src = "127.0.0.1:" + str(20000 + i)
+        d.bots[src] = copy.deepcopy(d.botTemplate)
+        d.startBots.append(src)
+    layouts = []
+
+    def mkLayout(rng):
+        if layouts:
+            raise nbsrv.StartLayoutError("Test layout does not fit.")
+        layouts.append([{'x': 100 + 200 * i, 'y': 500} for i in range(d.conf['botsInGame'])])
+        return layouts[0]
+
+    d.starts = nbsrv.StartSchedule(3, d.conf['botsInGame'], False, 1, mkLayout)
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        for i in range(100):
+            if d.done:
+                break
+            nbsrv.stepGame(d)
+    if not d.done or d.state['gameNumber'] != 1 or "Test layout does not fit." not in out.getvalue():
+        log("start schedule test 7 failed, arena did not stop after game 1 when a layout did not fit.", "ERROR")
+
+
+def testExplosionRing():
+    ring = nbsrv.ExplosionRing(3)
+    ring.add(5, 10, 20, "a")
+    ring.add(5, 11, 21, "b")
+    if ring.asDict(5) != {0: {'x': 10, 'y': 20, 'stepsAgo': 1, 'src': "a"}, 1: {'x': 11, 'y': 21, 'stepsAgo': 1, 'src': "b"}}:
+        log("explosion ring test 1 failed, " + str(ring.asDict(5)), "ERROR")
+    ring.add(6, 12, 22, "c")
+    if {k: e['stepsAgo'] for k, e in ring.asDict(7).items()} != {0: 3, 1: 3, 2: 2}:
+        log("explosion ring test 2 failed, " + str(ring.asDict(7)), "ERROR")
+    if list(ring.asDict(8).keys()) != [2]:
+        log("explosion ring test 3 failed, expired explosions in view: " + str(ring.asDict(8)), "ERROR")
+    ring.add(8, 13, 23, "d")  # reuses the slot of step 5
+    if len(ring) != 2 or sorted(ring.asDict(8).keys()) != [2, 3]:
+        log("explosion ring test 4 failed, slot not reused.", "ERROR")
+    ring.nextIndex = 65000
+    ring.add(8, 0, 0, "e")
+    ring.add(8, 0, 0, "f")
+    if sorted(ring.asDict(8).keys()) != [0, 2, 3, 65000]:
+        log("explosion ring test 5 failed, index did not wrap.", "ERROR")
+
+
+def testTimeHistogram():
+    rnd = random.Random(3)
+    samples = [rnd.expovariate(1000) for i in range(10000)]
+    h = nbtimers.TimeHistogram()
+    for secs in samples:
+        h.add(secs)
+    samples.sort()
+    for p in [50, 99]:
+        exact = samples[int(len(samples) * p / 100) - 1]
+        if not exact <= h.percentile(p) <= exact * (1 + 1.0 / nbtimers.subBuckets):
+            log("time histogram test 1 failed, p" + str(p) + " " + str(h.percentile(p)) + " != " + str(exact), "ERROR")
+    if h.max != samples[-1] or h.percentile(100) != samples[-1] or h.count != len(samples):
+        log("time histogram test 2 failed, wrong max or count.", "ERROR")
+
+    h2 = nbtimers.TimeHistogram()
+    h2.add(200)  # past the last bucket
+    h2.add(0)
+    h.merge(h2)
+    if h.count != len(samples) + 2 or h.max != 200 or h.percentile(100) != 200:
+        log("time histogram test 3 failed, merge.", "ERROR")
+
+    robots = [nbheadless.SittingDuck(), nbheadless.WallBanger(), nbheadless.LightHouse(), nbheadless.LightHouse()]
+    d = nbheadless.runHeadless(robots, {'gamesToPlay': 1, 'stepMax': 100}, seed=1)
+    for name in ['step', 'move', 'collisions', 'hitDamage', 'shells', 'scoring', 'scans']:
+        if d.timers[name].count != d.state['serverSteps']:
+            log("time histogram test 4 failed, " + name + " timed " + str(d.timers[name].count) + " steps.", "ERROR")
+    merged = nbsrv.mergeResults([nbsrv.arenaResult(d), nbsrv.arenaResult(d)])
+    if merged.timers['step'].count != d.state['serverSteps'] * 2 or merged.timers['step'] is d.timers['step']:
+        log("time histogram test 5 failed, timers not merged.", "ERROR")
+
+    # bots of an arena with fewer steps have missedSteps scaled up to all steps.
+    other = copy.deepcopy(nbsrv.arenaResult(d))
+    other['bots'] = {src + "0": bot for src, bot in other['bots'].items()}
+    other['state']['serverSteps'] += 7
+    merged = nbsrv.mergeResults([nbsrv.arenaResult(d), other])
+    if any(not isinstance(bot['missedSteps'], int) for bot in merged.bots.values()):
+        log("merge results test failed, missedSteps is not a whole number of steps.", "ERROR")
+
+
 def main():
     testHitSeverity()
+    testClassParams()
+    testNumpyMoveBots()
+    testNumpyMoveShells()
+    testIntersectLineCircle()
+    testCircleGrid()
+    testJammedBots()
+    testScanIndex()
+    testFindAllOverlapingBots()
+    testResolveCollisions()
+    testStartStepMsgs()
+    testSrvDataArenas()
+    testHeadless()
+    testHeadlessPool()
+    testSeededLayout()
+    testRecordReplay()
+    testIdleJump()
+    testLockstep()
+    testAdaptStepSec()
+    testMsgValidators()
+    testLogWriter()
+    testReplyStash()
+    testRttEstimator()
+    testAsyncNetBotSocket()
+    testTimeHistogram()
+    testStartSchedule()
+    testExplosionRing()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file